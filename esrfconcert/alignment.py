@@ -0,0 +1,413 @@
+"""Pre-scan alignment routines.
+
+Usage::
+
+    # Find the smallest ROI containing the sample over the whole trajectory of a laminography scan
+    plan = await plan_roi(ex, num_angles=8, margin=32)
+    print(plan)
+    # Use it for the next scan
+    await plan.apply(camera)
+
+    # Center the sample on the rotation axis within 5 um
+    result = await center_sample(ex, sample_motor, manipulator, pixel_size=1.1 * q.um,
+                                 tolerance=5 * q.um)
+    print(result)
+"""
+import logging
+import time
+import numpy as np
+from concert.quantities import q
+from esrfconcert.imageprocessing import center_of_mass
+
+
+LOG = logging.getLogger(__name__)
+
+
+def get_absorption(projections, flats, darks=None):
+    """Absorption 1 - (projections - darks) / (flats - darks) of *projections* (..., height,
+    width). *flats* and *darks* are broadcast against *projections*.
+    """
+    projections = np.asarray(projections, dtype=np.float32)
+    flats = np.asarray(flats, dtype=np.float32)
+    if darks is not None:
+        darks = np.asarray(darks, dtype=np.float32)
+        projections = projections - darks
+        flats = flats - darks
+
+    return 1 - projections / np.maximum(flats, 1)
+
+
+def get_edges(masks, min_pixels=1):
+    """Get the sample edges in boolean *masks* (num_images, height, width). A column or row belongs
+    to the sample if at least *min_pixels* of its pixels are set, which suppresses isolated
+    defects. Return an array (num_images, 4) of (left, right, top, bottom) pixel indices
+    (inclusive), NaN for masks without a sample.
+    """
+    masks = np.asarray(masks, dtype=bool)
+    columns = np.count_nonzero(masks, axis=1) >= min_pixels
+    rows = np.count_nonzero(masks, axis=2) >= min_pixels
+    edges = np.array([
+        np.argmax(columns, axis=1),
+        columns.shape[1] - 1 - np.argmax(columns[:, ::-1], axis=1),
+        np.argmax(rows, axis=1),
+        rows.shape[1] - 1 - np.argmax(rows[:, ::-1], axis=1),
+    ], dtype=float).T
+    edges[~np.any(columns, axis=1)] = np.nan
+
+    return edges
+
+
+def fit_sinusoid(values, angles):
+    """Least squares fit of a + b cos(angle) + c sin(angle) to *values* (num_angles, ...) measured
+    at rotation *angles* (a quantity or radians), all columns of *values* are fitted at once. At
+    least three angles are needed. Return the coefficients (a, b, c), each with the shape of one
+    row of *values*.
+    """
+    values = np.asarray(values, dtype=float)
+    angles = np.asarray(angles.to(q.rad).magnitude if hasattr(angles, 'magnitude') else angles,
+                        dtype=float)
+    design = np.stack((np.ones_like(angles), np.cos(angles), np.sin(angles)), axis=1)
+    coeffs = np.linalg.lstsq(design, values.reshape(len(values), -1), rcond=None)[0]
+
+    return tuple(coeffs.reshape((3,) + values.shape[1:]))
+
+
+def get_trajectory_extent(edges, angles):
+    """Get the extent (left, right, top, bottom) of the sample over a full revolution from *edges*
+    (num_angles, 4) as returned by :func:`get_edges` measured at rotation *angles*. Every point of
+    the sample moves on an ellipse in the laminographic projection, so every edge is fitted by
+    :func:`fit_sinusoid` and the extremes of the fits and of the measured edges are used. With
+    fewer than three angles only the measured edges are used.
+    """
+    valid = ~np.any(np.isnan(edges), axis=1)
+    if not np.any(valid):
+        raise ValueError('No sample found in any projection')
+    edges = edges[valid]
+    angles = angles[valid]
+    lower = np.min(edges, axis=0)
+    upper = np.max(edges, axis=0)
+
+    if len(edges) >= 3:
+        offsets, cosines, sines = fit_sinusoid(edges, angles)
+        amplitudes = np.hypot(cosines, sines)
+        lower = np.minimum(lower, offsets - amplitudes)
+        upper = np.maximum(upper, offsets + amplitudes)
+
+    # Left and top are minima, right and bottom maxima
+    return (lower[0], upper[1], lower[2], upper[3])
+
+
+class RoiPlan(object):
+
+    """Camera ROI proposed by :func:`plan_roi`. *x0*, *y0*, *width* and *height* define the ROI on
+    a sensor of *sensor_width* x *sensor_height* pixels, *bytes_per_pixel* and *num_projections*
+    are used to estimate the data volume, *frame_rate* is the frame rate with the full sensor (if
+    known), *buffer_memory* the memory available for camera buffers and *duration* the time the
+    planning took.
+    """
+
+    def __init__(self, x0, y0, width, height, sensor_width, sensor_height, bytes_per_pixel=2,
+                 num_projections=None, frame_rate=None, buffer_memory=40 * q.GiB, duration=None):
+        self.x0 = x0
+        self.y0 = y0
+        self.width = width
+        self.height = height
+        self.sensor_width = sensor_width
+        self.sensor_height = sensor_height
+        self.bytes_per_pixel = bytes_per_pixel
+        self.num_projections = num_projections
+        self.frame_rate = frame_rate
+        self.buffer_memory = buffer_memory
+        self.duration = duration
+
+    @property
+    def frame_rate_gain(self):
+        """Frame rate gain of a rolling shutter sensor read out from the center to the top and
+        bottom (like pco.edge), for which the readout time is given by the row farthest away from
+        the center. This is an upper bound, the exposure time may limit the frame rate earlier.
+        """
+        center = self.sensor_height / 2
+        distance = max(center - self.y0, self.y0 + self.height - center)
+
+        return center / distance
+
+    @property
+    def pixel_gain(self):
+        """Ratio of the full sensor and ROI pixel counts, i.e. the gain in buffer capacity and the
+        reduction of the data volume.
+        """
+        return self.sensor_width * self.sensor_height / (self.width * self.height)
+
+    @property
+    def buffer_capacity(self):
+        """Number of ROI frames fitting into the buffer memory."""
+        frame_size = self.width * self.height * self.bytes_per_pixel * q.B
+
+        return int((self.buffer_memory / frame_size).to_base_units().magnitude)
+
+    @property
+    def data_volume(self):
+        """Data volume of one scan with the ROI."""
+        if self.num_projections is None:
+            return None
+        volume = self.num_projections * self.width * self.height * self.bytes_per_pixel * q.B
+
+        return volume.to(q.GiB)
+
+    async def apply(self, camera):
+        """Set the ROI of *camera*."""
+        await set_roi(camera, self.x0, self.y0, self.width, self.height)
+        LOG.info('ROI set to x0=%d, y0=%d, width=%d, height=%d',
+                 self.x0, self.y0, self.width, self.height)
+
+    def __str__(self):
+        lines = [
+            'ROI: x0={}, y0={}, width={}, height={} (sensor {}x{})'.format(
+                self.x0, self.y0, self.width, self.height, self.sensor_width, self.sensor_height),
+            'Frame rate: {:.2f}x'.format(self.frame_rate_gain),
+            'Buffer capacity: {:.2f}x ({} frames)'.format(self.pixel_gain, self.buffer_capacity),
+            'Data volume: {:.2f}x smaller'.format(self.pixel_gain),
+        ]
+        if self.frame_rate is not None:
+            lines[1] += ' (up to {:.1f})'.format(self.frame_rate * self.frame_rate_gain)
+        if self.num_projections is not None:
+            lines[3] += ' ({:.1f} per scan)'.format(self.data_volume)
+        if self.duration is not None:
+            lines.append('Planning took {:.1f}'.format(self.duration))
+
+        return '\n'.join(lines)
+
+
+def make_roi_plan(extent, sensor_width, sensor_height, margin=32, x_step=1, y_step=1,
+                  symmetric=True, **kwargs):
+    """Make a :class:`RoiPlan` containing the sample *extent* (left, right, top, bottom) as
+    returned by :func:`get_trajectory_extent` plus *margin* pixels on every side. The ROI is aligned
+    to *x_step* and *y_step* pixels and clipped to the sensor. If *symmetric* is True, the ROI is
+    vertically centered on the sensor, which does not slow down center-out readout sensors. The
+    remaining *kwargs* are passed to :class:`RoiPlan`.
+    """
+    left, right, top, bottom = extent
+    x0 = max(0, int(np.floor((left - margin) / x_step)) * x_step)
+    x1 = min(sensor_width, int(np.ceil((right + 1 + margin) / x_step)) * x_step)
+    if symmetric:
+        center = sensor_height / 2
+        half = max(center - (top - margin), bottom + 1 + margin - center)
+        half = min(int(np.ceil(half / y_step)) * y_step, sensor_height // 2)
+        y0 = int(center - half)
+        y1 = int(center + half)
+    else:
+        y0 = max(0, int(np.floor((top - margin) / y_step)) * y_step)
+        y1 = min(sensor_height, int(np.ceil((bottom + 1 + margin) / y_step)) * y_step)
+
+    return RoiPlan(x0, y0, x1 - x0, y1 - y0, sensor_width, sensor_height, **kwargs)
+
+
+async def set_roi(camera, x0, y0, width, height):
+    """Set the ROI of *camera*. Offsets are reset first, so that any new size is valid."""
+    await camera.set_roi_x0(0 * q.pixel)
+    await camera.set_roi_y0(0 * q.pixel)
+    await camera.set_roi_width(width * q.pixel)
+    await camera.set_roi_height(height * q.pixel)
+    await camera.set_roi_x0(x0 * q.pixel)
+    await camera.set_roi_y0(y0 * q.pixel)
+
+
+async def _grab(camera):
+    async with camera.recording():
+        return np.array(await camera.grab(), dtype=np.float32)
+
+
+async def _take_references(experiment):
+    """Take a flat and a dark with the devices of *experiment*, return (flat, dark)."""
+    camera = experiment._camera
+    await experiment._shutter.close()
+    dark = await _grab(camera)
+    await experiment._shutter.open()
+    await experiment._flat_motor.set_position(await experiment.get_flat_position())
+    flat = await _grab(camera)
+    await experiment._flat_motor.set_position(await experiment.get_radio_position())
+
+    return (flat, dark)
+
+
+async def plan_roi(experiment, num_angles=8, margin=32, threshold=0.1, min_pixels=10, x_step=1,
+                   y_step=1, symmetric=True, apply=False):
+    """Plan the camera ROI of laminography *experiment* (e.g.
+    :class:`esrfconcert.experiments.laminography.ContinuousLaminography`). One flat, one dark and
+    *num_angles* projections evenly distributed over a revolution are taken with the full sensor.
+    Pixels with absorption above *threshold* belong to the sample, *min_pixels*, *margin*,
+    *x_step*, *y_step* and *symmetric* are explained in :func:`get_edges` and
+    :func:`make_roi_plan`. The original ROI is restored unless *apply* is True, in which case the
+    planned ROI is set. Return a :class:`RoiPlan`.
+    """
+    start = time.perf_counter()
+    camera = experiment._camera
+    motor = experiment._tomography_motor
+    if await camera.get_state() == 'recording':
+        await camera.stop_recording()
+    roi = [(await getter()).magnitude for getter in (camera.get_roi_x0, camera.get_roi_y0,
+                                                     camera.get_roi_width,
+                                                     camera.get_roi_height)]
+    sensor_width = int((await camera.get_sensor_width()).magnitude)
+    sensor_height = int((await camera.get_sensor_height()).magnitude)
+    angles = await experiment.get_start_angle() + np.linspace(0, 360, num_angles,
+                                                              endpoint=False) * q.deg
+    projections = np.empty((num_angles, sensor_height, sensor_width), dtype=np.float32)
+
+    try:
+        await set_roi(camera, 0, 0, sensor_width, sensor_height)
+        flats, darks = await _take_references(experiment)
+        for i, angle in enumerate(angles):
+            await motor.set_position(angle)
+            projections[i] = await _grab(camera)
+    finally:
+        await set_roi(camera, *roi)
+
+    masks = get_absorption(projections, flats, darks=darks) > threshold
+    extent = get_trajectory_extent(get_edges(masks, min_pixels=min_pixels), angles)
+    plan = make_roi_plan(
+        extent,
+        sensor_width,
+        sensor_height,
+        margin=margin,
+        x_step=x_step,
+        y_step=y_step,
+        symmetric=symmetric,
+        bytes_per_pixel=max(1, await camera.get_sensor_bitdepth() // 8),
+        num_projections=await experiment.get_num_projections(),
+        duration=(time.perf_counter() - start) * q.s
+    )
+    LOG.info('ROI plan:\n%s', plan)
+    if apply:
+        await plan.apply(camera)
+
+    return plan
+
+
+def get_sample_offset(positions, angles):
+    """Get the position of the sample relative to the rotation axis from its horizontal
+    *positions* in pixels in projections taken at rotation *angles*. A point at (x, y) in the frame
+    of the rotation stage is projected to center + x cos(angle) - y sin(angle), which is fitted to
+    *positions*. Return a tuple (center, x, y) in pixels.
+    """
+    center, cosine, sine = fit_sinusoid(positions, angles)
+
+    return (float(center), float(cosine), -float(sine))
+
+
+class CenteringResult(object):
+
+    """Result of :func:`center_sample`. *offsets* is a list of the measured (x, y) sample offsets
+    from the rotation axis in the stage frame, one per iteration, *center* the rotation axis
+    position in pixels, *converged* tells whether the tolerance has been met, *duration* is the
+    total time and *timings* a dictionary with the time spent in imaging, sample manipulation
+    (pushers and magnets) and sample motion.
+    """
+
+    def __init__(self, offsets, center, converged, duration, timings):
+        self.offsets = offsets
+        self.center = center
+        self.converged = converged
+        self.duration = duration
+        self.timings = timings
+
+    @property
+    def num_iterations(self):
+        return len(self.offsets)
+
+    def __str__(self):
+        lines = ['{} after {} iterations in {:.1f}'.format(
+            'Converged' if self.converged else 'Not converged', self.num_iterations,
+            self.duration)]
+        for i, (x, y) in enumerate(self.offsets):
+            lines.append('  {}: x={:.2f}, y={:.2f}'.format(i, x.to(q.um), y.to(q.um)))
+        lines.append('  rotation axis at {:.2f} pixels'.format(self.center))
+        for name, duration in self.timings.items():
+            lines.append('  {}: {:.1f}'.format(name, duration * q.s))
+
+        return '\n'.join(lines)
+
+
+async def center_sample(experiment, sample_motor, manipulator, pixel_size, tolerance=5 * q.um,
+                        angles=None, max_iterations=5, directions=(1, 1)):
+    """Center the sample over the rotation axis of laminography *experiment*, whose tomography
+    motor must be a :class:`esrfconcert.devices.motors.micos.LaminoScanningMotor`. Projections
+    are taken at *angles* relative to the start angle (0, 90, 180 and 270 degrees by default) with
+    the pushers out, the sample offset is estimated from the absorption centers of mass by
+    :func:`get_sample_offset` (*pixel_size* is the effective pixel size) and corrected by moving
+    the sample with *sample_motor* (:class:`esrfconcert.devices.motors.micos.SampleMotor`) at the
+    exchange angle of *manipulator* (:class:`esrfconcert.devices.motors.micos.SampleManipulator`)
+    with the pushers and magnets in. This is repeated until the offset is within *tolerance* or
+    *max_iterations* corrections have been made. *directions* are multiplied with the x and y
+    corrections along the beamline axes and account for the orientation of the stage. The pushers
+    are out at the end, ready for a scan. Return a :class:`CenteringResult`.
+    """
+    start = time.perf_counter()
+    timings = {'imaging': 0, 'manipulation': 0, 'motion': 0}
+    camera = experiment._camera
+    motor = experiment._tomography_motor
+    if angles is None:
+        angles = np.arange(4) * 90 * q.deg
+    angles = await experiment.get_start_angle() + angles
+    exchange_angle = manipulator.exchange_angle.to(q.rad).magnitude
+    pixel_size = pixel_size.to(q.mm)
+    offsets = []
+    converged = False
+
+    async def move_pushers_out():
+        if (await manipulator.sx45.get_state(), await manipulator.sy45.get_state()) != ('out',
+                                                                                      'out'):
+            started = time.perf_counter()
+            await manipulator.move_pushers_out()
+            timings['manipulation'] += time.perf_counter() - started
+
+    await move_pushers_out()
+    started = time.perf_counter()
+    flat, dark = await _take_references(experiment)
+    timings['imaging'] += time.perf_counter() - started
+
+    for i in range(max_iterations + 1):
+        started = time.perf_counter()
+        projections = []
+        for angle in angles:
+            await motor.set_position(angle)
+            projections.append(await _grab(camera))
+        absorption = get_absorption(projections, flat, darks=dark)
+        positions = center_of_mass(absorption)[:, 0]
+        timings['imaging'] += time.perf_counter() - started
+        if np.any(np.isnan(positions)):
+            raise AlignmentError('Sample not found in all projections')
+        center, x, y = get_sample_offset(positions, angles)
+        offsets.append((x * pixel_size, y * pixel_size))
+        LOG.info('Centering iteration %d: sample offset x=%s, y=%s', i, offsets[-1][0],
+                 offsets[-1][1])
+        if np.hypot(x, y) * pixel_size <= tolerance:
+            converged = True
+            break
+        if i == max_iterations:
+            break
+
+        # Offset along the beamline axes when the stage is at the exchange angle
+        started = time.perf_counter()
+        await motor.set_position(manipulator.exchange_angle)
+        await manipulator.move_pushers_in()
+        timings['manipulation'] += time.perf_counter() - started
+        started = time.perf_counter()
+        cos, sin = np.cos(exchange_angle), np.sin(exchange_angle)
+        correction = -np.array([cos * x - sin * y, sin * x + cos * y]) * np.array(directions)
+        await sample_motor.move_relative(correction[np.newaxis] * pixel_size)
+        timings['motion'] += time.perf_counter() - started
+        await move_pushers_out()
+
+    result = CenteringResult(offsets, center, converged, (time.perf_counter() - start) * q.s,
+                             timings)
+    LOG.info('Sample centering:\n%s', result)
+
+    return result
+
+
+class AlignmentError(Exception):
+
+    """Raised when an alignment routine fails."""
+
+    pass
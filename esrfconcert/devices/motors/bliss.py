@@ -5,7 +5,6 @@ import logging
 from concert.base import check, Quantity
 from concert.devices.motors import base
 from concert.quantities import q
-from bliss.shell.standard import mv
 
 
 LOG = logging.getLogger(__name__)
@@ -37,6 +36,9 @@ class _Base(object):
         return self._device.position * self['position'].unit
 
     async def _set_position(self, position):
+        # Importing bliss takes long, defer it until the first motion
+        from bliss.shell.standard import mv
+
         mv(self._device, position.to(self['position'].unit).magnitude)
 
     async def _get_acceleration(self):
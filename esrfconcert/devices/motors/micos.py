@@ -1,14 +1,19 @@
 # TODO: do we still need this?
 """Micos motors from ANKA laminograph at ID19 at ESRF."""
 
+import asyncio
+import logging
 import numpy as np
 from concert.base import State, StateError, Quantity, Parameter, Parameterizable, check
 from concert.coroutines.base import wait_until
 from concert.devices.motors import base
 from concert.quantities import q
-from esrfconcert.networking.micos import SocketConnection
+from esrfconcert.networking.micos import MicosConnectionError, POLL, URGENT, SocketConnection
+from esrfconcert.sequencer import InterlockError, Sequence, Step
 
 
+LOG = logging.getLogger(__name__)
+
 # Define angle between x_beamline and y_beamline
 ALPHA = 90 * q.deg
 # Define angle between x_pusher and y_pusher
@@ -16,17 +21,148 @@ BETA = 90 * q.deg
 # Define angle between x_beamline and x_pusher
 GAMMA = 135 * q.deg
 
+# Soft limit tables (None if the controller does not provide them) by (host, port, controller),
+# shared by all motors of one controller
+_LIMITS = {}
+# Running queries of the soft limits by (host, port, controller)
+_QUERIES = {}
+# Restrictions of the soft limits by (host, port, controller) as lists of (axis index, lower,
+# upper), applied to every table queried from the controller
+_RESTRICTIONS = {}
+
+
+class LimitTable(object):
+
+    """Soft limits of the axes of one controller, *lower* and *upper* contain one value per axis in
+    controller units (mm or deg). Whole arrays of targets are validated at once by
+    :meth:`validate`, so a plan is rejected without talking to the controller.
+    """
+
+    def __init__(self, lower, upper):
+        self.lower = np.array(lower, dtype=float)
+        self.upper = np.array(upper, dtype=float)
+        if self.lower.shape != self.upper.shape:
+            raise ValueError('lower and upper must have the same length')
+
+    def __len__(self):
+        return len(self.lower)
+
+    def restrict(self, index, lower=None, upper=None):
+        """Narrow the limits of axis *index* on top of the controller ones, e.g. to protect the
+        setup. The limits can only get narrower.
+        """
+        if lower is not None:
+            self.lower[index] = max(self.lower[index], lower)
+        if upper is not None:
+            self.upper[index] = min(self.upper[index], upper)
+
+    def validate(self, targets, axes=None):
+        """Check *targets*, either one value per axis in *axes* or an array with shape (N, number
+        of axes) with one row per point. *axes* are the axis indices of the columns, all axes if
+        None. Raise :class:`SoftLimitError` naming the first offending point if any target is
+        outside of the limits.
+        """
+        axes = np.arange(len(self)) if axes is None else np.asarray(axes)
+        targets = np.atleast_1d(np.asarray(targets, dtype=float))
+        if targets.ndim == 1:
+            targets = targets[np.newaxis]
+        if targets.ndim != 2 or targets.shape[1] != len(axes):
+            raise ValueError('targets must have one column per axis')
+        if np.any(axes >= len(self)):
+            raise ValueError('Axes {} outside of the {} controller axes'.format(axes, len(self)))
+        lower = self.lower[axes]
+        upper = self.upper[axes]
+        # Negated, so that NaN targets are invalid too
+        invalid = ~((targets >= lower) & (targets <= upper))
+        if np.any(invalid):
+            point, column = np.argwhere(invalid)[0]
+            msg = 'Point {} of {}: axis {} target {} outside of [{}, {}]'.format(
+                point, len(targets), axes[column], targets[point, column], lower[column],
+                upper[column])
+            raise SoftLimitError('standby', msg)
+
 
 class _Base(object):
 
     """Base for all Micos motors on the laminograph at ID19. Motor *name* is used for communication
-    with the controller.  *host* and *port* are connection details.
+    with the controller.  *host* and *port* are connection details. The soft limits are not checked
+    if the controller does not reply to their query within :attr:`limits_timeout`.
     """
 
+    limits_timeout = 2 * q.s
+
     async def __ainit__(self, controller, index, host, port):
         self._controller = controller
         self._index = index
         self._connection = SocketConnection(host, port)
+        self._limits_key = (host, port, controller)
+
+    async def get_limits(self, refresh=False):
+        """Return the :class:`LimitTable` of the controller or None if the controller does not
+        provide its limits. It is queried only once and shared by all motors of the same
+        controller, unless *refresh* is True.
+        """
+        key = self._limits_key
+        if not refresh and key in _LIMITS:
+            return _LIMITS[key]
+        future = _QUERIES.get(key)
+        # A query of another event loop (e.g. of a previous asyncio.run) cannot be awaited
+        if refresh or future is None or future.get_loop() is not asyncio.get_running_loop():
+            future = asyncio.ensure_future(self._query_limits())
+            _QUERIES[key] = future
+
+            def forget(done):
+                if _QUERIES.get(key) is done:
+                    del _QUERIES[key]
+
+            future.add_done_callback(forget)
+
+        # A cancelled caller must not cancel the query for the others
+        return await asyncio.shield(future)
+
+    def restrict_limits(self, index, lower=None, upper=None):
+        """Narrow the soft limits of controller axis *index* for all motors of the controller, see
+        :meth:`LimitTable.restrict`. The restriction is kept when the limits are queried again.
+        """
+        _RESTRICTIONS.setdefault(self._limits_key, []).append((index, lower, upper))
+        table = _LIMITS.get(self._limits_key)
+        if table is not None:
+            table.restrict(index, lower=lower, upper=upper)
+
+    async def _query_limits(self):
+        try:
+            reply = await asyncio.wait_for(
+                self._connection.execute('{} Limit ?'.format(self._controller)),
+                self.limits_timeout.to(q.s).magnitude)
+        except asyncio.TimeoutError:
+            # Not stored, so that the next check asks again
+            LOG.warning("Soft limits of %s not received within %s, targets are not checked",
+                        self._controller, self.limits_timeout)
+            return None
+        try:
+            split = reply.split('{} Limit '.format(self._controller))[1].split()
+            # Pairs of (lower, upper) for every axis
+            limits = np.array(split, dtype=float).reshape(-1, 2)
+        except (IndexError, ValueError):
+            LOG.warning("Cannot read soft limits of %s from `%s', targets are not checked",
+                        self._controller, reply)
+            _LIMITS[self._limits_key] = None
+            return None
+        table = LimitTable(limits[:, 0], limits[:, 1])
+        for index, lower, upper in _RESTRICTIONS.get(self._limits_key, []):
+            table.restrict(index, lower=lower, upper=upper)
+        _LIMITS[self._limits_key] = table
+
+        return table
+
+    async def check_limits(self, targets, axes=None):
+        """Check *targets* in controller units against the soft limits of the controller, see
+        :meth:`LimitTable.validate`. Nothing is checked if the controller does not provide its
+        limits.
+        """
+        limits = await self.get_limits()
+        if limits is not None:
+            limits.validate(targets, axes=axes)
 
     async def _get_positions_in_steps(self):
         pos = await self._connection.execute('{} Crds ?'.format(self._controller))
@@ -40,6 +176,7 @@ class _Base(object):
         return float(split[self._index])
 
     async def _set_position_in_steps(self, position, wait_for='standby'):
+        await self.check_limits(position, axes=[self._index])
         msg = await self._connection.execute('{} AxisAbs {} {}'.format(self._controller,
                                                                        self._index + 1, position))
         if 'Movement not possible due to soft limits' in msg:
@@ -72,19 +209,27 @@ class _Base(object):
         await self['state'].wait('standby', sleep_time=self._connection.sleep_between)
 
     async def _stop(self):
+        # Stop is sent immediately and confirmed ahead of all queued requests
         await self._connection.send('{} Stop'.format(self._controller))
-        await self['state'].wait('standby', sleep_time=self._connection.sleep_between)
+        while await _Base.get_state(self, priority=URGENT) != 'standby':
+            await asyncio.sleep(self._connection.sleep_between.to(q.s).magnitude)
 
-    async def get_state(self):
-        """Return the motor state."""
+    async def get_state(self, priority=POLL):
+        """Return the motor state, the request is sent with *priority* (see
+        :class:`esrfconcert.networking.micos.SocketConnection`).
+        """
         # TODO: the controller provides information on the state of all motor, i.e. if one motor is
         # moving this function returns True also for all other controller motors.
-        state = await self._connection.execute('{} IsReady'.format(self._controller))
+        state = await self._connection.execute('{} IsReady'.format(self._controller),
+                                               priority=priority)
 
         if state == '{} not ready'.format(self._controller):
             return 'moving'
-        else:
+        elif state == '{} ready'.format(self._controller):
             return 'standby'
+        else:
+            # Do not take e.g. a truncated reply for a stopped motor
+            raise MicosConnectionError('Unexpected state reply: {}'.format(state))
         # TODO: hard limit?
 
 
@@ -158,6 +303,7 @@ class SampleManipulationMotor(ContinuousLinearMotor):
 
     async def _set_position_in_steps(self, position, wait_for=None):
         # TODO: do this properly
+        await self.check_limits(position, axes=[self._index])
         msg = await self._connection.execute('{} AxisAbs {} {}'.format(self._controller,
                                                                        self._index + 1, position))
         if 'Movement not possible due to soft limits' in msg:
@@ -273,6 +419,7 @@ class PseudoMotor(Parameterizable, _Base):
         await Parameterizable.__ainit__(self)
 
     async def _set_position(self, positions):
+        await self.check_limits(positions, axes=range(len(positions)))
         str_positions = ' '.join([str(pos) for pos in positions])
         msg = await self._connection.execute(
             '{} MoveAbs {}'.format(self._controller, str_positions)
@@ -292,6 +439,22 @@ class PseudoMotor(Parameterizable, _Base):
         return await _Base.get_state(self)
 
 
+def get_pusher_offsets(x_offsets, y_offsets):
+    """Convert relative sample movements *x_offsets* and *y_offsets* along the beamline axes to
+    relative movements of the sx45 and sy45 pushers. Both arguments can be arrays, the result is
+    a tuple (sx45 offsets, sy45 offsets) in millimeters.
+    """
+    x_offsets = np.asarray(x_offsets.to(q.mm).magnitude)
+    y_offsets = np.asarray(y_offsets.to(q.mm).magnitude)
+    # x is moved with offset 0, y with offset ALPHA, see SampleMotor._move
+    sx45 = (x_offsets / np.cos(GAMMA.to(q.rad).magnitude)
+            + y_offsets / np.cos((GAMMA - ALPHA).to(q.rad).magnitude))
+    sy45 = (x_offsets / np.cos((GAMMA + BETA).to(q.rad).magnitude)
+            + y_offsets / np.cos((GAMMA + BETA - ALPHA).to(q.rad).magnitude))
+
+    return sx45 * q.mm, sy45 * q.mm
+
+
 class SampleMotor(PseudoMotor):
 
     async def __ainit__(self, controller, host, port, sx45, sy45, px45, py45, lamino_tilt):
@@ -308,26 +471,181 @@ class SampleMotor(PseudoMotor):
     async def move_y(self, rel_pos):
         return await self._move(rel_pos, offset=ALPHA)
 
-    async def _move(self, rel_pos, offset=0 * q.deg):
+    async def move_relative(self, offsets, callback=None):
+        """Move the sample to all (x, y) *offsets* relative to the current position one after
+        another, *offsets* is a quantity array with shape (N, 2). The pusher targets are computed
+        from one position snapshot up front and checked against the soft limits all at once, so
+        an invalid sequence raises :class:`SoftLimitError` before anything moves. If *callback* is
+        given, it is a coroutine function called with the (x, y) offset after every point has been
+        reached, e.g. for grabbing a frame. Return a list of the callback results.
+        """
+        offsets = offsets.to(q.mm)
+        if offsets.ndim != 2 or offsets.shape[1] != 2:
+            raise ValueError('offsets must have shape (N, 2)')
+        await self._check_magnets()
+
+        tilt_pos = (await self.lamino_tilt.get_position()).to(q.deg).magnitude
+        sx45_pos = (await self.sx45.get_position()).to(q.mm).magnitude
+        sy45_pos = (await self.sy45.get_position()).to(q.mm).magnitude
+        sx45_offsets, sy45_offsets = get_pusher_offsets(offsets[:, 0], offsets[:, 1])
+        sx45_targets = sx45_pos + sx45_offsets.magnitude
+        sy45_targets = sy45_pos + sy45_offsets.magnitude
+        targets = np.stack((np.full(len(offsets), tilt_pos), sx45_targets, sy45_targets), axis=1)
+        # Reject the whole sequence before the first point is approached
+        await self.check_limits(targets, axes=range(3))
+        results = []
+
+        for i in range(len(offsets)):
+            await self.set_position(targets[i])
+            if callback:
+                results.append(await callback(offsets[i, 0], offsets[i, 1]))
+
+        return results
+
+    async def move_grid(self, x_offsets, y_offsets, callback=None, snake=True):
+        """Raster the sample over the grid given by *x_offsets* and *y_offsets* relative to the
+        current position. If *snake* is True, every other row is traversed backwards to shorten the
+        travel. *callback* is the same as in :meth:`move_relative`.
+        """
+        x_offsets = x_offsets.to(q.mm).magnitude
+        y_offsets = y_offsets.to(q.mm).magnitude
+        x_grid, y_grid = np.meshgrid(x_offsets, y_offsets)
+        if snake:
+            x_grid[1::2] = x_grid[1::2, ::-1]
+        offsets = np.stack((x_grid.ravel(), y_grid.ravel()), axis=1) * q.mm
+
+        return await self.move_relative(offsets, callback=callback)
+
+    async def _check_magnets(self):
         # check if magnets are out: Sample should be only moved if magnets are in!
         if await self.px45.get_state() != 'in' and await self.py45.get_state() != 'in':
             raise RuntimeError('Magnets are not in')
-        else:
-            # get current positions
-            tilt_pos = await self.lamino_tilt.get_position()
-            sx45_pos = await self.sx45.get_position()
-            sy45_pos = await self.sy45.get_position()
 
-            # calculate target positions, x/y controlled by offset
-            sx45_target = sx45_pos + rel_pos / np.cos(GAMMA - offset)
-            sy45_target = sy45_pos + rel_pos / np.cos(GAMMA + BETA - offset)
+    async def _move(self, rel_pos, offset=0 * q.deg):
+        await self._check_magnets()
+        # get current positions
+        tilt_pos = await self.lamino_tilt.get_position()
+        sx45_pos = await self.sx45.get_position()
+        sy45_pos = await self.sy45.get_position()
+
+        # calculate target positions, x/y controlled by offset
+        sx45_target = sx45_pos + rel_pos / np.cos(GAMMA - offset)
+        sy45_target = sy45_pos + rel_pos / np.cos(GAMMA + BETA - offset)
+
+        await self.set_position([
+            tilt_pos.to(q.deg).magnitude,
+            sx45_target.to(q.mm).magnitude,
+            sy45_target.to(q.mm).magnitude
+        ])
+
+
+class SampleManipulator(object):
+
+    """Sample exchange on LAMINO-I. *sx45* and *sy45* are the pushers, *px45* and *py45* the
+    magnets (all :class:`SampleManipulationMotor`), *lamino_rot* is the
+    :class:`LaminoScanningMotor` which must be at *exchange_angle* +/- *angle_tolerance* for
+    pushing the sample in and *air_connection* is a :class:`SocketConnection` to the air valve
+    controller. The interlocks are encoded as dependencies of :class:`esrfconcert.sequencer.Step`
+    objects, see :class:`esrfconcert.sequencer.Sequence`.
+
+    By default, one controller moves only one axis at a time. All four axes are on the 'Sam'
+    controller, so the pushers and magnets move one after another like before and only the air
+    valve and the state queries overlap with the motions, the exchange is not faster. If
+    *concurrent_axes* is True, mechanically independent axes of one controller move at the same
+    time. Only enable it once the controller is known to accept a command while another axis is
+    moving.
+    """
+
+    def __init__(self, sx45, sy45, px45, py45, lamino_rot, air_connection,
+                 exchange_angle=-90 * q.deg, angle_tolerance=0.1 * q.deg, concurrent_axes=False):
+        self.sx45 = sx45
+        self.sy45 = sy45
+        self.px45 = px45
+        self.py45 = py45
+        self.lamino_rot = lamino_rot
+        self.air_connection = air_connection
+        self.exchange_angle = exchange_angle
+        self.angle_tolerance = angle_tolerance
+        self.concurrent_axes = concurrent_axes
+
+        # Concurrent commands to one controller are not verified, by default a controller is a
+        # resource used by one step at a time
+        sx45_ctrl, sy45_ctrl = self._get_resource(sx45), self._get_resource(sy45)
+        px45_ctrl, py45_ctrl = self._get_resource(px45), self._get_resource(py45)
+        self.pushers_out = Sequence([
+            Step('px45 out', lambda: self._move_out(self.px45), resource=px45_ctrl),
+            Step('py45 out', lambda: self._move_out(self.py45), resource=py45_ctrl),
+            Step('air off', self.air_off, after=['px45 out', 'py45 out']),
+            Step('sx45 stash', self.sx45['position'].stash),
+            Step('sy45 stash', self.sy45['position'].stash),
+            Step('sx45 out', self.sx45.move_out, after=['air off', 'sx45 stash'],
+                 interlocks=[self._check_magnets_out], resource=sx45_ctrl),
+            Step('sy45 out', self.sy45.move_out, after=['air off', 'sy45 stash'],
+                 interlocks=[self._check_magnets_out], resource=sy45_ctrl),
+        ])
+        self.pushers_in = Sequence([
+            Step('sx45 restore', self.sx45['position'].restore, resource=sx45_ctrl),
+            Step('sy45 restore', self.sy45['position'].restore, resource=sy45_ctrl),
+            Step('px45 in', self.px45.move_in, after=['sx45 restore', 'sy45 restore'],
+                 resource=px45_ctrl),
+            Step('py45 in', self.py45.move_in, after=['sx45 restore', 'sy45 restore'],
+                 resource=py45_ctrl),
+            Step('air on', self.air_on, after=['px45 in', 'py45 in']),
+        ], interlocks=[self._check_exchange_angle, self._check_magnets_out])
+        self.magnets_out = Sequence([
+            Step('px45 out', self.px45.move_out, resource=px45_ctrl),
+            Step('py45 out', self.py45.move_out, resource=py45_ctrl),
+        ])
+
+    def _get_resource(self, motor):
+        if self.concurrent_axes:
+            return (motor._controller, motor._index)
+
+        return motor._controller
+
+    async def _move_out(self, motor):
+        if await motor.get_state() != 'out':
+            await motor.move_out()
+
+    async def _check_magnets_out(self):
+        states = await asyncio.gather(self.px45.get_state(), self.py45.get_state())
+        if states != ['out', 'out']:
+            raise MagnetsInException('Magnets are still in')
+
+    async def _check_exchange_angle(self):
+        position = await self.lamino_rot.get_position()
+        if abs(position - self.exchange_angle) > self.angle_tolerance:
+            raise InterlockError('lamino_rot at {} instead of {}'.format(position,
+                                                                     self.exchange_angle))
+
+    async def air_on(self):
+        await self.air_connection.send('Dmc2143 sendcommand SB 1')
+
+    async def air_off(self):
+        await self.air_connection.send('Dmc2143 sendcommand CB 1')
+
+    async def move_pushers_out(self):
+        """Move magnets and then pushers out, the pusher positions are stashed."""
+        await self.pushers_out.run()
+
+    async def move_pushers_in(self):
+        """Restore the pusher positions and move the magnets in."""
+        await self.pushers_in.run()
+
+    async def move_magnets_out(self):
+        await self.magnets_out.run()
+
+
+class SoftLimitError(StateError):
+
+    """Raised when a target is beyond the soft limits."""
 
-            await self.set_position([
-                tilt_pos.to(q.deg).magnitude,
-                sx45_target.to(q.mm).magnitude,
-                sy45_target.to(q.mm).magnitude
-            ])
+    pass
 
 
 class LaminoRotException(Exception):
     pass
+
+
+class MagnetsInException(InterlockError):
+    pass
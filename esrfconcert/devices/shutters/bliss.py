@@ -1,20 +1,91 @@
 """Bliss shutter."""
+import asyncio
+import collections
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from concert.base import Quantity
 from concert.devices.shutters import base
+from concert.quantities import q
+
+
+LOG = logging.getLogger(__name__)
 
 
 class Shutter(base.Shutter):
 
-    """A Bliss shutter implementation."""
+    """A Bliss shutter implementation. Calls to the Bliss *device* run in a thread, so they do not
+    block the event loop, and opening and closing return only after the device reports the new
+    state, or raise :class:`ShutterError` after *timeout*.
 
-    async def __ainit__(self, device):
-        await super().__ainit__()
+    The actuation latency (time from the command until the state is confirmed) of the last
+    *history_length* motions is recorded separately for opening and closing. The first state check
+    happens after the shortest latency seen so far, then the state is polled every
+    *poll_interval*. The expected latency is the *percentile* of the history, available as
+    *open_latency* and *close_latency*, so that experiments can, e.g., start opening the shutter
+    exactly that long before the exposure.
+    """
+
+    open_latency = Quantity(q.s, help='Expected time to open')
+    close_latency = Quantity(q.s, help='Expected time to close')
+
+    async def __ainit__(self, device, timeout=10 * q.s, poll_interval=10 * q.ms, history_length=20,
+                        percentile=95):
         self._device = device
+        self._timeout = timeout
+        self._poll_interval = poll_interval
+        self._percentile = percentile
+        self._latencies = {'open': collections.deque(maxlen=history_length),
+                           'closed': collections.deque(maxlen=history_length)}
+        # One thread serializes all calls to the device
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        await super().__ainit__()
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _actuate(self, func, target):
+        start = time.perf_counter()
+        await self._call(func)
+        history = self._latencies[target]
+        if history:
+            # No need to ask the device before the fastest motion could have finished
+            await asyncio.sleep(max(0, min(history) - (time.perf_counter() - start)))
+        while await self._get_state() != target:
+            if (time.perf_counter() - start) * q.s > self._timeout:
+                raise ShutterError('{} not {} after {}'.format(self._device.name, target,
+                                                               self._timeout))
+            await asyncio.sleep(self._poll_interval.to(q.s).magnitude)
+        history.append(time.perf_counter() - start)
+        LOG.debug('%s %s in %.3f s', self._device.name, target, history[-1])
+
+    def get_latency(self, state):
+        """Get the expected latency of moving to *state* ('open' or 'closed'), None if unknown."""
+        history = self._latencies[state]
+        if not history:
+            return None
+
+        return np.percentile(history, self._percentile) * q.s
+
+    async def _get_open_latency(self):
+        return self.get_latency('open')
+
+    async def _get_close_latency(self):
+        return self.get_latency('closed')
 
     async def _open(self):
-        self._device.open()
+        await self._actuate(self._device.open, 'open')
 
     async def _close(self):
-        self._device.close()
+        await self._actuate(self._device.close, 'closed')
 
     async def _get_state(self):
-        return self._device.state.name.lower()
+        return (await self._call(getattr, self._device, 'state')).name.lower()
+
+
+class ShutterError(Exception):
+
+    """Raised when a shutter does not reach the desired state."""
+
+    pass
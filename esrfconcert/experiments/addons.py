@@ -0,0 +1,884 @@
+"""Add-ons for experiments."""
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+import numpy as np
+from multiprocessing.shared_memory import SharedMemory
+from concert.experiments.addons import Addon
+from concert.quantities import q
+from concert.storage import DirectoryWalker
+from esrfconcert.imageprocessing import downsample, get_shift, RunningStatistics
+from esrfconcert.reconstruction import set_scan_direction
+from esrfconcert.sharedmemory import SharedRingBuffer
+
+
+LOG = logging.getLogger(__name__)
+
+
+class _TelemetryRecord(object):
+
+    """Telemetry of one acquisition run."""
+
+    def __init__(self, name, consumer_names, motor_names):
+        self.name = name
+        self.num_grabbed = 0
+        self.frame_times = []
+        self.grab_latencies = []
+        self.buffer_fill = []
+        self.processing_times = {name: [] for name in consumer_names}
+        self.queue_depths = {name: [] for name in consumer_names}
+        self.motor_times = []
+        self.motor_positions = {name: [] for name in motor_names}
+        # Producer and all consumers must finish before the record is complete
+        self.pending = len(consumer_names) + 1
+
+    def to_arrays(self):
+        """Return a dictionary of numpy arrays suitable for :func:`numpy.savez`."""
+        frame_times = np.array(self.frame_times)
+        arrays = {
+            'frame_times': frame_times - frame_times[0] if len(frame_times) else frame_times,
+            'grab_latencies': np.array(self.grab_latencies, dtype=np.float32),
+            'frame_intervals': np.diff(frame_times).astype(np.float32),
+            'buffer_fill': np.array(self.buffer_fill, dtype=np.float32),
+            'motor_times': (np.array(self.motor_times) - self.frame_times[0]
+                            if self.frame_times else np.array(self.motor_times)),
+        }
+        for name in self.processing_times:
+            arrays['processing_times/' + name] = np.array(self.processing_times[name],
+                                                          dtype=np.float32)
+            arrays['queue_depths/' + name] = np.array(self.queue_depths[name], dtype=np.int32)
+        for name in self.motor_positions:
+            arrays['motor_positions/' + name] = np.array(self.motor_positions[name])
+
+        return arrays
+
+    def summarize(self):
+        """Return a human readable summary."""
+        arrays = self.to_arrays()
+        lines = ['Telemetry of {}: {} frames'.format(self.name, self.num_grabbed)]
+        if self.num_grabbed > 1:
+            intervals = arrays['frame_intervals']
+            lines.append('  frame rate: {:.2f} fps, interval mean/max: {:.2f}/{:.2f} ms'.format(
+                1 / np.mean(intervals), 1e3 * np.mean(intervals), 1e3 * np.max(intervals)))
+        if self.num_grabbed:
+            latencies = arrays['grab_latencies']
+            lines.append('  grab latency mean/max: {:.2f}/{:.2f} ms'.format(
+                1e3 * np.mean(latencies), 1e3 * np.max(latencies)))
+        if self.buffer_fill:
+            lines.append('  camera buffer fill max: {:g}'.format(np.max(arrays['buffer_fill'])))
+
+        slowest = None
+        for name in self.processing_times:
+            times = arrays['processing_times/' + name]
+            depths = arrays['queue_depths/' + name]
+            if not len(times):
+                continue
+            lines.append('  {}: processing mean/max: {:.2f}/{:.2f} ms, queue depth max: {}'.format(
+                name, 1e3 * np.mean(times), 1e3 * np.max(times), np.max(depths)))
+            if slowest is None or np.mean(times) > slowest[1]:
+                slowest = (name, np.mean(times))
+        if slowest and self.num_grabbed:
+            # A consumer slower than the camera either queues frames or stalls the producer
+            limit = slowest[0] if slowest[1] > np.mean(arrays['grab_latencies']) else 'camera'
+            lines.append('  throughput limited by: {}'.format(limit))
+
+        return '\n'.join(lines)
+
+
+class _InstrumentedConsumer(object):
+
+    """Consumer of :class:`Telemetry` instrumenting *consumer* by calling *wrapped* instead. It
+    compares equal to *consumer*, so that the add-on which added *consumer* can still remove it
+    from the acquisition.
+    """
+
+    def __init__(self, telemetry, consumer, wrapped):
+        self.telemetry = telemetry
+        self.consumer = consumer
+        self._wrapped = wrapped
+
+    def __call__(self, producer):
+        return self._wrapped(producer)
+
+    def __eq__(self, other):
+        return other is self or other is self.consumer
+
+    def __hash__(self):
+        return hash(self.consumer)
+
+
+class Telemetry(Addon):
+
+    """Acquisition telemetry of *experiment*. For every acquisition it records the frame times,
+    grab latencies, the processing time and queue depth (number of frames grabbed but not yet taken)
+    of every consumer and the positions of *motors* (a dictionary mapping names to motors) sampled
+    every *sample_interval*. If *buffer_fill* is given, it is a coroutine function without arguments
+    returning the camera buffer fill level, which is recorded with every frame.
+
+    When an acquisition is done, the data is stored as numpy arrays in `telemetry-<acquisition
+    name>.npz` in the current directory of *walker* (defaults to the experiment walker, nothing is
+    stored for other than :class:`concert.storage.DirectoryWalker`) and a summary is logged. Records
+    and summaries of the last run are stored in :attr:`records` and :attr:`reports`.
+
+    Consumers are instrumented when the add-on is attached, so it must be created after all other
+    add-ons.
+    """
+
+    def __init__(self, experiment, motors=None, buffer_fill=None, sample_interval=0.1 * q.s,
+                 walker=None):
+        self.experiment = experiment
+        self.motors = {} if motors is None else motors
+        self.buffer_fill = buffer_fill
+        self.sample_interval = sample_interval
+        self.walker = experiment.walker if walker is None else walker
+        self.records = {}
+        self.reports = {}
+        self._originals = {}
+        self._running = {}
+        super(Telemetry, self).__init__(experiment.acquisitions)
+
+    def _attach(self):
+        for acq in self.acquisitions:
+            names = [self._get_consumer_name(consumer, i)
+                     for i, consumer in enumerate(acq.consumers)]
+            wrapped = self._wrap_producer(acq, acq.producer)
+            self._originals[acq] = (acq.producer, wrapped, names)
+            acq.producer = wrapped
+            acq.consumers[:] = [_InstrumentedConsumer(self, consumer,
+                                                      self._wrap_consumer(acq, consumer, name))
+                                for consumer, name in zip(acq.consumers, names)]
+
+    def _detach(self):
+        for acq, (producer, wrapped, names) in self._originals.items():
+            if acq.producer is wrapped:
+                # Unless another add-on attached before us has restored its original already
+                acq.producer = producer
+            # Add-ons may have added or removed consumers in the meantime
+            acq.consumers[:] = [consumer.consumer if self._is_own(consumer) else consumer
+                                for consumer in acq.consumers]
+        self._originals = {}
+
+    def _is_own(self, consumer):
+        return isinstance(consumer, _InstrumentedConsumer) and consumer.telemetry is self
+
+    def _get_consumer_name(self, consumer, index):
+        name = getattr(consumer, '__qualname__', type(consumer).__name__)
+
+        return '{}-{}'.format(index, name)
+
+    def _get_record(self, acq):
+        """Get the record of the current run of *acq*, the producer and the consumers start in
+        arbitrary order, the first one creates it.
+        """
+        if acq.name not in self._running:
+            record = _TelemetryRecord(acq.name, self._originals[acq][2], self.motors.keys())
+            # Only the instrumented consumers which are still attached report back
+            record.pending = sum(self._is_own(consumer) for consumer in acq.consumers) + 1
+            self._running[acq.name] = record
+            self.records[acq.name] = record
+
+        return self._running[acq.name]
+
+    def _wrap_producer(self, acq, producer):
+        async def sample_motors(record):
+            while True:
+                record.motor_times.append(time.perf_counter())
+                for name, motor in self.motors.items():
+                    position = await motor.get_position()
+                    record.motor_positions[name].append(position.magnitude)
+                await asyncio.sleep(self.sample_interval.to(q.s).magnitude)
+
+        async def instrumented():
+            record = self._get_record(acq)
+            sampler = asyncio.ensure_future(sample_motors(record)) if self.motors else None
+            try:
+                start = time.perf_counter()
+                async for item in producer():
+                    now = time.perf_counter()
+                    record.grab_latencies.append(now - start)
+                    record.frame_times.append(now)
+                    record.num_grabbed += 1
+                    if self.buffer_fill:
+                        record.buffer_fill.append(await self.buffer_fill())
+                    yield item
+                    start = time.perf_counter()
+            finally:
+                if sampler:
+                    sampler.cancel()
+                self._finish(record)
+
+        return instrumented
+
+    def _wrap_consumer(self, acq, consumer, name):
+        async def instrumented_producer(producer, record):
+            index = 0
+            async for item in producer:
+                index += 1
+                record.queue_depths[name].append(record.num_grabbed - index)
+                start = time.perf_counter()
+                yield item
+                record.processing_times[name].append(time.perf_counter() - start)
+
+        async def wrapped(producer):
+            record = self._get_record(acq)
+            try:
+                await consumer(instrumented_producer(producer, record))
+            finally:
+                self._finish(record)
+
+        return wrapped
+
+    def _finish(self, record):
+        record.pending -= 1
+        if record.pending:
+            return
+        del self._running[record.name]
+        self.reports[record.name] = record.summarize()
+        LOG.info(self.reports[record.name])
+        if isinstance(self.walker, DirectoryWalker):
+            path = os.path.join(self.walker.current, 'telemetry-{}.npz'.format(record.name))
+            np.savez(path, **record.to_arrays())
+            LOG.debug('Telemetry of %s written to %s', record.name, path)
+
+
+class ScanDirection(Addon):
+
+    """Keep the reconstruction arguments *args* of an online reconstruction (e.g.
+    :class:`concert.experiments.addons.OnlineReconstruction`) in line with the direction of every
+    scan of a bidirectional :class:`esrfconcert.experiments.laminography.ContinuousLaminography`
+    *experiment*, so that reversed scans are reconstructed without manual intervention. The
+    arguments are adapted by :func:`esrfconcert.reconstruction.set_scan_direction` before the first
+    projection of a scan is produced.
+    """
+
+    def __init__(self, experiment, args):
+        self.experiment = experiment
+        self.args = args
+        self._originals = {}
+        super(ScanDirection, self).__init__(experiment.acquisitions)
+
+    def _attach(self):
+        for acq in self.acquisitions:
+            if acq.name == 'radios' and acq not in self._originals:
+                wrapped = self._wrap_producer(acq.producer)
+                self._originals[acq] = (acq.producer, wrapped)
+                acq.producer = wrapped
+
+    def _detach(self):
+        for acq, (producer, wrapped) in self._originals.items():
+            if acq.producer is wrapped:
+                acq.producer = producer
+        self._originals = {}
+
+    def _wrap_producer(self, producer):
+        async def directed():
+            direction = await self.experiment.get_direction()
+            set_scan_direction(self.args, direction)
+            LOG.debug('Reconstruction arguments set for scan direction %d', direction)
+            async for item in producer():
+                yield item
+
+        return directed
+
+
+class _StoppingAddon(Addon):
+
+    """Base of add-ons whose consumers stop acquisitions. An exception raised by a consumer leaves
+    the producer suspended, so that its cleanup (e.g. closing the shutter and stopping the motor)
+    is not run. Instead, a consumer passes its acquisition and the exception to :meth:`_stop` and
+    keeps consuming. The producer of that acquisition, wrapped by :meth:`_wrap_producer`, is then
+    closed after the current item has been consumed and the exception is raised by the acquisition.
+    """
+
+    def __init__(self, acquisitions):
+        self._producers = {}
+        # Pending errors by acquisition
+        self._errors = {}
+        super(_StoppingAddon, self).__init__(acquisitions)
+
+    def _wrap_producer(self, acq):
+        if acq not in self._producers:
+            wrapped = self._make_stoppable(acq, acq.producer)
+            self._producers[acq] = (acq.producer, wrapped)
+            acq.producer = wrapped
+
+    def _unwrap_producers(self):
+        for acq, (producer, wrapped) in self._producers.items():
+            if acq.producer is wrapped:
+                acq.producer = producer
+        self._producers = {}
+
+    def _stop(self, acq, error):
+        """Stop the running acquisition *acq* with *error*."""
+        self._errors.setdefault(acq, error)
+
+    def _make_stoppable(self, acq, producer):
+        async def stoppable():
+            # Errors of previous runs do not stop this one
+            self._errors.pop(acq, None)
+            items = producer()
+            try:
+                async for item in items:
+                    yield item
+                    if acq in self._errors:
+                        raise self._errors.pop(acq)
+            finally:
+                # Run the producer cleanup now and not when it is garbage collected
+                await items.aclose()
+
+        return stoppable
+
+
+# Messages in the shared ring buffer of ProcessReconstruction
+_FRAME, _START, _END, _STOP, _DIRECTION = range(5)
+_STREAMS = ['darks', 'flats', 'radios']
+
+
+def _get_stream(acquisition_name):
+    """Return the stream ('darks', 'flats' or 'radios') of *acquisition_name* or None."""
+    for stream in _STREAMS:
+        if acquisition_name.startswith(stream):
+            return stream
+
+
+def _reconstruct(ring, args, average_normalization, connection, num_received):
+    """Reconstruction worker process main function."""
+    try:
+        asyncio.run(_serve_reconstruction(ring, args, average_normalization, connection,
+                                          num_received))
+    finally:
+        ring.close()
+
+
+async def _serve_reconstruction(ring, args, average_normalization, connection, num_received):
+    try:
+        await _serve_reconstruction_requests(ring, args, average_normalization, connection,
+                                             num_received)
+    except Exception:
+        # Report before the interrupted stream is skipped on shutdown
+        import traceback
+        connection.send(('error', traceback.format_exc()))
+
+
+async def _serve_reconstruction_requests(ring, args, average_normalization, connection,
+                                         num_received):
+    from concert.ext.ufo import GeneralBackprojectManager
+
+    manager = await GeneralBackprojectManager(args, average_normalization=average_normalization)
+    loop = asyncio.get_running_loop()
+
+    async def read():
+        return await loop.run_in_executor(None, ring.read)
+
+    async def produce(stream):
+        # Images are views of the ring slots, a slot is released when the next image is requested
+        kind = None
+        try:
+            while True:
+                kind, index, image = await read()
+                if kind == _END:
+                    break
+                if stream == 'radios':
+                    num_received.value += 1
+                yield image
+                ring.release()
+                kind = None
+        finally:
+            if kind is not None:
+                ring.release()
+            if kind == _FRAME:
+                # Consumer quit early, skip the rest of the stream
+                while kind != _END:
+                    kind = (await read())[0]
+                    ring.release()
+
+    while True:
+        kind, index, image = await read()
+        ring.release()
+        if kind == _STOP:
+            break
+        if kind == _DIRECTION:
+            set_scan_direction(manager.args, index)
+            continue
+        stream = _STREAMS[index]
+        if stream == 'radios':
+            num_received.value = 0
+            await manager.backproject(produce(stream))
+            volume = np.asarray(manager.volume)
+            shm = SharedMemory(create=True, size=volume.nbytes)
+            np.copyto(np.ndarray(volume.shape, dtype=volume.dtype, buffer=shm.buf), volume)
+            connection.send(('volume', shm.name, volume.shape, volume.dtype.str))
+            shm.close()
+        elif stream == 'darks':
+            await manager.update_darks(produce(stream))
+        else:
+            await manager.update_flats(produce(stream))
+
+
+class ProcessReconstruction(_StoppingAddon):
+
+    """Online reconstruction of *experiment* with reconstruction arguments *args* (a
+    :class:`concert.ext.ufo.GeneralBackprojectArgs` instance) in a separate process, so that
+    backprojection does not compete with the acquisition for the event loop and the GIL.
+    *average_normalization* is passed to the :class:`concert.ext.ufo.GeneralBackprojectManager`.
+
+    Images of acquisitions whose names start with 'darks', 'flats' and 'radios' are copied once
+    into a :class:`esrfconcert.sharedmemory.SharedRingBuffer` of *num_slots* slots, which is
+    created together with the worker process when the first image arrives (its size determines the
+    slot size). If a stream starts with an image which does not fit into a slot (e.g. after the
+    region of interest has been enlarged), the worker is restarted with larger slots, the darks and
+    flats it has do not match such images anyway. The reconstruction reads the images directly from
+    shared memory. When the ring is full,
+    the behavior is given by *policies*, a dictionary mapping stream names to either 'block' (wait
+    for a free slot, i.e. apply backpressure to the acquisition), 'drop' (drop the image) or a
+    quantity specifying how long to wait before dropping. By default, only darks and flats are
+    dropped, a reconstruction from radios with missing projections is wrong. Dropped images are
+    counted in :attr:`dropped`. Projections tagged with 'scan_direction' in their metadata (see
+    :class:`esrfconcert.experiments.laminography.ContinuousLaminography`) adapt the reconstruction
+    arguments to the scan direction. If the worker process fails, the acquisition is stopped and
+    raises :class:`ProcessReconstructionError`.
+
+    The volume of the last scan is available by :meth:`get_volume`, :meth:`shutdown` stops the
+    worker process.
+    """
+
+    def __init__(self, experiment, args, num_slots=64, average_normalization=True, policies=None,
+                 poll_interval=1 * q.ms):
+        self.args = args
+        self.num_slots = num_slots
+        self.average_normalization = average_normalization
+        self.policies = {'darks': 'drop', 'flats': 'drop', 'radios': 'block'}
+        if policies:
+            self.policies.update(policies)
+        self.poll_interval = poll_interval
+        self.dropped = {stream: 0 for stream in _STREAMS}
+        self.volume = None
+        self._ring = None
+        self._process = None
+        self._connection = None
+        self._num_received = None
+        self._consumers = {}
+        super(ProcessReconstruction, self).__init__(experiment.acquisitions)
+
+    @property
+    def num_received_projections(self):
+        return self._num_received.value if self._num_received else 0
+
+    def _attach(self):
+        for acq in self.acquisitions:
+            stream = _get_stream(acq.name)
+            if stream and acq not in self._consumers:
+                self._consumers[acq] = self._make_consumer(acq, stream)
+                acq.consumers.append(self._consumers[acq])
+                self._wrap_producer(acq)
+
+    def _detach(self):
+        for acq, consumer in self._consumers.items():
+            acq.consumers.remove(consumer)
+        self._consumers = {}
+        self._unwrap_producers()
+
+    def _start(self, image):
+        context = multiprocessing.get_context('spawn')
+        self._ring = SharedRingBuffer(self.num_slots, np.asarray(image).nbytes, context=context)
+        self._num_received = context.Value('i', 0)
+        self._connection, child_connection = context.Pipe(duplex=False)
+        self._process = context.Process(
+            target=_reconstruct,
+            args=(self._ring, self.args, self.average_normalization, child_connection,
+                  self._num_received),
+            name='ProcessReconstruction',
+            daemon=True
+        )
+        self._process.start()
+        LOG.debug('Reconstruction process %d started with %d slots of %d bytes',
+                  self._process.pid, self.num_slots, self._ring.slot_size)
+
+    async def _reserve(self, policy):
+        """Reserve a ring slot according to *policy*, return False if the image is to be dropped."""
+        if self._ring.reserve(block=False):
+            return True
+        if policy == 'drop':
+            return False
+        start = time.perf_counter()
+        while not self._ring.reserve(block=False):
+            if not self._process.is_alive():
+                self._check_messages()
+                raise ProcessReconstructionError('Reconstruction process died')
+            if policy != 'block' and (time.perf_counter() - start) * q.s > policy:
+                return False
+            # Polling does not leave a blocked thread behind when the acquisition is cancelled
+            await asyncio.sleep(self.poll_interval.to(q.s).magnitude)
+
+        return True
+
+    def _make_consumer(self, acq, stream):
+        async def feed(producer):
+            started = False
+            try:
+                async for image in producer:
+                    if not self._ring:
+                        self._start(image)
+                    elif not started and np.asarray(image).nbytes > self._ring.slot_size:
+                        LOG.debug('%s of %d bytes do not fit into ring slots, restarting '
+                                  'reconstruction process', stream, np.asarray(image).nbytes)
+                        await self.shutdown()
+                        self._start(image)
+                    else:
+                        # Notice a failed worker with the next image
+                        self._check_messages()
+                    if not started:
+                        direction = getattr(image, 'metadata', {}).get('scan_direction')
+                        if stream == 'radios' and direction is not None:
+                            await self._reserve('block')
+                            self._ring.write(_DIRECTION, direction)
+                        await self._reserve('block')
+                        self._ring.write(_START, _STREAMS.index(stream))
+                        started = True
+                    if await self._reserve(self.policies[stream]):
+                        self._ring.write(_FRAME, image=image)
+                    else:
+                        self.dropped[stream] += 1
+            finally:
+                if started:
+                    await self._reserve('block')
+                    self._ring.write(_END)
+            if self.dropped[stream]:
+                LOG.warning('%d %s dropped by online reconstruction', self.dropped[stream], stream)
+
+        async def consume(producer):
+            try:
+                await feed(producer)
+            except ProcessReconstructionError as error:
+                LOG.error('Online reconstruction failed, stopping %s', stream)
+                self._stop(acq, error)
+                async for image in producer:
+                    pass
+
+        return consume
+
+    def _check_messages(self):
+        while self._connection.poll():
+            try:
+                message = self._connection.recv()
+            except EOFError:
+                # The process has exited and sent everything
+                break
+            if message[0] == 'error':
+                raise ProcessReconstructionError(message[1])
+            name, shape, dtype = message[1:]
+            shm = SharedMemory(name=name)
+            self.volume = np.array(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+            shm.close()
+            shm.unlink()
+
+    async def get_volume(self, timeout=None):
+        """Wait for the reconstruction of the last scan to finish (at most *timeout* if given) and
+        return the volume.
+        """
+        start = time.perf_counter()
+        num_received = self.num_received_projections
+        while self._connection and not self._connection.poll():
+            if not self._process.is_alive():
+                raise ProcessReconstructionError('Reconstruction process died')
+            if timeout is not None and (time.perf_counter() - start) * q.s > timeout:
+                raise ProcessReconstructionError('Reconstruction of {} projections not finished '
+                                                 'in {}'.format(num_received, timeout))
+            await asyncio.sleep(self.poll_interval.to(q.s).magnitude)
+        if self._connection:
+            self._check_messages()
+
+        return self.volume
+
+    async def shutdown(self, timeout=10 * q.s):
+        """Stop the reconstruction process and free the shared memory."""
+        if not self._process:
+            return
+        try:
+            if self._process.is_alive():
+                await self._reserve('block')
+                self._ring.write(_STOP)
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._process.join, timeout.to(q.s).magnitude)
+                if self._process.is_alive():
+                    LOG.warning('Reconstruction process did not stop, terminating it')
+                    self._process.terminate()
+            # Take over a volume which has not been fetched yet, which also frees its memory
+            self._check_messages()
+        finally:
+            self._ring.close()
+            self._ring.unlink()
+            self._ring = self._process = self._connection = None
+
+
+class ReferenceStatistics(_StoppingAddon):
+
+    """Streaming statistics of darks and flats of *experiment* (acquisitions whose names start
+    with 'darks' or 'flats'). Every image updates a :class:`esrfconcert.imageprocessing.
+    RunningStatistics` (*saturation* is passed to it) stored in :attr:`statistics` under the
+    acquisition name, no image stacks are kept.
+
+    Every flat after the first *min_flats* is compared with the running mean: if its mean
+    intensity differs by more than *intensity_tolerance* (relative, e.g. beam loss) or if the
+    relative standard deviation of the ratio of the two images downsampled by *downsampling* is
+    larger than *structure_tolerance* (e.g. moving optics), the flat is excluded from the
+    statistics, its index is appended to :attr:`bad_flats` and *bad_flat_callback* (a coroutine
+    function) is called with the acquisition name, the index and the reason. The callback may
+    raise an exception to abort the experiment, the flats acquisition then stops and raises it.
+
+    When an acquisition is done, mean, variance, saturated fraction and hot pixels (see
+    :meth:`esrfconcert.imageprocessing.RunningStatistics.get_hot_pixels` with *num_sigmas*) are
+    stored in `references-<acquisition name>.npz` in the current directory of *walker* (defaults
+    to the experiment walker, nothing is stored for other than
+    :class:`concert.storage.DirectoryWalker`) and every coroutine function in *callbacks* is
+    called with the acquisition name and the statistics, e.g. to pass the mean to a
+    reconstruction.
+    """
+
+    def __init__(self, experiment, walker=None, saturation=None, callbacks=None,
+                 bad_flat_callback=None, min_flats=3, intensity_tolerance=0.05,
+                 structure_tolerance=0.02, downsampling=8, num_sigmas=5):
+        self.walker = experiment.walker if walker is None else walker
+        self.saturation = saturation
+        self.callbacks = [] if callbacks is None else callbacks
+        self.bad_flat_callback = bad_flat_callback
+        self.min_flats = min_flats
+        self.intensity_tolerance = intensity_tolerance
+        self.structure_tolerance = structure_tolerance
+        self.downsampling = downsampling
+        self.num_sigmas = num_sigmas
+        self.statistics = {}
+        self.bad_flats = {}
+        self._consumers = {}
+        super(ReferenceStatistics, self).__init__(experiment.acquisitions)
+
+    def _attach(self):
+        for acq in self.acquisitions:
+            stream = _get_stream(acq.name)
+            if stream in ['darks', 'flats'] and acq not in self._consumers:
+                self._consumers[acq] = self._make_consumer(acq, stream)
+                acq.consumers.append(self._consumers[acq])
+                if stream == 'flats':
+                    self._wrap_producer(acq)
+
+    def _detach(self):
+        for acq, consumer in self._consumers.items():
+            acq.consumers.remove(consumer)
+        self._consumers = {}
+        self._unwrap_producers()
+
+    def _check_flat(self, image, statistics):
+        """Return the reason why flat *image* is bad or None if it is fine."""
+        mean = statistics.mean
+        reference = float(np.mean(mean))
+        ratio = float(np.mean(image, dtype=np.float32)) / reference
+        if abs(ratio - 1) > self.intensity_tolerance:
+            return 'mean intensity changed by {:.1f} %'.format(100 * (ratio - 1))
+        ratios = (downsample(image, self.downsampling)
+                  / np.maximum(downsample(mean, self.downsampling), 1))
+        deviation = float(np.std(ratios) / np.mean(ratios))
+        if deviation > self.structure_tolerance:
+            return 'intensity distribution changed by {:.1f} %'.format(100 * deviation)
+
+    def _make_consumer(self, acq, stream):
+        name = acq.name
+
+        async def consume(producer):
+            statistics = RunningStatistics(saturation=self.saturation)
+            self.statistics[name] = statistics
+            self.bad_flats[name] = []
+            index = 0
+            async for image in producer:
+                reason = None
+                if stream == 'flats' and statistics.count >= self.min_flats:
+                    reason = self._check_flat(image, statistics)
+                if reason:
+                    self.bad_flats[name].append(index)
+                    LOG.warning('Bad flat %d in %s: %s', index, name, reason)
+                    if self.bad_flat_callback:
+                        try:
+                            await self.bad_flat_callback(name, index, reason)
+                        except Exception as error:
+                            self._stop(acq, error)
+                else:
+                    statistics.update(image)
+                index += 1
+            if statistics.count:
+                await self._publish(name, statistics)
+
+        return consume
+
+    async def _publish(self, name, statistics):
+        LOG.debug('%s: %d images, mean %g', name, statistics.count, np.mean(statistics.mean))
+        if isinstance(self.walker, DirectoryWalker):
+            arrays = {'mean': statistics.mean, 'saturated': statistics.saturated,
+                      'hot_pixels': statistics.get_hot_pixels(num_sigmas=self.num_sigmas)}
+            if statistics.variance is not None:
+                arrays['variance'] = statistics.variance
+            path = os.path.join(self.walker.current, 'references-{}.npz'.format(name))
+            np.savez(path, **arrays)
+        for callback in self.callbacks:
+            await callback(name, statistics)
+
+
+class QualityRule(object):
+
+    """Rule for :class:`QualityMonitor` violated when *metric* ('mean', 'relative_mean',
+    'saturated' or 'shift') is below *lower* or above *upper* (None means no limit) in *num_frames*
+    consecutive checked frames. *action* is 'warn' (log a warning), 'abort' (stop the scan) or
+    'pause' (stop the scan so that it can be resumed, see :class:`QualityMonitor`).
+    """
+
+    def __init__(self, metric, lower=None, upper=None, num_frames=1, action='warn'):
+        if action not in ['warn', 'abort', 'pause']:
+            raise ValueError("action must be one of `warn', `abort' or `pause'")
+        self.metric = metric
+        self.lower = lower
+        self.upper = upper
+        self.num_frames = num_frames
+        self.action = action
+
+    def is_violated(self, value):
+        return ((self.lower is not None and value < self.lower)
+                or (self.upper is not None and value > self.upper))
+
+    def __repr__(self):
+        return 'QualityRule({}, lower={}, upper={}, num_frames={}, action={})'.format(
+            self.metric, self.lower, self.upper, self.num_frames, self.action)
+
+
+class QualityMonitor(_StoppingAddon):
+
+    """Live quality monitor of projections (acquisitions whose names start with 'radios') of
+    *experiment*. Every *every*-th frame is checked, for which the following metrics are computed
+    and stored in :attr:`metrics` (a dictionary mapping acquisition names to dictionaries of
+    arrays of metric values):
+
+    - mean: mean intensity
+    - relative_mean: mean relative to the average of the first *baseline_frames* checked frames
+    - saturated: fraction of pixels at or above *saturation* (the maximum of the image dtype by
+      default)
+    - shift: magnitude of the shift in pixels with respect to the previously checked frame, both
+      downsampled by *downsampling* (which is the resolution) and registered by phase correlation
+
+    *rules* is a list of :class:`QualityRule` objects, by default a warning is issued when more than
+    1 % of pixels are saturated and the scan is paused when the intensity drops below half of the
+    baseline for 10 frames (closed shutter, beam loss). An aborted scan stops after the offending
+    frame, the projections acquisition finishes its cleanup and raises :class:`QualityError`. A
+    paused scan raises it as well, but when the experiment has a
+    checkpoint (see :class:`esrfconcert.experiments.checkpoint.ScanCheckpoint`) and frames carry
+    'projection_index' metadata, the offending projections and all acquired after them are
+    marked as missing, so that `resume()` takes them again once the problem is fixed.
+    """
+
+    def __init__(self, experiment, rules=None, every=1, baseline_frames=10, downsampling=8,
+                 saturation=None):
+        self.experiment = experiment
+        if rules is None:
+            rules = [QualityRule('saturated', upper=0.01),
+                     QualityRule('relative_mean', lower=0.5, num_frames=10, action='pause')]
+        self.rules = rules
+        self.every = every
+        self.baseline_frames = baseline_frames
+        self.downsampling = downsampling
+        self.saturation = saturation
+        self.metrics = {}
+        self._consumers = {}
+        super(QualityMonitor, self).__init__(experiment.acquisitions)
+
+    def _attach(self):
+        for acq in self.acquisitions:
+            if _get_stream(acq.name) == 'radios' and acq not in self._consumers:
+                self._consumers[acq] = self._make_consumer(acq)
+                acq.consumers.append(self._consumers[acq])
+                self._wrap_producer(acq)
+
+    def _detach(self):
+        for acq, consumer in self._consumers.items():
+            acq.consumers.remove(consumer)
+        self._consumers = {}
+        self._unwrap_producers()
+
+    def _measure(self, image, previous):
+        """Return (mean, saturated fraction, shift, downsampled image) of *image*, *previous* is
+        the previous downsampled image or None.
+        """
+        image = np.asarray(image)
+        small = downsample(image, self.downsampling)
+        saturation = self.saturation
+        if saturation is None:
+            saturation = np.iinfo(image.dtype).max if image.dtype.kind in 'ui' else np.inf
+        shift = 0
+        if previous is not None:
+            shift = self.downsampling * float(np.hypot(*get_shift(small, previous)))
+
+        return (float(np.mean(small)), np.count_nonzero(image >= saturation) / image.size, shift,
+                small)
+
+    def _make_consumer(self, acq):
+        name = acq.name
+
+        async def consume(producer):
+            metrics = {metric: [] for metric in ['mean', 'relative_mean', 'saturated', 'shift']}
+            self.metrics[name] = metrics
+            # Per rule: number of consecutive violations and projection index of the first one
+            violations = [(0, None)] * len(self.rules)
+            previous = None
+            baseline = None
+            index = -1
+            try:
+                async for image in producer:
+                    index += 1
+                    if index % self.every:
+                        continue
+                    projection_index = getattr(image, 'metadata', {}).get('projection_index', index)
+                    mean, saturated, shift, previous = self._measure(image, previous)
+                    metrics['mean'].append(mean)
+                    if len(metrics['mean']) <= self.baseline_frames:
+                        baseline = np.mean(metrics['mean'])
+                    metrics['relative_mean'].append(mean / baseline if baseline else np.nan)
+                    metrics['saturated'].append(saturated)
+                    metrics['shift'].append(shift)
+
+                    for i, rule in enumerate(self.rules):
+                        count, first = violations[i]
+                        if not rule.is_violated(metrics[rule.metric][-1]):
+                            violations[i] = (0, None)
+                            continue
+                        violations[i] = (count + 1, projection_index if first is None else first)
+                        if count + 1 == rule.num_frames:
+                            self._act(acq, rule, metrics[rule.metric][-1], violations[i][1])
+            finally:
+                self.metrics[name] = {metric: np.array(values)
+                                      for metric, values in metrics.items()}
+
+        return consume
+
+    def _act(self, acq, rule, value, first):
+        message = '{}: {} = {:g} violates {} since projection {}'.format(acq.name, rule.metric,
+                                                                         value, rule, first)
+        if rule.action == 'warn':
+            LOG.warning(message)
+            return
+        checkpoint = getattr(self.experiment, 'checkpoint', None)
+        if rule.action == 'pause' and checkpoint:
+            checkpoint.discard_since(first)
+            message += ', resume to continue'
+        LOG.error(message)
+        self._stop(acq, QualityError(message))
+
+
+class QualityError(Exception):
+
+    """Raised when a scan is stopped by :class:`QualityMonitor`."""
+
+    pass
+
+
+class ProcessReconstructionError(Exception):
+
+    """Raised when the reconstruction process fails."""
+
+    pass
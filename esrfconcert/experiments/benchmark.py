@@ -0,0 +1,393 @@
+"""Offline acquisition benchmark of laminography experiments with simulated devices.
+
+Usage::
+
+    python -m esrfconcert.experiments.benchmark --frame-rate 100 --width 2560 --height 2160 \\
+        --num-projections 2000 --min-fps 98 --max-dropped 0
+
+Both :class:`.ContinuousLaminography` and :class:`.SteppedLaminography` are run with a simulated
+camera, rotation motors and a shutter and the same kind of consumers as in the lamino session
+(writer, accumulator, live preview and a timestamp check). The benchmark reports the sustained
+frame rate, dropped frames, peak RSS and its increase during every experiment and time per
+acquisition and fails if a threshold is not met.
+"""
+import argparse
+import asyncio
+import logging
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from concert.base import Parameter, Quantity, transition
+from concert.coroutines.sinks import Accumulate
+from concert.devices.cameras.dummy import Base as DummyCameraBase
+from concert.devices.motors import base as motor_base
+from concert.devices.shutters.dummy import Shutter as DummyShutter
+from concert.experiments.addons import Consumer, ImageWriter
+from concert.quantities import q
+from concert.storage import DirectoryWalker, DummyWalker
+from esrfconcert.experiments.addons import Telemetry
+from esrfconcert.experiments.laminography import ContinuousLaminography, SteppedLaminography
+
+
+LOG = logging.getLogger(__name__)
+LIVE_PREVIEW_FPS = 0.25 / q.s
+
+
+class SimulatedCamera(DummyCameraBase):
+
+    """A camera producing *width* x *height* frames with *frame_rate*. In the 'AUTO' trigger mode
+    frames are generated continuously after the recording starts and kept in a ring buffer of
+    *num_buffers* frames, frames which are not grabbed before they are overwritten are counted in
+    :attr:`dropped_frames`. In other trigger modes a frame is available 1 / *frame_rate* after a
+    trigger.
+    """
+
+    sensor_bitdepth = Parameter()
+    num_buffers = Parameter()
+    buffered = Parameter()
+
+    async def __ainit__(self, frame_rate=100 / q.s, width=2560, height=2160, num_buffers=1000):
+        await super(SimulatedCamera, self).__ainit__()
+        self._frame_rate = frame_rate
+        self._roi_width = width * q.pixel
+        self._roi_height = height * q.pixel
+        self._num_buffers = num_buffers
+        self._buffered = False
+        self._frame = np.random.randint(0, 2 ** 12, size=(height, width)).astype(np.uint16)
+        self._start = None
+        self._trigger_time = None
+        self._index = 0
+        self.dropped_frames = 0
+
+    async def _get_sensor_bitdepth(self):
+        return 16
+
+    async def _get_num_buffers(self):
+        return self._num_buffers
+
+    async def _set_num_buffers(self, num_buffers):
+        self._num_buffers = num_buffers
+
+    async def _get_buffered(self):
+        return self._buffered
+
+    async def _set_buffered(self, buffered):
+        self._buffered = buffered
+
+    @transition(target='recording')
+    async def _record_real(self):
+        self._start = time.perf_counter()
+        self._index = 0
+
+    async def _trigger_real(self):
+        self._trigger_time = time.perf_counter()
+
+    async def _grab_real(self):
+        period = 1 / self._frame_rate.to(1 / q.s).magnitude
+        if str(self._trigger_source).upper().endswith('AUTO'):
+            now = time.perf_counter()
+            # Frames which have been overwritten in the ring buffer are lost
+            backlog = int((now - self._start) / period) - self._index
+            if backlog > self._num_buffers:
+                self.dropped_frames += backlog - self._num_buffers
+                self._index += backlog - self._num_buffers
+            ready = self._start + (self._index + 1) * period
+            self._index += 1
+        else:
+            ready = (self._trigger_time or time.perf_counter()) + period
+            self._trigger_time = None
+        if ready > time.perf_counter():
+            await asyncio.sleep(ready - time.perf_counter())
+
+        return self._frame.copy()
+
+
+class SimulatedRotationMotor(motor_base.ContinuousRotationMotor):
+
+    """A rotation motor which, like the Micos motors, moves with the set velocity when its position
+    is set.
+    """
+
+    acceleration = Quantity(q.deg / q.s ** 2)
+
+    async def __ainit__(self, velocity=25 * q.deg / q.s, acceleration=100 * q.deg / q.s ** 2):
+        await super(SimulatedRotationMotor, self).__ainit__()
+        self._position = 0 * q.deg
+        self._velocity = velocity
+        self._acceleration = acceleration
+        self._stopped = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._motion = None
+
+    async def _get_position(self):
+        if self._motion:
+            start_time, start, target = self._motion
+            travelled = self._velocity * (time.perf_counter() - start_time) * q.s
+            if travelled < abs(target - start):
+                return start + np.sign((target - start).magnitude) * travelled
+
+            return target
+
+        return self._position
+
+    async def _set_position(self, position):
+        self._stopped.clear()
+        self._idle.clear()
+        duration = abs((position - self._position) / self._velocity).to(q.s).magnitude
+        self._motion = (time.perf_counter(), self._position, position)
+        try:
+            await asyncio.wait_for(self._stopped.wait(), duration)
+            self._position = await self._get_position()
+        except asyncio.TimeoutError:
+            self._position = position
+        finally:
+            self._motion = None
+            self._idle.set()
+
+    async def _home(self):
+        await self._set_position(0 * q.deg)
+
+    async def _stop(self):
+        self._stopped.set()
+        await self._idle.wait()
+
+    async def _get_velocity(self):
+        return self._velocity
+
+    async def _set_velocity(self, velocity):
+        self._velocity = velocity
+
+    async def _get_acceleration(self):
+        return self._acceleration
+
+    async def _set_acceleration(self, acceleration):
+        self._acceleration = acceleration
+
+    async def _get_state(self):
+        return 'moving' if self._motion else 'standby'
+
+
+class BenchmarkResult(object):
+
+    """Benchmark result of experiment *name*. *fps* is the sustained frame rate of the radios,
+    *dropped_frames* the number of frames lost by the camera, *peak_rss* the peak resident set size
+    of the process sampled during the experiment, *rss_increase* its increase over the resident
+    set size at the start of the experiment and *phases* maps acquisition names to their duration.
+    """
+
+    def __init__(self, name, fps, dropped_frames, peak_rss, rss_increase, phases):
+        self.name = name
+        self.fps = fps
+        self.dropped_frames = dropped_frames
+        self.peak_rss = peak_rss
+        self.rss_increase = rss_increase
+        self.phases = phases
+
+    def check(self, min_fps=None, max_dropped=None, max_rss=None):
+        """Return a list of violated thresholds."""
+        failures = []
+        if min_fps is not None and self.fps < min_fps:
+            failures.append('{}: {:.2f} fps < {}'.format(self.name, self.fps, min_fps))
+        if max_dropped is not None and self.dropped_frames > max_dropped:
+            failures.append('{}: {} dropped frames > {}'.format(self.name, self.dropped_frames,
+                                                                max_dropped))
+        if max_rss is not None and self.peak_rss > max_rss:
+            failures.append('{}: peak RSS {} > {}'.format(self.name, self.peak_rss.to(q.MiB),
+                                                          max_rss.to(q.MiB)))
+
+        return failures
+
+    def __str__(self):
+        lines = ['{}: {:.2f} fps, {} dropped frames, peak RSS {:.0f} (+{:.0f})'.format(
+            self.name, self.fps, self.dropped_frames, self.peak_rss.to(q.MiB),
+            self.rss_increase.to(q.MiB))]
+        for name, duration in self.phases.items():
+            lines.append('  {:<10} {:8.3f} s'.format(name, duration))
+
+        return '\n'.join(lines)
+
+
+def _get_rss():
+    """Current resident set size of the process, the peak value where it is not available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() * q.B
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * q.KiB
+
+
+class _RssMonitor(object):
+
+    """Sample the resident set size every *interval* while the async with block runs. The peak
+    value is in :attr:`peak` and its increase over the value at the start in :attr:`increase`.
+    """
+
+    def __init__(self, interval=10 * q.ms):
+        self.interval = interval
+        self.start = self.peak = 0 * q.B
+        self._task = None
+
+    @property
+    def increase(self):
+        return self.peak - self.start
+
+    def _sample(self):
+        self.peak = max(self.peak, _get_rss())
+
+    async def _run(self):
+        while True:
+            self._sample()
+            await asyncio.sleep(self.interval.to(q.s).magnitude)
+
+    async def __aenter__(self):
+        self.start = self.peak = _get_rss()
+        self._task = asyncio.ensure_future(self._run())
+
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._sample()
+
+
+def _get_frame_rate(frame_times):
+    """Mean frame rate given the grab *frame_times* in seconds, 0 for less than two frames."""
+    if len(frame_times) < 2 or frame_times[-1] == frame_times[0]:
+        return 0
+
+    return (len(frame_times) - 1) / (frame_times[-1] - frame_times[0])
+
+
+def _attach_consumers(experiment, walker, camera):
+    """Attach consumers like in the lamino session, return the added add-ons."""
+    async def live_preview(producer):
+        nth = max(1, int((await camera.get_frame_rate() / LIVE_PREVIEW_FPS).to_base_units()
+                         .magnitude))
+        i = 0
+        async for image in producer:
+            if i % nth == 0:
+                # Stand-in for the viewer, which gets a copy of the image
+                np.copy(image)
+            i += 1
+
+    async def check_timestamps(producer):
+        # Stand-in for the PCO timestamp check which decodes the first 14 pixels of every frame
+        async for image in producer:
+            np.asarray(image[0, :14], dtype=np.int64).sum()
+
+    return [
+        Consumer(experiment.acquisitions, live_preview),
+        Consumer([experiment.radios], Accumulate()),
+        ImageWriter(experiment.acquisitions, walker),
+        Consumer(experiment.acquisitions, check_timestamps),
+        # Must be last
+        Telemetry(experiment),
+    ]
+
+
+def _time_acquisitions(experiment, phases):
+    for acq in experiment.acquisitions:
+        def wrap(name, producer):
+            async def timed():
+                start = time.perf_counter()
+                try:
+                    async for item in producer():
+                        yield item
+                finally:
+                    phases[name] = time.perf_counter() - start
+
+            return timed
+
+        acq.producer = wrap(acq.name, acq.producer)
+
+
+async def run_benchmark(experiment_class, frame_rate=100 / q.s, width=2560, height=2160,
+                        num_projections=1000, num_flats=50, num_darks=50, num_buffers=1000,
+                        root=None, angular_range=360 * q.deg):
+    """Run *experiment_class* (:class:`.ContinuousLaminography` or :class:`.SteppedLaminography`)
+    over *angular_range* with simulated devices and return a :class:`BenchmarkResult`. Frames are
+    written to a temporary directory in *root* or not at all if *root* is None.
+    """
+    camera = await SimulatedCamera(frame_rate=frame_rate, width=width, height=height,
+                                   num_buffers=num_buffers)
+    flat_motor = await SimulatedRotationMotor(velocity=100 * q.deg / q.s)
+    rot_motor = await SimulatedRotationMotor(velocity=1000 * q.deg / q.s,
+                                             acceleration=10000 * q.deg / q.s ** 2)
+    shutter = await DummyShutter()
+    directory = tempfile.mkdtemp(dir=root) if root else None
+    walker = DirectoryWalker(root=directory) if directory else DummyWalker()
+    kwargs = dict(num_flats=num_flats, num_darks=num_darks, num_projections=num_projections,
+                  angular_range=angular_range, start_angle=0 * q.deg)
+
+    if experiment_class is ContinuousLaminography:
+        experiment = await ContinuousLaminography(walker, flat_motor, rot_motor, shutter,
+                                                  30 * q.deg, 0 * q.deg, camera, **kwargs)
+    else:
+        experiment = await experiment_class(walker, flat_motor, rot_motor, 30 * q.deg, 0 * q.deg,
+                                            camera, shutter, **kwargs)
+
+    addons = _attach_consumers(experiment, walker, camera)
+    phases = {}
+    _time_acquisitions(experiment, phases)
+    try:
+        async with _RssMonitor() as rss:
+            await experiment.run()
+    finally:
+        for addon in addons[::-1]:
+            addon.detach()
+        if directory:
+            shutil.rmtree(directory)
+
+    radios = addons[-1].records['radios']
+    fps = _get_frame_rate(radios.frame_times)
+    LOG.info(addons[-1].reports['radios'])
+
+    return BenchmarkResult(experiment_class.__name__, fps, camera.dropped_frames, rss.peak,
+                           rss.increase, phases)
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description='Laminography acquisition benchmark')
+    parser.add_argument('--frame-rate', type=float, default=100, help='Camera frame rate [1/s]')
+    parser.add_argument('--width', type=int, default=2560, help='Frame width')
+    parser.add_argument('--height', type=int, default=2160, help='Frame height')
+    parser.add_argument('--num-projections', type=int, default=1000)
+    parser.add_argument('--num-flats', type=int, default=50)
+    parser.add_argument('--num-darks', type=int, default=50)
+    parser.add_argument('--num-buffers', type=int, default=1000, help='Camera ring buffer size')
+    parser.add_argument('--root', help='Write frames to a temporary directory in ROOT')
+    parser.add_argument('--experiments', nargs='+', default=['continuous', 'stepped'],
+                        choices=['continuous', 'stepped'])
+    parser.add_argument('--min-fps', type=float, help='Fail below this continuous frame rate')
+    parser.add_argument('--max-dropped', type=int, help='Fail above this number of dropped frames')
+    parser.add_argument('--max-rss', type=float, help='Fail above this peak RSS [MiB]')
+    args = parser.parse_args(argv)
+
+    classes = {'continuous': ContinuousLaminography, 'stepped': SteppedLaminography}
+    failures = []
+    for name in args.experiments:
+        result = await run_benchmark(classes[name], frame_rate=args.frame_rate / q.s,
+                                     width=args.width, height=args.height,
+                                     num_projections=args.num_projections,
+                                     num_flats=args.num_flats, num_darks=args.num_darks,
+                                     num_buffers=args.num_buffers, root=args.root)
+        print(result)
+        # Stepped scans are limited by motion, the frame rate threshold applies only to continuous
+        failures += result.check(min_fps=args.min_fps if name == 'continuous' else None,
+                                 max_dropped=args.max_dropped,
+                                 max_rss=args.max_rss * q.MiB if args.max_rss else None)
+
+    for failure in failures:
+        print('FAILED', failure)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
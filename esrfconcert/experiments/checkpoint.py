@@ -0,0 +1,255 @@
+"""Scan progress checkpoints for resuming interrupted scans."""
+import glob
+import json
+import logging
+import os
+import numpy as np
+
+
+LOG = logging.getLogger(__name__)
+
+
+class ScanCheckpoint(object):
+
+    """Progress of a scan stored in a JSON file *path*. It records for every projection index the
+    run in which it was acquired (-1 for missing projections), the names of completed acquisitions
+    other than the projections (e.g. 'flats', 'darks_after') in :attr:`valid` and for every run the
+    directory it was written to and the projection indices in the order in which they were written
+    there, see :meth:`locate`. An existing file is loaded.
+
+    Projections are first added to the current run by :meth:`add` in acquisition order and count as
+    acquired only once their storage is confirmed by :meth:`confirm`. Every confirmation is saved
+    at least every *save_interval* confirmed projections and the file is written by :meth:`save`.
+    """
+
+    def __init__(self, path, save_interval=100):
+        self.path = path
+        self.save_interval = save_interval
+        self.scan = None
+        self.run = -1
+        self.runs = np.zeros(0, dtype=np.int32)
+        self.valid = set()
+        # One {'directory': path or None, 'ranges': [[start, stop, step], ...]} entry per run, the
+        # ranges hold the confirmed projection indices in the order they were written
+        self.records = []
+        self._unsaved = 0
+        # Projections added in this run in acquisition order, the first _num_confirmed of them are
+        # confirmed
+        self._added = []
+        self._num_confirmed = 0
+        self._discarded = False
+        if os.path.exists(path):
+            self.load()
+
+    @property
+    def num_acquired(self):
+        return int(np.count_nonzero(self.runs >= 0))
+
+    @property
+    def complete(self):
+        return len(self.runs) > 0 and self.num_acquired == len(self.runs)
+
+    @property
+    def num_added(self):
+        """Number of projections added in the current run."""
+        return len(self._added)
+
+    @property
+    def directory(self):
+        """Directory of the current run."""
+        return self.records[-1]['directory'] if self.records else None
+
+    @directory.setter
+    def directory(self, directory):
+        self.records[-1]['directory'] = directory
+
+    def reset(self, **scan):
+        """Start a new scan described by keyword arguments *scan*, which must contain
+        *num_projections* and must be JSON serializable.
+        """
+        self.scan = scan
+        self.run = 0
+        self.runs = -np.ones(scan['num_projections'], dtype=np.int32)
+        self.valid = set()
+        self.records = []
+        self._start_run()
+        self.save()
+
+    def start_run(self, **scan):
+        """Start a run resuming the scan, *scan* must match the one given to :meth:`reset`."""
+        if self.scan != scan:
+            raise CheckpointError('Checkpointed scan {} does not match {}'.format(self.scan, scan))
+        self.run += 1
+        self._start_run()
+        LOG.info('Resuming scan, %d of %d projections acquired, complete acquisitions: %s',
+                 self.num_acquired, len(self.runs), ', '.join(sorted(self.valid)) or 'none')
+
+    def _start_run(self):
+        self.records.append({'directory': None, 'ranges': []})
+        self._added = []
+        self._num_confirmed = 0
+        self._discarded = False
+
+    def is_valid(self, name):
+        """Return True if acquisition *name* is complete."""
+        return name in self.valid
+
+    def set_valid(self, name):
+        """Mark acquisition *name* as complete and save."""
+        self.valid.add(name)
+        self.save()
+
+    def add(self, index):
+        """Add projection *index* acquired in the current run, it is acquired once confirmed."""
+        if not self._discarded:
+            self._added.append(int(index))
+
+    def confirm(self, num_written=None):
+        """Confirm that the first *num_written* projections added in this run (all if None) have
+        been stored.
+        """
+        if num_written is None:
+            num_written = len(self._added)
+        num_written = min(num_written, len(self._added))
+        if num_written <= self._num_confirmed:
+            return
+        indices = self._added[self._num_confirmed:num_written]
+        self.runs[indices] = self.run
+        self.records[-1]['ranges'] = _get_ranges(self._added[:num_written])
+        self._unsaved += num_written - self._num_confirmed
+        self._num_confirmed = num_written
+        if self._unsaved >= self.save_interval:
+            self.save()
+
+    def discard_since(self, index):
+        """Mark projection *index* and all projections added after it in the current run as
+        missing, e.g. when they turn out to be bad. Projections added later in this run are ignored,
+        the run is expected to be stopped.
+        """
+        self._discarded = True
+        if index in self._added:
+            position = self._added.index(index)
+            self.runs[self._added[position:]] = -1
+            del self._added[position:]
+            self._num_confirmed = min(self._num_confirmed, position)
+            self.records[-1]['ranges'] = _get_ranges(self._added[:self._num_confirmed])
+        self.save()
+
+    def get_missing(self):
+        """Return the indices of missing projections."""
+        return np.where(self.runs < 0)[0]
+
+    def get_missing_sectors(self):
+        """Return a list of (first index, number of projections) tuples of contiguous missing
+        projections.
+        """
+        missing = self.get_missing()
+        if not len(missing):
+            return []
+        # Split where consecutive missing indices are not neighbors
+        breaks = np.where(np.diff(missing) > 1)[0] + 1
+        starts = np.concatenate(([0], breaks))
+        ends = np.concatenate((breaks, [len(missing)]))
+
+        return [(int(missing[start]), int(end - start)) for start, end in zip(starts, ends)]
+
+    def locate(self, index):
+        """Return a tuple (directory, position) of projection *index*, i.e. the directory of the
+        run which acquired it and the position of the projection among the frames written there.
+        Return None for missing projections.
+        """
+        run = self.runs[index]
+        if run < 0:
+            return None
+        record = self.records[run]
+        position = 0
+        for start, stop, step in record['ranges']:
+            indices = range(start, stop, step)
+            if index in indices:
+                return (record['directory'], position + indices.index(index))
+            position += len(indices)
+
+    def save(self):
+        state = {
+            'scan': self.scan,
+            'run': self.run,
+            'runs': self.runs.tolist(),
+            'valid': sorted(self.valid),
+            'records': self.records,
+        }
+        # Write to a temporary file first so that a crash does not leave a broken checkpoint
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
+
+    def load(self):
+        with open(self.path) as f:
+            state = json.load(f)
+        self.scan = state['scan']
+        self.run = state['run']
+        self.runs = np.array(state['runs'], dtype=np.int32)
+        self.valid = set(state['valid'])
+        self.records = state['records']
+
+
+class WrittenFrames(object):
+
+    """Count of the frames written to the TIFF files in directory *path*, e.g. by a
+    :class:`concert.storage.DirectoryWalker`. Files are assumed to be written one after another in
+    the order of their names, so only the last one is read again by :meth:`count`. The count is a
+    lower bound, the last frame of the last file may still be being written and is not counted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._counts = {}
+
+    def count(self):
+        """Return the number of frames written so far. A file which cannot be read ends the
+        count.
+        """
+        import tifffile
+
+        filenames = sorted(glob.glob(os.path.join(self.path, '*.tif')))
+        total = 0
+        for i, filename in enumerate(filenames):
+            if filename not in self._counts:
+                try:
+                    with tifffile.TiffFile(filename) as tif:
+                        count = len(tif.pages)
+                except Exception:
+                    break
+                if i == len(filenames) - 1:
+                    # The last file may still grow
+                    total += max(count - 1, 0)
+                    break
+                self._counts[filename] = count
+            total += self._counts[filename]
+
+        return total
+
+
+def _get_ranges(indices):
+    """Compress *indices* into a list of [start, stop, step] ranges of consecutive values."""
+    ranges = []
+    for index in indices:
+        if ranges:
+            start, stop, step = ranges[-1]
+            if len(range(start, stop, step)) == 1 and abs(index - start) == 1:
+                ranges[-1] = [start, index + (index - start), index - start]
+                continue
+            if index == stop:
+                ranges[-1][1] += step
+                continue
+        ranges.append([index, index + 1, 1])
+
+    return ranges
+
+
+class CheckpointError(Exception):
+
+    """Raised when a scan cannot be resumed."""
+
+    pass
@@ -8,34 +8,149 @@
 """
 import asyncio
 import logging
+import os
 import time
+import numpy as np
 
 from concert.base import Parameter, Quantity
 from concert.coroutines.base import background, start
 from concert.quantities import q
 from concert.experiments.base import Acquisition, Experiment
 from concert.experiments.synchrotron import SteppedTomography, ContinuousTomography
+from concert.storage import DirectoryWalker
+from esrfconcert.experiments.checkpoint import CheckpointError, WrittenFrames
 
 
 LOG = logging.getLogger(__name__)
 
 
-class SteppedLaminography(SteppedTomography):
+class _CheckpointMixin(object):
     """
-    Stepped laminography
+    Scan progress checkpointing. If :attr:`checkpoint` is set to a
+    :class:`esrfconcert.experiments.checkpoint.ScanCheckpoint`, every run resets it and records in
+    it the projections stored by the run, its directory and the completed acquisitions. A
+    projection counts as acquired once it has been written, i.e. when the radios acquisition ends
+    and periodically in between according to the frames found on disk if the experiment writes
+    with a :class:`concert.storage.DirectoryWalker`. :meth:`resume` runs the experiment again and
+    takes only the missing projections and skips all other acquisitions which have been completed.
+    """
+    checkpoint = None
+    _resuming = False
+    _written_radios = None
+
+    async def _get_scan_description(self):
+        return {
+            'num_projections': await self.get_num_projections(),
+            'angular_range': float((await self.get_angular_range()).to(q.deg).magnitude),
+            'start_angle': float((await self.get_start_angle()).to(q.deg).magnitude)
+        }
+
+    @background
+    async def run(self):
+        if self.checkpoint:
+            scan = await self._get_scan_description()
+            if self._resuming:
+                self.checkpoint.start_run(**scan)
+            else:
+                self.checkpoint.reset(**scan)
+        try:
+            await super().run()
+        finally:
+            if self.checkpoint:
+                self.checkpoint.save()
+
+    async def resume(self):
+        """Resume the checkpointed scan."""
+        if not self.checkpoint:
+            raise CheckpointError('No checkpoint set')
+        self._resuming = True
+        try:
+            await self.run()
+        finally:
+            self._resuming = False
+
+    async def acquire(self):
+        if not self.checkpoint:
+            await super().acquire()
+            return
+
+        if isinstance(self.walker, DirectoryWalker):
+            # The walker is in the directory of this run, acquisitions are written below it
+            self.checkpoint.directory = self.walker.current
+            self._written_radios = WrittenFrames(os.path.join(self.walker.current, 'radios'))
+        else:
+            self._written_radios = None
+        for acq in self.acquisitions:
+            if await self.get_state() != 'running':
+                break
+            if acq.name == 'radios':
+                if self.checkpoint.complete:
+                    LOG.info('Projections complete in checkpoint, skipping them')
+                    continue
+                completed = False
+                try:
+                    await acq()
+                    completed = True
+                finally:
+                    # The writers are done with a finished acquisition, otherwise only the frames
+                    # found on disk are known to be stored
+                    self._confirm_projections(completed=completed)
+            elif self.checkpoint.is_valid(acq.name):
+                LOG.info('%s complete in checkpoint, skipping them', acq.name.capitalize())
+            else:
+                await acq()
+                self.checkpoint.set_valid(acq.name)
+
+    def _add_projection(self, index):
+        """Add projection *index* to the checkpoint, confirm the written ones once in a while."""
+        if not self.checkpoint:
+            return
+        self.checkpoint.add(index)
+        if not self.checkpoint.num_added % self.checkpoint.save_interval:
+            self._confirm_projections()
+
+    def _confirm_projections(self, completed=False):
+        if completed or self._written_radios is None:
+            self.checkpoint.confirm()
+        else:
+            self.checkpoint.confirm(self._written_radios.count())
+
+
+class SteppedLaminography(_CheckpointMixin, SteppedTomography):
+    """
+    Stepped laminography, resumable by :meth:`resume` when :attr:`checkpoint` is set.
     """
     async def __ainit__(self, walker, flat_motor, scanning_motor, radio_position, flat_position, camera,
                  shutter, num_flats=51, num_darks=50, num_projections=3600, 
                  angular_range=360 * q.deg, start_angle=0 * q.deg, seperate_scans=True):
         
-        await SteppedTomography.__ainit__(self)
+        await SteppedTomography.__ainit__(
+            self,
+            walker=walker,
+            flat_motor=flat_motor,
+            tomography_motor=scanning_motor,
+            radio_position=radio_position,
+            flat_position=flat_position,
+            camera=camera,
+            shutter=shutter,
+            num_flats=num_flats,
+            num_darks=num_darks,
+            num_projections=num_projections,
+            angular_range=angular_range,
+            start_angle=start_angle,
+            separate_scans=seperate_scans
+        )
 
     async def _take_radios(self):
         try:
             await self._prepare_radios()
             await self._camera.set_trigger_source("SOFTWARE")
+            if self.checkpoint:
+                indices = self.checkpoint.get_missing()
+            else:
+                indices = range(await self.get_num_projections())
             async with self._camera.recording():
-                for i in range(await self.get_num_projections()):
+                for i in indices:
                     await self._tomography_motor.set_position(
                             i * await self.get_angular_range() / await self.get_num_projections() +
                             await self.get_start_angle()
@@ -44,20 +159,37 @@ class SteppedLaminography(SteppedTomography):
                         await self._camera.trigger()
                     except:
                         pass
-                    yield await self._camera.grab()
+                    frame = await self._camera.grab()
+                    if hasattr(frame, 'metadata'):
+                        frame.metadata['projection_index'] = int(i)
+                    yield frame
+                    self._add_projection(i)
         finally:
             await self._finish_radios()
 
 
-class ContinuousLaminography(ContinuousTomography):
+class ContinuousLaminography(_CheckpointMixin, ContinuousTomography):
     """
-    Continuous laminography
+    Continuous laminography, resumable by :meth:`resume` when :attr:`checkpoint` is set, in which
+    case only the missing angular sectors are scanned again (each with its own acceleration and
+    deceleration margin). If *bidirectional* is True, consecutive scans alternate the direction
+    of the scanning motor, i.e. every other scan starts where the previous one ended and there is no
+    rewind to the start angle. Both directions cover the same angular sector, projections of
+    reversed scans come in descending angle order, which is logged in the experiment log and stored
+    in the frame metadata (if the camera provides it) under 'scan_direction' and 'projection_index'.
+    Stored frames keep the acquisition order, online reconstructions follow the direction by
+    :class:`esrfconcert.experiments.addons.ScanDirection` or, out of process, by the frame metadata
+    (:class:`esrfconcert.experiments.addons.ProcessReconstruction`).
     """
     velocity = Quantity(q.deg / q.s)
+    bidirectional = Parameter(help='Alternate the scanning direction between consecutive scans')
+    direction = Parameter(help='Direction of the next scan, 1 (ascending angles) or -1')
 
     async def __ainit__(self, walker, flat_motor, scanning_motor, shutter, radio_position, flat_position, camera,
                  num_flats=51, num_darks=50, num_projections=3600, angular_range=360 * q.deg, start_angle=0 * q.deg,
-                 separate_scans=True):
+                 separate_scans=True, bidirectional=False):
+        self._bidirectional = bidirectional
+        self._direction = 1
         await ContinuousTomography.__ainit__(
             self,
             walker=walker,
@@ -77,6 +209,48 @@ class ContinuousLaminography(ContinuousTomography):
         self['radio_position']._parameter.unit = q.deg
         self['flat_position']._parameter.unit = q.deg
 
+    async def _get_bidirectional(self):
+        return self._bidirectional
+
+    async def _set_bidirectional(self, bidirectional):
+        self._bidirectional = bool(bidirectional)
+        if not self._bidirectional:
+            self._direction = 1
+
+    async def _get_direction(self):
+        return self._direction
+
+    async def _set_direction(self, direction):
+        if direction not in [1, -1]:
+            raise ValueError('direction must be 1 or -1')
+        self._direction = direction
+
+    async def _get_motion(self, first=0, num=None):
+        """Get the motion of the scanning motor for the next scan of *num* projections starting with
+        projection *first* (all by default) as a tuple (motion start, motion end, acceleration time,
+        delay between motion start and first frame).
+        """
+        if num is None:
+            num = self._num_projections
+        rot_velocity = await self.get_velocity()
+        margin_time = rot_velocity / await self._tomography_motor.get_acceleration()
+        # TODO: make this a parameter
+        additional_margin = 0.5 * q.deg
+        margin = 0.5 * rot_velocity * margin_time + additional_margin
+        step = await self.get_angular_range() / self._num_projections
+        start_pos = await self.get_start_angle() + first * step
+        end_pos = start_pos + num * step + 2 * margin
+        LOG.debug("End position: %s, additional_margin: %s, margin: %s",
+                 end_pos, additional_margin, margin)
+        delay = margin_time
+        if self._direction == -1:
+            start_pos, end_pos = end_pos, start_pos
+            # Moving backwards the additional margin is in front of the first projection, skip it to
+            # cover the same angular sector as in the forward direction
+            delay = margin_time + 2 * additional_margin / rot_velocity
+
+        return (start_pos, end_pos, margin_time, delay)
+
     async def _prepare_radios(self):
         if 'motion_velocity' in self._tomography_motor:
             await self._tomography_motor['motion_velocity'].stash()
@@ -92,7 +266,7 @@ class ContinuousLaminography(ContinuousTomography):
 
         await self._flat_motor.set_position(await self.get_radio_position())
         await self._tomography_motor.set_velocity(25 * q.deg / q.s)
-        await self._tomography_motor.set_position(await self.get_start_angle())
+        await self._tomography_motor.set_position((await self._get_motion())[0])
         await self.start_sample_exposure()
 
     async def _finish_radios(self):
@@ -103,41 +277,199 @@ class ContinuousLaminography(ContinuousTomography):
             await self._tomography_motor.stop()
         if 'motion_velocity' in self._tomography_motor:
             await self._tomography_motor['motion_velocity'].restore()
-        await self._tomography_motor.set_position(await self.get_start_angle())
+        if self._bidirectional:
+            # The next scan starts where this one ended
+            self._direction = -self._direction
+        else:
+            await self._tomography_motor.set_position(await self._get_rewind_position())
         self._finished = True
 
+    async def _get_rewind_position(self):
+        """Position the scanning motor returns to after a unidirectional scan."""
+        return await self.get_start_angle()
+
     async def _take_radios(self):
-        rot_velocity = await self.get_velocity()
-        margin_time = rot_velocity / await self._tomography_motor.get_acceleration()
-        # TODO: make this a parameter
-        additional_margin = 0.5 * q.deg
-        margin = 0.5 * rot_velocity * margin_time + additional_margin
-        end_pos = await self.get_start_angle() + await self.get_angular_range() + 2 * margin
-        LOG.debug("End position: %s, additional_margin: %s, margin: %s",
-                 end_pos, additional_margin, margin)
+        if self.checkpoint:
+            sectors = self.checkpoint.get_missing_sectors()
+        else:
+            sectors = [(0, self._num_projections)]
         try:
             await self._prepare_radios()
-            # TODO: change this to motion_velocity
-            await self._tomography_motor.set_velocity(rot_velocity)
-            LOG.debug("Starting motion with scanning motor at %s",
+            for first, num in sectors:
+                async for frame in self._take_sector(first, num):
+                    yield frame
+        finally:
+            # TODO: remove after motion_velocity is implemented
+            await self._tomography_motor.set_velocity(25 * q.deg / q.s)
+            await self._finish_radios()
+
+    async def _take_sector(self, first, num):
+        """Take *num* projections starting with projection *first* in one continuous motion."""
+        rot_velocity = await self.get_velocity()
+        direction = self._direction
+        start_pos, end_pos, margin_time, delay = await self._get_motion(first, num)
+        self.log.info('Scan direction: %d, projections %d-%d', direction, first, first + num - 1)
+        if num != self._num_projections:
+            # _prepare_radios moved the motor to the start of the full scan
+            await self._tomography_motor.set_velocity(25 * q.deg / q.s)
+            await self._tomography_motor.set_position(start_pos)
+        # TODO: change this to motion_velocity
+        await self._tomography_motor.set_velocity(rot_velocity)
+        LOG.debug("Starting motion with scanning motor at %s",
+                  await self._tomography_motor.get_position())
+        motion_task = self._tomography_motor.set_position(end_pos)
+        LOG.debug("Waiting %s for acceleration", delay)
+        await asyncio.sleep(delay.to(q.s).magnitude)
+        stop_reported = False
+        async with self._camera.recording():
+            LOG.debug("Camera started recording with scanning motor at %s",
                       await self._tomography_motor.get_position())
-            motion_task = self._tomography_motor.set_position(end_pos)
-            LOG.debug("Waiting %s for acceleration", margin_time)
-            await asyncio.sleep(margin_time.to(q.s).magnitude)
-            stop_reported = False
-            async with self._camera.recording():
-                LOG.debug("Camera started recording with scanning motor at %s",
-                          await self._tomography_motor.get_position())
-                for i in range(self._num_projections):
-                    yield await self._camera.grab()
-                    if not stop_reported and motion_task.done():
-                        LOG.debug("Motion task done when grabbing projection %d", i)
-                        stop_reported = True
-                LOG.debug("Grabbing frames completed with scanning motor at %s",
-                          await self._tomography_motor.get_position())
-                await motion_task
+            for i in range(num):
+                index = first + (i if direction == 1 else num - 1 - i)
+                frame = await self._camera.grab()
+                if hasattr(frame, 'metadata'):
+                    frame.metadata['scan_direction'] = direction
+                    frame.metadata['projection_index'] = index
+                yield frame
+                self._add_projection(index)
+                if not stop_reported and motion_task.done():
+                    LOG.debug("Motion task done when grabbing projection %d", i)
+                    stop_reported = True
+            LOG.debug("Grabbing frames completed with scanning motor at %s",
+                      await self._tomography_motor.get_position())
+            await motion_task
+            LOG.debug("Motion finished")
+
+
+class TimeResolvedLaminography(ContinuousLaminography):
+    """
+    Time-resolved (4D) laminography. The scanning motor rotates continuously over
+    *num_revolutions* full turns, each turn yielding *num_projections* frames. The frame stream is
+    split into one acquisition per revolution, the first one is called 'radios' (so that addons
+    attached to radios get the first revolution), the following ones 'radios_1', 'radios_2', ...
+    The camera keeps recording and the motor keeps moving between them, every frame is handed to
+    the consumers as soon as it is grabbed. Flats and darks are taken before the first revolution
+    and if *flats_at_end* is True also after the last one ('flats_after', 'darks_after'). After
+    the scan, the scanning motor returns to the closest position equivalent to the start angle
+    modulo 360 degrees instead of unwinding all revolutions.
+    """
+    num_revolutions = Parameter(help='Number of full revolutions')
+
+    async def __ainit__(self, walker, flat_motor, scanning_motor, shutter, radio_position,
+                        flat_position, camera, num_flats=51, num_darks=50, num_projections=3600,
+                        num_revolutions=10, start_angle=0 * q.deg, flats_at_end=True,
+                        separate_scans=True):
+        self._num_revolutions = num_revolutions
+        self._motion_task = None
+        # Whole turns between start_angle and the start of the next scan
+        self._turn_offset = 0 * q.deg
+        await ContinuousLaminography.__ainit__(
+            self,
+            walker,
+            flat_motor,
+            scanning_motor,
+            shutter,
+            radio_position,
+            flat_position,
+            camera,
+            num_flats=num_flats,
+            num_darks=num_darks,
+            num_projections=num_projections,
+            angular_range=360 * q.deg,
+            start_angle=start_angle,
+            separate_scans=separate_scans
+        )
+        for i in range(1, num_revolutions):
+            self.add(await Acquisition('radios_{}'.format(i), self._make_revolution_producer(i)))
+        if flats_at_end:
+            self.add(await Acquisition('flats_after', self._take_flats))
+            self.add(await Acquisition('darks_after', self._take_darks))
+
+    async def _get_num_revolutions(self):
+        return self._num_revolutions
+
+    async def _set_bidirectional(self, bidirectional):
+        if bidirectional:
+            raise ValueError('Time-resolved laminography is always unidirectional')
+
+    async def resume(self):
+        raise LaminographyError('Time-resolved laminography cannot be resumed')
+
+    async def _get_motion(self, first=0, num=None):
+        start_pos, end_pos, margin_time, delay = await ContinuousLaminography._get_motion(
+            self, first=first, num=num)
+        end_pos += (self._num_revolutions - 1) * await self.get_angular_range()
+
+        return (start_pos + self._turn_offset, end_pos + self._turn_offset, margin_time, delay)
+
+    async def _get_rewind_position(self):
+        # Go back to the closest position equivalent to the start angle instead of unwinding all
+        # revolutions, the next scan starts there
+        start_angle = await self.get_start_angle()
+        position = await self._tomography_motor.get_position()
+        turns = np.round((position - start_angle).to(q.deg).magnitude / 360)
+        self._turn_offset = turns * 360 * q.deg
+
+        return start_angle + self._turn_offset
+
+    def _make_revolution_producer(self, index):
+        async def take_revolution():
+            async for frame in self._take_revolution(index):
+                yield frame
+
+        return take_revolution
+
+    async def _take_radios(self):
+        async for frame in self._take_revolution(0):
+            yield frame
+
+    async def _take_revolution(self, index):
+        last = index == self._num_revolutions - 1
+        completed = False
+        try:
+            if index == 0:
+                rot_velocity = await self.get_velocity()
+                start_pos, end_pos, margin_time, delay = await self._get_motion()
+                await self._prepare_radios()
+                # TODO: change this to motion_velocity
+                await self._tomography_motor.set_velocity(rot_velocity)
+                self._motion_task = self._tomography_motor.set_position(end_pos)
+                LOG.debug("Waiting %s for acceleration", delay)
+                await asyncio.sleep(delay.to(q.s).magnitude)
+                await self._camera.start_recording()
+            elif self._motion_task is None:
+                raise LaminographyError('Revolution {} started without motion'.format(index))
+
+            LOG.debug("Revolution %d started with scanning motor at %s", index,
+                      await self._tomography_motor.get_position())
+            for i in range(self._num_projections):
+                frame = await self._camera.grab()
+                if hasattr(frame, 'metadata'):
+                    frame.metadata['revolution'] = index
+                yield frame
+            completed = True
+        finally:
+            if last or not completed:
+                await self._finish_revolutions(completed)
+
+    async def _finish_revolutions(self, completed):
+        if self._finished:
+            return
+        try:
+            if await self._camera.get_state() == 'recording':
+                await self._camera.stop_recording()
+            if completed:
+                await self._motion_task
                 LOG.debug("Motion finished")
         finally:
+            self._motion_task = None
             # TODO: remove after motion_velocity is implemented
             await self._tomography_motor.set_velocity(25 * q.deg / q.s)
             await self._finish_radios()
+
+
+class LaminographyError(Exception):
+
+    """Laminography experiment errors."""
+
+    pass
@@ -0,0 +1,124 @@
+"""Helpers for setting up esrfconcert sessions."""
+import asyncio
+import contextlib
+import importlib
+import logging
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+
+class StartupProfile(object):
+
+    """Session startup bookkeeping. Imports and device constructions executed through this object
+    are timed and can be displayed by printing it. The total time is counted from *start* (a
+    :func:`time.perf_counter` value, e.g. taken before the imports of a session) or from the
+    creation of the profile if None.
+
+    Usage::
+
+        start = time.perf_counter()
+        # Session imports
+        profile = StartupProfile(start=start)
+        profile.record('import', 'session imports', start)
+        static = profile.import_module('bliss.config.static')
+        devices = await profile.create_devices(
+            sx45=SampleManipulationMotor(...),
+            lamino_tilt=ContinuousRotationMotor(...),
+        )
+        print(profile)
+    """
+
+    def __init__(self, start=None):
+        self.entries = []
+        self._start = time.perf_counter() if start is None else start
+
+    @contextlib.contextmanager
+    def measure(self, kind, name):
+        """Time the body of the with statement and record it under *kind* (e.g. 'import') and
+        *name*.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(kind, name, start)
+
+    def record(self, kind, name, start):
+        """Record *kind* and *name* which took from *start* (a :func:`time.perf_counter` value)
+        until now, e.g. for work done before the profile was created.
+        """
+        duration = time.perf_counter() - start
+        self.entries.append((kind, name, duration))
+        LOG.debug('%s %s took %.3f s', kind, name, duration)
+
+    def import_module(self, name):
+        """Import module *name* and record how long it took."""
+        with self.measure('import', name):
+            return importlib.import_module(name)
+
+    def import_lazily(self, name):
+        """Return a :class:`LazyModule` for module *name*, the import is recorded when it
+        happens.
+        """
+        return LazyModule(name, profile=self)
+
+    async def create_device(self, name, awaitable):
+        """Await *awaitable* which constructs device *name*, e.g. `Motor(...)', and return the
+        device.
+        """
+        with self.measure('device', name):
+            return await awaitable
+
+    async def create_devices(self, **awaitables):
+        """Construct independent devices concurrently. *awaitables* map device names to awaitable
+        constructors, e.g. `sx45=SampleManipulationMotor(...)'. Return a dictionary with the same
+        keys and the constructed devices as values. Devices which depend on each other must be
+        created by separate calls. Only constructors which wait for I/O (e.g. connecting to a
+        server) overlap, the others run one after another anyway.
+        """
+        names = list(awaitables.keys())
+        devices = await asyncio.gather(*[self.create_device(name, awaitables[name])
+                                         for name in names])
+
+        return dict(zip(names, devices))
+
+    @property
+    def total(self):
+        """Time elapsed since the creation of this profile."""
+        return time.perf_counter() - self._start
+
+    def __str__(self):
+        lines = ['{:<8} {:<32} {:>9}'.format('Kind', 'Name', 'Time [s]')]
+        for kind, name, duration in sorted(self.entries, key=lambda entry: -entry[2]):
+            lines.append('{:<8} {:<32} {:>9.3f}'.format(kind, name, duration))
+        lines.append('{:<41} {:>9.3f}'.format('Total', self.total))
+
+        return '\n'.join(lines)
+
+
+class LazyModule(object):
+
+    """Stand-in for module *name* which is imported on the first attribute access, e.g. for slow
+    imports only needed interactively. The import is recorded in *profile* if given.
+    """
+
+    def __init__(self, name, profile=None):
+        self._name = name
+        self._profile = profile
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            if self._profile:
+                self._module = self._profile.import_module(self._name)
+            else:
+                self._module = importlib.import_module(self._name)
+
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        state = 'imported' if self._module else 'not imported'
+
+        return '<LazyModule {} ({})>'.format(self._name, state)
@@ -0,0 +1,151 @@
+"""Vectorized image measures used by esrfconcert routines. All functions operate on the last two
+axes of their input, so a whole stack of images is processed in one pass.
+"""
+import numpy as np
+
+
+def gradient_energy(images):
+    """Mean squared gradient magnitude of *images* (..., height, width). Sharper images yield
+    larger values.
+    """
+    images = np.asarray(images, dtype=np.float32)
+    dy = np.diff(images, axis=-2)[..., :, :-1]
+    dx = np.diff(images, axis=-1)[..., :-1, :]
+
+    return np.mean(dx ** 2 + dy ** 2, axis=(-2, -1))
+
+
+def entropy(images, num_bins=256):
+    """Shannon entropy of the gray value histogram of *images* (..., height, width). Every image
+    is binned into *num_bins* between its own minimum and maximum. Sharper slices have lower
+    entropy.
+    """
+    images = np.asarray(images, dtype=np.float32)
+    shape = images.shape[:-2]
+    flat = images.reshape(-1, images.shape[-2] * images.shape[-1])
+    lower = flat.min(axis=1, keepdims=True)
+    span = flat.max(axis=1, keepdims=True) - lower
+    span[span == 0] = 1
+    indices = np.minimum(((flat - lower) / span * num_bins).astype(np.intp), num_bins - 1)
+    # Offset the bins of every image so that one bincount computes all histograms
+    indices += np.arange(flat.shape[0])[:, np.newaxis] * num_bins
+    hist = np.bincount(indices.ravel(), minlength=flat.shape[0] * num_bins)
+    prob = hist.reshape(flat.shape[0], num_bins) / flat.shape[1]
+    logs = np.zeros_like(prob)
+    np.log2(prob, out=logs, where=prob > 0)
+
+    return -np.sum(prob * logs, axis=1).reshape(shape)
+
+
+class RunningStatistics(object):
+
+    """Per-pixel statistics of a stream of images updated one image at a time by :meth:`update`.
+    Mean and variance are computed by Welford's algorithm in float32, so only a few images are held
+    in memory. Pixels at or above *saturation* (the maximum of the image dtype by default) are
+    counted.
+    """
+
+    def __init__(self, saturation=None):
+        self.saturation = saturation
+        self.count = 0
+        self.mean = None
+        self._m2 = None
+        self._num_saturated = None
+
+    def update(self, image):
+        image = np.asarray(image)
+        saturation = self.saturation
+        if saturation is None:
+            saturation = np.iinfo(image.dtype).max if image.dtype.kind in 'ui' else np.inf
+        values = image.astype(np.float32)
+        self.count += 1
+        if self.mean is None:
+            self.mean = values
+            self._m2 = np.zeros_like(values)
+            self._num_saturated = np.zeros(values.shape, dtype=np.uint32)
+        else:
+            delta = values - self.mean
+            self.mean += delta / self.count
+            values -= self.mean
+            self._m2 += delta * values
+        self._num_saturated += image >= saturation
+
+    @property
+    def variance(self):
+        """Unbiased per-pixel variance."""
+        if self.count < 2:
+            return None
+
+        return self._m2 / (self.count - 1)
+
+    @property
+    def saturated(self):
+        """Fraction of images in which a pixel was saturated."""
+        if not self.count:
+            return None
+
+        return (self._num_saturated / self.count).astype(np.float32)
+
+    def get_hot_pixels(self, num_sigmas=5):
+        """Get a boolean map of pixels whose mean exceeds the median of all means by more than
+        *num_sigmas* robust standard deviations (estimated from the median absolute deviation).
+        """
+        median = np.median(self.mean)
+        sigma = 1.4826 * np.median(np.abs(self.mean - median))
+
+        return self.mean > median + num_sigmas * max(sigma, np.finfo(np.float32).eps)
+
+
+def center_of_mass(images):
+    """Center of mass (x, y) in pixels of *images* (..., height, width), negative values are
+    ignored. Return an array (..., 2), NaN for images without positive values.
+    """
+    images = np.clip(np.asarray(images, dtype=np.float32), 0, None)
+    total = np.sum(images, axis=(-2, -1))
+    x = np.sum(images.sum(axis=-2) * np.arange(images.shape[-1]), axis=-1)
+    y = np.sum(images.sum(axis=-1) * np.arange(images.shape[-2]), axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.stack((x / total, y / total), axis=-1)
+
+
+def downsample(image, factor):
+    """Downsample *image* (..., height, width) by averaging *factor* x *factor* blocks, excess rows
+    and columns are cropped.
+    """
+    image = np.asarray(image)
+    height = image.shape[-2] // factor * factor
+    width = image.shape[-1] // factor * factor
+    image = image[..., :height, :width]
+    shape = image.shape[:-2] + (height // factor, factor, width // factor, factor)
+
+    return image.reshape(shape).mean(axis=(-3, -1), dtype=np.float32)
+
+
+def get_shift(image, reference):
+    """Get the shift (y, x) in pixels of *image* with respect to *reference* by phase
+    correlation.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    reference = np.asarray(reference, dtype=np.float32)
+    spectrum = np.fft.rfft2(image - image.mean()) * np.conj(np.fft.rfft2(reference -
+                                                                         reference.mean()))
+    spectrum /= np.abs(spectrum) + np.finfo(np.float32).eps
+    correlation = np.fft.irfft2(spectrum, s=image.shape)
+    peak = np.array(np.unravel_index(np.argmax(correlation), correlation.shape))
+    # Peaks past the middle are negative shifts
+    shape = np.array(correlation.shape)
+    peak[peak > shape // 2] -= shape[peak > shape // 2]
+
+    return tuple(int(value) for value in peak)
+
+
+def sharpness(images, metric='gradient'):
+    """Sharpness of *images* (..., height, width) for which larger is better. *metric* is either
+    'gradient' (:func:`gradient_energy`) or 'entropy' (negative :func:`entropy`).
+    """
+    if metric == 'gradient':
+        return gradient_energy(images)
+    elif metric == 'entropy':
+        return -entropy(images)
+
+    raise ValueError("Unknown metric `{}', use `gradient' or `entropy'".format(metric))
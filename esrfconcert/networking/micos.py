@@ -1,35 +1,149 @@
 """Ethernet connection to micos motors on ANKA laminograph at ID19 at ESRF."""
 
-import logging
 import asyncio
+import heapq
+import itertools
+import logging
 from concert.quantities import q
 from concert.networking import base
 
 
 LOG = logging.getLogger(__name__)
 
+# Request priorities, lower values are served first
+URGENT = 0
+NORMAL = 1
+POLL = 2
+
+
+class PriorityLock(object):
+
+    """Lock granted to waiters by their priority (lower first), in order of arrival within one
+    priority. :attr:`urgent` is set as long as an :data:`URGENT` request is waiting. Used as an
+    async context manager it acquires with :data:`NORMAL` priority.
+    """
+
+    def __init__(self):
+        self._locked = False
+        self._waiters = []
+        self._counter = itertools.count()
+        self._num_urgent = 0
+        self.urgent = asyncio.Event()
+
+    def locked(self):
+        return self._locked
+
+    async def acquire(self, priority=NORMAL):
+        if not self._locked and not self._waiters:
+            self._locked = True
+            return True
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        if priority == URGENT:
+            self._num_urgent += 1
+            self.urgent.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The lock has been handed over to us in the meantime
+                self.release()
+            raise
+        finally:
+            if priority == URGENT:
+                self._num_urgent -= 1
+                if not self._num_urgent:
+                    self.urgent.clear()
+
+        return True
+
+    def release(self):
+        if not self._locked:
+            raise RuntimeError('Lock is not acquired')
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[2]
+            if not future.done():
+                # Hand the lock over without unlocking it
+                future.set_result(None)
+                return
+        self._locked = False
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
 
 class SocketConnection(base.SocketConnection):
 
-    """Micos-specific ethernet connection."""
+    """Micos-specific ethernet connection. Requests by :meth:`execute` are served one after another
+    by their priority, :data:`URGENT` requests (e.g. checking that a stop succeeded) go before
+    :data:`NORMAL` ones (commands, position reads), which go before :data:`POLL` ones (state
+    polling). Every request waits *sleep_between* after sending before it reads the reply, unless it
+    is urgent or an urgent request is waiting, in which case it starts reading right away. Either
+    way the reply is read up to the return sequence before the lock is released, so that no part
+    of it is left for the next request. A request cancelled in between (e.g. by a timeout) drops
+    the connection for the same reason, the next request reconnects. Commands without a reply (e.g.
+    Stop) are sent immediately by :meth:`send`.
+    """
 
     def __init__(self, host, port, sleep_between=0.1*q.s):
         super(SocketConnection, self).__init__(host, port, return_sequence='\r\n')
         self.sleep_between = sleep_between
+        self.lock = PriorityLock()
         self._initialized = False
 
+    async def close(self):
+        if self._writer:
+            await super().close()
+            self._reader = self._writer = None
+            self._initialized = False
+
     async def send(self, data):
         if not self._initialized:
             LOG.debug("Flushing Micos server: %s", await self.recv())
             self._initialized = True
         await super().send(data)
 
-    async def execute(self, data):
-        """Send *data*, get and interpret the response."""
-        async with self.lock:
+    async def recv_line(self):
+        """Read one reply up to the return sequence, which is stripped."""
+        if not self._reader:
+            await self.connect()
+
+        sequence = self.return_sequence.encode('ascii')
+        try:
+            result = await self._reader.readuntil(sequence)
+        except asyncio.IncompleteReadError as error:
+            raise MicosConnectionError('Connection closed with partial reply {}'.format(
+                error.partial)) from error
+        result = result[:-len(sequence)].decode('ascii')
+        LOG.debug('Received %s', result)
+
+        return result
+
+    async def execute(self, data, priority=NORMAL):
+        """Send *data* with *priority*, get and interpret the response."""
+        await self.lock.acquire(priority)
+        try:
             await self.send(data)
-            await asyncio.sleep(self.sleep_between.to(q.s).magnitude)
-            result = await self.recv()
+            if priority != URGENT:
+                try:
+                    await asyncio.wait_for(self.lock.urgent.wait(),
+                                           self.sleep_between.to(q.s).magnitude)
+                except asyncio.TimeoutError:
+                    pass
+            result = await self.recv_line()
+        except asyncio.CancelledError:
+            # The reply may still arrive and would be taken for the reply to the next request
+            if self._writer:
+                self._writer.close()
+            self._reader = self._writer = None
+            self._initialized = False
+            raise
+        finally:
+            self.lock.release()
 
         return result
 
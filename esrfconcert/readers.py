@@ -0,0 +1,155 @@
+"""Fast reading of stored image sequences for offline reprocessing.
+
+Usage::
+
+    # Feed a finished scan into the consumers attached to the experiment acquisitions
+    await replay(ex, '/path/to/scan', num_workers=8)
+
+    # Or read every 4th projection of a region of interest
+    source = ReplaySource('/path/to/scan/radios', stride=4, roi=(slice(500, 1500), None))
+    async for image in source():
+        ...
+"""
+import asyncio
+import collections
+import glob
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from concert.coroutines.base import broadcast
+from concert.helpers import ImageWithMetadata
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _get_data_offset(page):
+    """Return the file offset of the data of tifffile *page* if it can be memory mapped, otherwise
+    None.
+    """
+    if hasattr(page, 'is_memmappable'):
+        return page.dataoffsets[0] if page.is_memmappable else None
+    # Older tifffile versions provide (offset, size) of uncompressed contiguous data
+    if page.is_contiguous and page.compression in (1, None):
+        return page.is_contiguous[0]
+
+
+class TiffStack(object):
+
+    """Random access to all pages of the TIFF files matching *pattern* (a directory means all
+    `*.tif` files in it), sorted by file name. Uncompressed pages stored contiguously are read
+    through a memory map, so that only the bytes of the requested region are read from disk, other
+    pages are decoded by tifffile. Metadata stored as JSON in the page description are attached
+    to the images.
+    """
+
+    def __init__(self, pattern):
+        import tifffile
+
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.tif')
+        filenames = sorted(glob.glob(pattern))
+        if not filenames:
+            raise ReaderError("No files matching `{}' found".format(pattern))
+        # One (filename, page index, data offset, shape, dtype, description) entry per page, the
+        # offset is None for pages which cannot be memory mapped
+        self._pages = []
+        for filename in filenames:
+            with tifffile.TiffFile(filename) as tif:
+                for index, page in enumerate(tif.pages):
+                    offset = _get_data_offset(page)
+                    self._pages.append((filename, index, offset, page.shape, page.dtype,
+                                        page.description))
+
+    def __len__(self):
+        return len(self._pages)
+
+    def read(self, index, roi=None):
+        """Read image *index*, *roi* is a tuple of (row slice, column slice), None means all."""
+        filename, page_index, offset, shape, dtype, description = self._pages[index]
+        roi = tuple(slice(None) if item is None else item for item in (roi or (None, None)))
+        if offset is not None:
+            # Copy the region out of the map, the copy reads only the needed rows
+            image = np.array(np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                                       shape=shape)[roi])
+        else:
+            import tifffile
+
+            image = tifffile.imread(filename, key=page_index)[roi]
+        image = image.view(ImageWithMetadata)
+        try:
+            image.metadata = json.loads(description)
+            image.metadata.pop('shape', None)
+        except ValueError:
+            pass
+
+        return image
+
+
+class ReplaySource(object):
+
+    """Asynchronous producer of the images stored in *pattern* (see :class:`TiffStack`). Images
+    *first*, *first* + *stride*, ... (at most *num* of them) cropped to *roi* (a tuple of row and
+    column slices) are read by *num_workers* threads, which read up to *prefetch* images ahead of
+    the consumer. Images are produced in order. Call the object to get the producer.
+    """
+
+    def __init__(self, pattern, num_workers=4, prefetch=16, first=0, num=None, stride=1,
+                 roi=None):
+        self.stack = TiffStack(pattern)
+        self.num_workers = num_workers
+        self.prefetch = max(prefetch, num_workers)
+        self.indices = range(first, len(self.stack), stride)
+        if num is not None:
+            self.indices = self.indices[:num]
+        self.roi = roi
+
+    def __len__(self):
+        return len(self.indices)
+
+    async def __call__(self):
+        loop = asyncio.get_running_loop()
+        indices = iter(self.indices)
+        pending = collections.deque()
+
+        def submit():
+            for index in indices:
+                pending.append(loop.run_in_executor(executor, self.stack.read, index, self.roi))
+                return
+
+        executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        try:
+            for i in range(self.prefetch):
+                submit()
+            while pending:
+                image = await pending.popleft()
+                submit()
+                yield image
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+async def replay(experiment, directory, **kwargs):
+    """Feed the images stored by an image writer under *directory* (one subdirectory per
+    acquisition) into the consumers of the corresponding acquisitions of *experiment*, in the
+    order of the acquisitions, without running any device. Acquisitions without stored images are
+    skipped. *kwargs* are passed to :class:`ReplaySource`.
+    """
+    for acq in experiment.acquisitions:
+        path = os.path.join(directory, acq.name)
+        if not os.path.isdir(path) or not acq.consumers:
+            continue
+        source = ReplaySource(path, **kwargs)
+        LOG.info('Replaying %d images of %s', len(source), acq.name)
+        await asyncio.gather(*broadcast(source(), *acq.consumers))
+
+
+class ReaderError(Exception):
+
+    """Raised when images cannot be read."""
+
+    pass
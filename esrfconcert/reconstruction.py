@@ -0,0 +1,131 @@
+"""Reconstruction helpers for laminography.
+
+Usage::
+
+    result = await optimize_lamino_parameters(reco.manager, zs=[-100, 0, 100])
+    args.axis_angle_x = [result.axis_angle_x.to(q.rad).magnitude]
+    args.center_position_x = [result.center_position_x]
+    print(result.timings)
+
+    # Before the next scan of a bidirectional continuous laminography (the ScanDirection add-on
+    # does this automatically)
+    set_scan_direction(args, await ex.get_direction())
+    await ex.run()
+"""
+import logging
+import time
+import numpy as np
+from concert.coroutines.base import async_generate
+from concert.quantities import q
+from esrfconcert.imageprocessing import sharpness
+
+
+LOG = logging.getLogger(__name__)
+
+
+class LaminoParameters(object):
+
+    """Result of :func:`optimize_lamino_parameters`. *axis_angle_x* is the lamino angle,
+    *center_position_x* the rotation center in pixels, *scores* a dictionary mapping parameter names
+    to lists of (values, scores) tuples, one per refinement iteration and *timings* a dictionary
+    with time spent in backprojection, scoring and in total.
+    """
+
+    def __init__(self, axis_angle_x, center_position_x, scores, timings):
+        self.axis_angle_x = axis_angle_x
+        self.center_position_x = center_position_x
+        self.scores = scores
+        self.timings = timings
+
+    def __repr__(self):
+        return 'LaminoParameters(axis_angle_x={}, center_position_x={}, timings={})'.format(
+            self.axis_angle_x, self.center_position_x, self.timings)
+
+
+async def _search(manager, parameter, attribute, best, half_range, num_steps, num_iterations,
+                  zs, metric, timings):
+    """Coarse-to-fine search of *parameter* (reco argument name, e.g. 'axis-angle-x') stored in
+    *attribute* of the reco args around *best*. Every iteration shrinks the range to two steps
+    around the best value.
+    """
+    args = manager.args
+    iterations = []
+
+    for i in range(num_iterations):
+        step = 2 * half_range / (num_steps - 1)
+        # Stop half a step after the last value to include it in the region
+        region = [best - half_range, best + half_range + step / 2, step]
+        values = np.arange(*region)[:num_steps]
+        args.z_parameter = parameter
+        args.region = [float(value) for value in region]
+        scores = np.zeros(len(values))
+
+        for z in zs:
+            args.z = z
+            start = time.perf_counter()
+            await manager.backproject(async_generate(manager.projections))
+            timings['backprojection'] += time.perf_counter() - start
+            start = time.perf_counter()
+            scores += sharpness(np.asarray(manager.volume)[:len(values)], metric=metric)
+            timings['scoring'] += time.perf_counter() - start
+
+        best = float(values[np.argmax(scores)])
+        iterations.append((values, scores))
+        LOG.debug('%s iteration %d: best value %g in [%g, %g]', parameter, i, best,
+                  values[0], values[-1])
+        half_range = step
+        setattr(args, attribute, [best])
+
+    return best, iterations
+
+
+async def optimize_lamino_parameters(manager, angle_range=5 * q.deg, center_range=20,
+                                     num_steps=11, num_iterations=3, zs=(0,), metric='gradient'):
+    """Find the laminographic angle and the rotation center by backprojecting already acquired
+    projections stored in the :class:`concert.ext.ufo.GeneralBackprojectManager` *manager* over a
+    parameter grid. The current reco arguments are the starting point, the angle is searched in
+    +/- *angle_range* and the center in +/- *center_range* pixels, each on a grid with *num_steps*
+    values which is narrowed around the best value *num_iterations* times. Slices at every z in *zs*
+    are scored by :func:`esrfconcert.imageprocessing.sharpness` with *metric* and the scores are
+    summed. The angle is optimized first, then the center with the optimal angle. The reco arguments
+    are restored afterwards. Return :class:`LaminoParameters`.
+    """
+    if num_steps < 3:
+        raise ValueError('At least three steps are needed to narrow the grid')
+
+    args = manager.args
+    original = {name: getattr(args, name) for name in
+                ['z_parameter', 'region', 'z', 'axis_angle_x', 'center_position_x']}
+    timings = {'backprojection': 0, 'scoring': 0}
+    scores = {}
+    start = time.perf_counter()
+
+    try:
+        angle, scores['axis-angle-x'] = await _search(
+            manager, 'axis-angle-x', 'axis_angle_x', args.axis_angle_x[0],
+            angle_range.to(q.rad).magnitude, num_steps, num_iterations, zs, metric, timings)
+        center, scores['center-position-x'] = await _search(
+            manager, 'center-position-x', 'center_position_x', args.center_position_x[0],
+            center_range, num_steps, num_iterations, zs, metric, timings)
+    finally:
+        for name, value in original.items():
+            setattr(args, name, value)
+
+    timings['total'] = time.perf_counter() - start
+    LOG.info('Optimal lamino angle: %g deg, center: %g, took %.1f s',
+             np.rad2deg(angle), center, timings['total'])
+
+    return LaminoParameters(angle * q.rad, center, scores, timings)
+
+
+def set_scan_direction(args, direction):
+    """Adapt reco *args* to projections of a continuous scan in *direction* (1 or -1, see
+    :class:`esrfconcert.experiments.laminography.ContinuousLaminography`). Projections of a reversed
+    scan come in descending angle order, so the overall angle becomes negative and the volume is
+    rotated by the angular range to compensate for the first projection being at its end.
+    """
+    if direction not in [1, -1]:
+        raise ValueError('direction must be 1 or -1')
+    angular_range = abs(args.overall_angle)
+    args.overall_angle = direction * angular_range
+    args.volume_angle_z = [0.0 if direction == 1 else angular_range]
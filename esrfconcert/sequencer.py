@@ -0,0 +1,146 @@
+"""Declarative sequences of dependent device actions.
+
+A :class:`Sequence` consists of named :class:`Step` objects. Every step starts as soon as all the
+steps it depends on are finished, so independent steps run concurrently. Interlocks are coroutine
+functions which raise :class:`InterlockError` if an action must not be executed. Interlocks of the
+sequence are checked before anything is started, interlocks of a step right before the step, so
+that a violation stops the sequence before any unsafe motion. Steps using the same resource, e.g.
+axes of one motor controller, never run at the same time.
+"""
+import asyncio
+import logging
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Step(object):
+
+    """A step *name* of a :class:`Sequence` executing coroutine function *func* without arguments.
+    *after* is a list of step names which must be finished before this one starts and
+    *interlocks* a list of coroutine functions without arguments which raise
+    :class:`InterlockError` if the step must not be executed. Steps with the same *resource* (any
+    hashable, None means no resource) are executed one after another.
+    """
+
+    def __init__(self, name, func, after=(), interlocks=(), resource=None):
+        self.name = name
+        self.func = func
+        self.after = tuple(after)
+        self.interlocks = tuple(interlocks)
+        self.resource = resource
+
+    def __repr__(self):
+        return 'Step({}, after={})'.format(self.name, list(self.after))
+
+
+class Sequence(object):
+
+    """A dependency graph of :class:`Step` objects *steps* guarded by *interlocks*, which are
+    coroutine functions without arguments checked before any step is started.
+    """
+
+    def __init__(self, steps, interlocks=()):
+        self.steps = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise SequenceError("Duplicate step `{}'".format(step.name))
+            self.steps[step.name] = step
+        self.interlocks = tuple(interlocks)
+        self.timings = {}
+        self._check_graph()
+
+    def _check_graph(self):
+        """Make sure all dependencies exist and that there are no cycles."""
+        for step in self.steps.values():
+            for name in step.after:
+                if name not in self.steps:
+                    raise SequenceError("Step `{}' depends on unknown step `{}'".format(step.name,
+                                                                                       name))
+        visited = set()
+        path = []
+
+        def visit(name):
+            if name in path:
+                raise SequenceError('Cyclic dependency: {}'.format(
+                    ' -> '.join(path[path.index(name):] + [name])))
+            if name in visited:
+                return
+            path.append(name)
+            for dependency in self.steps[name].after:
+                visit(dependency)
+            path.pop()
+            visited.add(name)
+
+        for name in self.steps:
+            visit(name)
+
+    async def _run_step(self, step, tasks, locks):
+        if step.after:
+            await asyncio.gather(*[tasks[name] for name in step.after])
+        async with locks[step.resource]:
+            for interlock in step.interlocks:
+                await interlock()
+            start = time.perf_counter()
+            LOG.debug('Starting step %s', step.name)
+            await step.func()
+            self.timings[step.name] = time.perf_counter() - start
+        LOG.debug('Step %s finished in %.3f s', step.name, self.timings[step.name])
+
+    async def run(self):
+        """Check the interlocks and run all steps, each one as soon as its dependencies are
+        finished. If any interlock or step fails, the ones which have not finished yet are
+        cancelled and the exception is re-raised.
+        """
+        await _gather([asyncio.ensure_future(interlock()) for interlock in self.interlocks])
+        self.timings = {}
+        start = time.perf_counter()
+        locks = {step.resource: asyncio.Lock() for step in self.steps.values()}
+        locks[None] = _Unlimited()
+        # Tasks do not start before the first await, so all of them exist by the time any step
+        # looks up its dependencies.
+        tasks = {}
+        for step in self.steps.values():
+            tasks[step.name] = asyncio.ensure_future(self._run_step(step, tasks, locks))
+
+        try:
+            await _gather(list(tasks.values()))
+        finally:
+            self.timings['total'] = time.perf_counter() - start
+
+
+class _Unlimited(object):
+
+    """Context manager standing in for the lock of steps without a resource."""
+
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+async def _gather(tasks):
+    """Wait for all *tasks*, if one of them fails, cancel the others and re-raise."""
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class SequenceError(Exception):
+
+    """Raised for invalid sequence definitions."""
+
+    pass
+
+
+class InterlockError(Exception):
+
+    """Raised by interlocks when an action must not be executed."""
+
+    pass
@@ -20,7 +20,77 @@ Usage:
     args.z_parameter = 'z'
     args.region = [0.0, 1.0, 0.0] # Do not forget the decimal points!
     await reco.manager.backproject(async_generate(reco.manager.projections))
+
+    # Or let the lamino angle and center be found automatically
+    result = await optimize_lamino_parameters(reco.manager, angle_range=5 * q.deg, zs=[0])
+    args.axis_angle_x = [result.axis_angle_x.to(q.rad).magnitude]
+    args.center_position_x = [result.center_position_x]
+
+Camera ROI
+----------
+
+    # Propose the smallest ROI containing the sample during the scan, apply=True sets it
+    plan = await plan_roi(ex, num_angles=8, margin=32)
+    print(plan)
+    await plan.apply(camera)
+
+Sample centering
+----------------
+
+    # Center the sample over lamino_rot, pushers and magnets are handled automatically
+    result = await center_sample(ex, sample_motor, manipulator, pixel_size=1.1 * q.um)
+    print(result)
+
+Soft limits
+-----------
+
+    # Raster sequences and pseudo motor vectors are checked against the cached controller limits
+    # before anything moves, nothing is checked if the controller does not report its limits
+    limits = await pseudo_motor.get_limits()
+    limits.validate([[10, 50, 50], [40, 50, 50]])  # Raises SoftLimitError for the second point
+    # Setup specific restrictions are kept when the limits are queried again
+    pseudo_motor.restrict_limits(0, upper=32)
+    await pseudo_motor.get_limits(refresh=True)
+
+Flat and dark statistics
+------------------------
+
+    # Running mean, variance, saturation and hot pixel maps, bad flats are reported on the fly
+    async def use_mean(name, statistics):
+        if name == 'flats':
+            await reco.manager.update_flats(async_generate([statistics.mean]))
+    references = ReferenceStatistics(ex, callbacks=[use_mean])
+    references.statistics['flats'].variance
+    references.bad_flats
+
+Projection quality
+------------------
+
+    # Pause the scan if the intensity drops for 10 frames, resume when the problem is fixed
+    ex.checkpoint = ScanCheckpoint(walker.current + '/checkpoint.json')
+    monitor = QualityMonitor(ex, rules=[QualityRule('relative_mean', lower=0.5, num_frames=10,
+                                                    action='pause')])
+    await ex.resume()
+    monitor.metrics['radios']['shift']
+
+Reprocessing stored data
+------------------------
+
+    # Feed a finished scan into the consumers attached to ex (e.g. reco, monitor) at disk speed
+    await replay(ex, '/path/to/scan', num_workers=8, prefetch=32)
+
+Reconstruction in a separate process
+------------------------------------
+
+    # Instead of OnlineReconstruction, frames are passed through shared memory
+    reco = ProcessReconstruction(ex, args, num_slots=256)
+    await ex.run().join()
+    volume = await reco.get_volume()
+    await reco.shutdown()
 """
+import time
+# Taken before the other imports, which dominate the startup, so that the profile includes them
+SESSION_START = time.perf_counter()
 from numpy import asarray_chkfinite
 import asyncio
 import logging
@@ -42,12 +112,19 @@ from concert.experiments.addons import Consumer, ImageWriter
 from concert.storage import DummyWalker, DirectoryWalker
 from concert.ext.ufo import GeneralBackprojectArgs, GeneralBackprojectManager
 from concert.experiments.addons import Consumer, OnlineReconstruction
+from esrfconcert.alignment import center_sample, plan_roi
+from esrfconcert.experiments.addons import (ProcessReconstruction, QualityMonitor, QualityRule,
+                                           ReferenceStatistics, ScanDirection, Telemetry)
+from esrfconcert.experiments.checkpoint import ScanCheckpoint
 from esrfconcert.experiments.laminography import ContinuousLaminography
+from esrfconcert.reconstruction import optimize_lamino_parameters
 from esrfconcert.devices.motors.micos import (
     ContinuousLinearMotor,
     ContinuousRotationMotor,
     LaminoScanningMotor,
+    MagnetsInException,
     PseudoMotor,
+    SampleManipulator,
     SampleMotor,
     SampleManipulationMotor
 )
@@ -56,7 +133,10 @@ from esrfconcert.devices.motors.bliss import (
     ContinuousRotationMotor as BlissRotationMotor
 )
 # from esrfconcert.devices.motors.sampletranslation import (move_sample_x, move_sample_y)
+from esrfconcert.helpers import StartupProfile
+from esrfconcert.readers import replay
 from esrfconcert.networking.micos import SocketConnection
+from esrfconcert.watchdog import StallWatchdog
 from pco_camera import Camera as Edge
 from pco_camera import PCOTimestampCheck
 
@@ -72,35 +152,53 @@ concert.config.PROGRESS_BAR = False
 micos_connection = ('172.29.30.162', 6542)
 steps_per_degree = 26222
 
-# scanning rotation motor
-# TO CHECK: INDECES CORRECT? IN ANDREI'S SCRIPT CONSTRUCTORS ARE CALLED WITH INDEX-1?!
-# sample translation motors
-# puscher
-sx45 = await SampleManipulationMotor('Sam', 0, micos_connection[0], micos_connection[1],
-                               in_position=140.0 * q.mm, out_position=0 * q.mm)
-sy45 = await SampleManipulationMotor('Sam', 1, micos_connection[0], micos_connection[1],
-                               in_position=140.0 * q.mm, out_position=0 * q.mm)
-# magnets
-px45 = await SampleManipulationMotor('Sam', 2, micos_connection[0], micos_connection[1],
-                               in_position=0.9 * q.mm, out_position=0.0 * q.mm)
-py45 = await SampleManipulationMotor('Sam', 3, micos_connection[0], micos_connection[1],
-                               in_position=0.9 * q.mm, out_position=0.0 * q.mm)
-# scanning rotation motor
+profile = StartupProfile(start=SESSION_START)
+profile.record('import', 'session imports', SESSION_START)
+
+# The Micos constructors do not talk to the controller, creating them together only keeps the
+# setup in one place and their entries in the profile, it does not save time
 # TO CHECK: INDECES CORRECT? IN ANDREI'S SCRIPT CONSTRUCTORS ARE CALLED WITH INDEX-1?!
-lamino_rot = await LaminoScanningMotor('Sam', 4, micos_connection[0], micos_connection[1], sx45, sy45)
-lamino_tilt = await ContinuousRotationMotor('Cont2', 0, micos_connection[0], micos_connection[1])
+devices = await profile.create_devices(
+    # pushers
+    sx45=SampleManipulationMotor('Sam', 0, micos_connection[0], micos_connection[1],
+                                 in_position=140.0 * q.mm, out_position=0 * q.mm),
+    sy45=SampleManipulationMotor('Sam', 1, micos_connection[0], micos_connection[1],
+                                 in_position=140.0 * q.mm, out_position=0 * q.mm),
+    # magnets
+    px45=SampleManipulationMotor('Sam', 2, micos_connection[0], micos_connection[1],
+                                 in_position=0.9 * q.mm, out_position=0.0 * q.mm),
+    py45=SampleManipulationMotor('Sam', 3, micos_connection[0], micos_connection[1],
+                                 in_position=0.9 * q.mm, out_position=0.0 * q.mm),
+    lamino_tilt=ContinuousRotationMotor('Cont2', 0, micos_connection[0], micos_connection[1]),
+    pseudo_motor=PseudoMotor('Cont2', micos_connection[0], micos_connection[1]),
+)
+sx45 = devices['sx45']
+sy45 = devices['sy45']
+px45 = devices['px45']
+py45 = devices['py45']
+lamino_tilt = devices['lamino_tilt']
+pseudo_motor = devices['pseudo_motor']
 await lamino_tilt['position'].set_upper(32 * q.deg)
-pseudo_motor = await PseudoMotor('Cont2', micos_connection[0], micos_connection[1])
-sample_motor = await SampleMotor(
-    'Cont2',
-    micos_connection[0],
-    micos_connection[1],
-    sx45,
-    sy45,
-    px45,
-    py45,
-    lamino_tilt
+# The same for moves of all Cont2 axes at once by pseudo_motor and sample_motor
+pseudo_motor.restrict_limits(0, upper=32)
+
+# Devices depending on the ones above
+devices = await profile.create_devices(
+    # scanning rotation motor
+    lamino_rot=LaminoScanningMotor('Sam', 4, micos_connection[0], micos_connection[1], sx45, sy45),
+    sample_motor=SampleMotor(
+        'Cont2',
+        micos_connection[0],
+        micos_connection[1],
+        sx45,
+        sy45,
+        px45,
+        py45,
+        lamino_tilt
+    ),
 )
+lamino_rot = devices['lamino_rot']
+sample_motor = devices['sample_motor']
 
 
 async def get_pusher_positions():
@@ -110,49 +208,15 @@ async def get_pusher_positions():
     return (pos_x, pos_y)
 
 
-class MagnetsInException(Exception):
-    pass
-
 air_connection = SocketConnection(micos_connection[0], micos_connection[1])
-
-
-async def air_on():
-    await air_connection.send('Dmc2143 sendcommand SB 1')
-
-
-async def air_off():
-    await air_connection.send('Dmc2143 sendcommand CB 1')
-
-
-async def move_pushers_out():
-    if await px45.get_state() != 'out':
-        await px45.move_out()
-    if await py45.get_state() != 'out':
-        await py45.move_out()
-
-    await air_off()
-    await sx45['position'].stash()
-    await sy45['position'].stash()
-    await sx45.move_out()
-    await sy45.move_out()
-
-
-async def move_pushers_in():
-    if np.abs((await lamino_rot.get_position()).to(q.deg).magnitude + 90) > 0.1:
-        raise RuntimeError("lamino_rot not in 0 deg")
-    if await px45.get_state() == 'out' and await py45.get_state() == 'out':
-        await sx45['position'].restore()
-        await sy45['position'].restore()
-        await px45.move_in()
-        await py45.move_in()
-        await air_on()
-    else:
-        raise MagnetsInException('Magnets are still in')
-
-
-async def move_magnets_out():
-    await px45.move_out()
-    await py45.move_out()
+# All pushers and magnets are on the Sam controller and move one after another, pass
+# concurrent_axes=True once the controller is known to accept commands while an axis moves
+manipulator = SampleManipulator(sx45, sy45, px45, py45, lamino_rot, air_connection)
+air_on = manipulator.air_on
+air_off = manipulator.air_off
+move_pushers_out = manipulator.move_pushers_out
+move_pushers_in = manipulator.move_pushers_in
+move_magnets_out = manipulator.move_magnets_out
 
 
 def get_timestamps(images=None, path=None):
@@ -249,7 +313,7 @@ shutter = await DummyShutter()
 # rot_motor = await DummyContinuousRotationMotor()
 
 # Real deal
-camera = await Edge('net')
+camera = await profile.create_device('camera', Edge('net'))
 await camera.set_timestamp_mode(camera.uca.enum_values.timestamp_mode.BINARY)
 await camera.set_trigger_source('AUTO')
 rot_motor = lamino_rot
@@ -288,6 +352,10 @@ args.axis_angle_x = [(await ex.get_radio_position()).to(q.rad).magnitude]
 # args.axis_angle_x = [float(np.deg2rad(30.5))]
 manager = GeneralBackprojectManager(args)
 reco = await OnlineReconstruction(ex, args, do_normalization=True, average_normalization=True)
+# Reconstruct reversed scans of ex.bidirectional = True correctly
+scan_direction = ScanDirection(ex, args)
+# Must come after all other addons
+telemetry = Telemetry(ex, motors={'lamino_rot': lamino_rot})
 # To Do:
 # treat rotation position as pusher positions!
 # write shutdown routine:
@@ -302,9 +370,9 @@ reco = await OnlineReconstruction(ex, args, do_normalization=True, average_norma
 #############################
 
 #from bliss.setup_globals import *
-from bliss.common import session
-from bliss.config import static
-from bliss.shell import standard
+static = profile.import_module('bliss.config.static')
+# Only needed for interactive use, e.g. standard.wa(), imported on first access
+standard = profile.import_lazily('bliss.shell.standard')
 
 blissConfig = static.get_config()
 
@@ -313,20 +381,32 @@ blissConfig = static.get_config()
 # - shutters: frontend, bsh1, bsh2
 # - storage ring: machinfo
 
-blissSessionLamino =  blissConfig.get('lamino')
-blissSessionLamino.setup()
-
-# Microscope translation motors
-lmy = await BlissLinearMotor(blissSessionLamino.env_dict['lmy'])
-lmz = await BlissLinearMotor(blissSessionLamino.env_dict['lmz'])
-
-# Detector tanslation motors
-cx = await BlissLinearMotor(blissSessionLamino.env_dict['cx'])
-cy = await BlissLinearMotor(blissSessionLamino.env_dict['cy'])
-cz = await BlissLinearMotor(blissSessionLamino.env_dict['cz'])
-
-# Optics motors
-rotc1p29A = await BlissRotationMotor(blissSessionLamino.env_dict['rotc1p29A'])
+with profile.measure('session', 'lamino'):
+    blissSessionLamino =  blissConfig.get('lamino')
+    blissSessionLamino.setup()
+
+devices = await profile.create_devices(
+    # Microscope translation motors
+    lmy=BlissLinearMotor(blissSessionLamino.env_dict['lmy']),
+    lmz=BlissLinearMotor(blissSessionLamino.env_dict['lmz']),
+    # Detector tanslation motors
+    cx=BlissLinearMotor(blissSessionLamino.env_dict['cx']),
+    cy=BlissLinearMotor(blissSessionLamino.env_dict['cy']),
+    cz=BlissLinearMotor(blissSessionLamino.env_dict['cz']),
+    # Optics motors
+    rotc1p29A=BlissRotationMotor(blissSessionLamino.env_dict['rotc1p29A']),
+    # Shutters
+    fast_shutter=BlissShutter(blissSessionLamino.env_dict['exp_shutter']),
+    experiment_shutter=BlissShutter(blissSessionLamino.env_dict['bsh2']),
+)
+lmy = devices['lmy']
+lmz = devices['lmz']
+cx = devices['cx']
+cy = devices['cy']
+cz = devices['cz']
+rotc1p29A = devices['rotc1p29A']
+fast_shutter = devices['fast_shutter']
+experiment_shutter = devices['experiment_shutter']
 #rotc0p3A = await BlissRotationMotor(blissSessionLamino.env_dict['rotc0p3A'])
 #rotc0p6A = await BlissRotationMotor(blissSessionLamino.env_dict['rotc0p6A'])
 
@@ -353,12 +433,17 @@ machinfo = blissSessionLamino.env_dict['machinfo']
 # simmot1 = await BlissLinearMotor(blissSessionJens.env_dict['simmot1'])
 # simmot2 = await BlissLinearMotor(blissSessionJens.env_dict['simmot2'])
 
-# Shutters
-fast_shutter = await BlissShutter(blissSessionLamino.env_dict['exp_shutter'])
-experiment_shutter = await BlissShutter(blissSessionLamino.env_dict['bsh2'])
-
 #################################
 ### Bliss beamline components end
 #################################
 
 ex._shutter = experiment_shutter
+LOG.info('Session startup profile:\n%s', profile)
+
+# Report event loop stalls caused by devices, print(watchdog) shows the statistics
+watchdog = StallWatchdog(threshold=50 * q.ms, devices={
+    'sx45': sx45, 'sy45': sy45, 'px45': px45, 'py45': py45, 'lamino_rot': lamino_rot,
+    'lamino_tilt': lamino_tilt, 'sample_motor': sample_motor, 'lmy': lmy, 'lmz': lmz,
+    'cx': cx, 'cy': cy, 'cz': cz, 'rotc1p29A': rotc1p29A, 'fast_shutter': fast_shutter,
+    'experiment_shutter': experiment_shutter})
+watchdog.start()
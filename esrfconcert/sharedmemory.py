@@ -0,0 +1,133 @@
+"""Passing images between processes through shared memory."""
+import logging
+import multiprocessing
+import numpy as np
+from multiprocessing.shared_memory import SharedMemory
+
+
+LOG = logging.getLogger(__name__)
+
+
+class SharedRingBuffer(object):
+
+    """Single producer, single consumer ring buffer of *num_slots* slots holding up to *slot_size*
+    bytes each in shared memory. Every slot has a header with an integer *kind* and *index* of the
+    item, its shape and dtype, so images are transferred without pickling. The producer copies an
+    image into a free slot by :meth:`write` after a successful :meth:`reserve` and the consumer gets
+    a numpy array viewing the slot memory by :meth:`read`, which is valid until :meth:`release`.
+
+    The buffer is passed to another process as an argument of :class:`multiprocessing.Process`,
+    *context* is the multiprocessing context used to create the process (default context if None).
+    The creating process must call :meth:`unlink` when the buffer is not needed anymore.
+    """
+
+    # kind, index, ndim, shape[0], shape[1], shape[2], dtype character
+    _HEADER_LENGTH = 7
+    _MAX_NDIM = 3
+
+    def __init__(self, num_slots, slot_size, context=None):
+        if context is None:
+            context = multiprocessing
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        header_size = num_slots * self._HEADER_LENGTH * 8
+        self._shm = SharedMemory(create=True, size=header_size + num_slots * slot_size)
+        self._free = context.Semaphore(num_slots)
+        self._filled = context.Semaphore(0)
+        self._setup()
+
+    def _setup(self):
+        self._headers = np.ndarray((self.num_slots, self._HEADER_LENGTH), dtype=np.int64,
+                                   buffer=self._shm.buf)
+        self._data_offset = self._headers.nbytes
+        # Positions are local to the producer and the consumer respectively
+        self._write_position = 0
+        self._read_position = 0
+        self._reserved = False
+
+    def __getstate__(self):
+        return (self.num_slots, self.slot_size, self._shm.name, self._free, self._filled)
+
+    def __setstate__(self, state):
+        self.num_slots, self.slot_size, name, self._free, self._filled = state
+        self._shm = SharedMemory(name=name)
+        self._setup()
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def reserve(self, block=True, timeout=None):
+        """Reserve a free slot for :meth:`write`. If *block* is False or *timeout* (in seconds)
+        expires, return False if there is no free slot, otherwise True.
+        """
+        if not self._reserved:
+            self._reserved = self._free.acquire(block, timeout)
+
+        return self._reserved
+
+    def write(self, kind, index=0, image=None):
+        """Write *image* (None for messages without data) of *kind* and *index* into the reserved
+        slot and hand it over to the consumer.
+        """
+        if not self._reserved:
+            raise SharedMemoryError('No slot reserved')
+        header = self._headers[self._write_position]
+        header[:] = 0
+        header[0] = kind
+        header[1] = index
+        if image is not None:
+            image = np.asarray(image)
+            if image.nbytes > self.slot_size or image.ndim > self._MAX_NDIM:
+                raise SharedMemoryError('Image of shape {} and dtype {} does not fit into a slot '
+                                        'of {} bytes'.format(image.shape, image.dtype,
+                                                             self.slot_size))
+            header[2] = image.ndim
+            header[3:3 + image.ndim] = image.shape
+            header[6] = ord(image.dtype.char)
+            np.copyto(self._get_view(self._write_position, image.shape, image.dtype), image)
+        self._write_position = (self._write_position + 1) % self.num_slots
+        self._reserved = False
+        self._filled.release()
+
+    def read(self, block=True, timeout=None):
+        """Wait for the next slot and return a tuple (kind, index, image), where image is None for
+        messages without data. If *block* is False or *timeout* (in seconds) expires, return None
+        if there is no slot ready.
+        """
+        if not self._filled.acquire(block, timeout):
+            return None
+        header = self._headers[self._read_position]
+        kind, index, ndim = (int(value) for value in header[:3])
+        image = None
+        if header[6]:
+            image = self._get_view(self._read_position, tuple(header[3:3 + ndim]),
+                                   np.dtype(chr(header[6])))
+
+        return (kind, index, image)
+
+    def release(self):
+        """Give the slot returned by the last :meth:`read` back to the producer."""
+        self._read_position = (self._read_position + 1) % self.num_slots
+        self._free.release()
+
+    def close(self):
+        """Close access to the shared memory in this process."""
+        self._headers = None
+        self._shm.close()
+
+    def unlink(self):
+        """Destroy the shared memory, must be called once by the creating process."""
+        self._shm.unlink()
+
+    def _get_view(self, position, shape, dtype):
+        offset = self._data_offset + position * self.slot_size
+
+        return np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset)
+
+
+class SharedMemoryError(Exception):
+
+    """Raised on shared memory misuse."""
+
+    pass
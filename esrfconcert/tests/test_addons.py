@@ -0,0 +1,265 @@
+"""Test experiment add-ons."""
+import asyncio
+import numpy as np
+from types import SimpleNamespace
+from unittest import SkipTest, TestCase
+from concert.quantities import q
+try:
+    from concert.experiments.addons import Consumer
+    from concert.experiments.base import Acquisition
+    from esrfconcert.experiments.addons import (ProcessReconstruction, ProcessReconstructionError,
+                                                QualityError, QualityMonitor, QualityRule,
+                                                ReferenceStatistics, ScanDirection, Telemetry)
+except ImportError as error:
+    # Concert without the add-on API of this package
+    raise SkipTest('Add-ons not available: {}'.format(error))
+
+
+class FakeAcquisition(object):
+
+    def __init__(self, name, producer):
+        self.name = name
+        self.producer = producer
+        self.consumers = []
+
+
+class FakeExperiment(object):
+
+    def __init__(self, producers, direction=1):
+        self.acquisitions = [FakeAcquisition(name, producer) for name, producer in producers]
+        self.direction = direction
+
+    async def get_direction(self):
+        return self.direction
+
+
+def make_producer(num, shape=(4, 4), value=None):
+    async def produce():
+        for i in range(num):
+            yield np.full(shape, i if value is None else value, dtype=np.float32)
+
+    return produce
+
+
+async def consume(producer):
+    return [image async for image in producer()]
+
+
+class CleanedProducer(object):
+
+    """Producer of *num* images, the first *num_good* of them with intensity 100 and the rest 0.
+    :attr:`cleaned` is set when the producer finishes.
+    """
+
+    def __init__(self, num, num_good, shape=(16, 16)):
+        self.num = num
+        self.num_good = num_good
+        self.shape = shape
+        self.num_produced = 0
+        self.cleaned = False
+
+    async def __call__(self):
+        try:
+            for i in range(self.num):
+                self.num_produced += 1
+                yield np.full(self.shape, 100 if i < self.num_good else 0, dtype=np.uint16)
+        finally:
+            self.cleaned = True
+
+
+class TestStopping(TestCase):
+
+    async def _make_experiment(self, name, producer):
+        acquisition = await Acquisition(name, producer)
+
+        return SimpleNamespace(acquisitions=[acquisition], walker=None)
+
+    def test_quality_abort(self):
+        async def run():
+            producer = CleanedProducer(100, 5)
+            experiment = await self._make_experiment('radios', producer)
+            QualityMonitor(experiment, rules=[QualityRule('relative_mean', lower=0.5,
+                                                          num_frames=2, action='abort')],
+                           baseline_frames=3)
+            with self.assertRaises(QualityError):
+                await asyncio.wait_for(experiment.acquisitions[0](), 10)
+
+            return producer
+
+        producer = asyncio.run(run())
+        # Stopped right after the second bad frame and cleaned up
+        self.assertEqual(producer.num_produced, 7)
+        self.assertTrue(producer.cleaned)
+
+    def test_stop_own_acquisition(self):
+        async def run():
+            bad = CleanedProducer(100, 5)
+            good = CleanedProducer(100, 100)
+            experiment = SimpleNamespace(acquisitions=[await Acquisition('radios', bad),
+                                                       await Acquisition('radios_1', good)],
+                                         walker=None)
+            QualityMonitor(experiment, rules=[QualityRule('relative_mean', lower=0.5,
+                                                          num_frames=2, action='abort')],
+                           baseline_frames=3)
+            results = await asyncio.wait_for(
+                asyncio.gather(*[acq() for acq in experiment.acquisitions],
+                               return_exceptions=True), 10)
+
+            return results, bad, good
+
+        results, bad, good = asyncio.run(run())
+        # Only the acquisition with bad frames is stopped
+        self.assertIsInstance(results[0], QualityError)
+        self.assertIsNone(results[1])
+        self.assertEqual(bad.num_produced, 7)
+        self.assertEqual(good.num_produced, 100)
+
+    def test_bad_flat_callback(self):
+        async def abort(name, index, reason):
+            raise RuntimeError('Bad flat {}'.format(index))
+
+        async def run():
+            producer = CleanedProducer(20, 4)
+            experiment = await self._make_experiment('flats', producer)
+            ReferenceStatistics(experiment, bad_flat_callback=abort, min_flats=3)
+            with self.assertRaises(RuntimeError):
+                await asyncio.wait_for(experiment.acquisitions[0](), 10)
+
+            return producer
+
+        producer = asyncio.run(run())
+        self.assertEqual(producer.num_produced, 5)
+        self.assertTrue(producer.cleaned)
+
+    def test_reconstruction_failure(self):
+        async def run():
+            producer = CleanedProducer(1000, 1000)
+            experiment = await self._make_experiment('radios', producer)
+            # The worker fails without reconstruction arguments
+            reco = ProcessReconstruction(experiment, None, num_slots=2,
+                                         policies={'radios': 'block'})
+            try:
+                with self.assertRaises(ProcessReconstructionError):
+                    await asyncio.wait_for(experiment.acquisitions[0](), 60)
+            finally:
+                await reco.shutdown()
+
+            return producer
+
+        producer = asyncio.run(run())
+        self.assertLess(producer.num_produced, 1000)
+        self.assertTrue(producer.cleaned)
+
+
+class TestScanDirection(TestCase):
+
+    def test_direction(self):
+        args = SimpleNamespace(overall_angle=2 * np.pi, volume_angle_z=[0.0])
+        experiment = FakeExperiment([('flats', make_producer(2)), ('radios', make_producer(3))])
+        ScanDirection(experiment, args)
+        experiment.direction = -1
+        asyncio.run(consume(experiment.acquisitions[0].producer))
+        self.assertEqual(args.overall_angle, 2 * np.pi)
+        self.assertEqual(len(asyncio.run(consume(experiment.acquisitions[1].producer))), 3)
+        self.assertEqual(args.overall_angle, -2 * np.pi)
+        self.assertEqual(args.volume_angle_z, [2 * np.pi])
+        experiment.direction = 1
+        asyncio.run(consume(experiment.acquisitions[1].producer))
+        self.assertEqual(args.overall_angle, 2 * np.pi)
+
+
+class TestTelemetry(TestCase):
+
+    def test_detach_order(self):
+        async def run(telemetry_first):
+            received = []
+
+            async def collect(producer):
+                async for item in producer:
+                    received.append(item)
+
+            producer = make_producer(5)
+            acquisition = await Acquisition('radios', producer)
+            experiment = SimpleNamespace(acquisitions=[acquisition], walker=None)
+            consumer = Consumer(experiment.acquisitions, collect)
+            telemetry = Telemetry(experiment)
+            await acquisition()
+            self.assertEqual(len(received), 5)
+            self.assertEqual(len(list(telemetry.records['radios'].processing_times.values())[0]),
+                             5)
+
+            if telemetry_first:
+                telemetry.detach()
+                consumer.detach()
+            else:
+                # The consumer is found although it is instrumented
+                consumer.detach()
+                # Runs without the removed consumer are still recorded
+                telemetry.reports.clear()
+                await acquisition()
+                self.assertEqual(len(received), 5)
+                self.assertEqual(telemetry.records['radios'].num_grabbed, 5)
+                self.assertIn('radios', telemetry.reports)
+                telemetry.detach()
+
+            return acquisition, producer
+
+        for telemetry_first in [True, False]:
+            acquisition, producer = asyncio.run(run(telemetry_first))
+            self.assertEqual(acquisition.consumers, [])
+            self.assertIs(acquisition.producer, producer)
+
+
+class TestProcessReconstruction(TestCase):
+
+    def setUp(self):
+        try:
+            # concert.ext.ufo imports without tofu, but cannot reconstruct
+            import tofu  # noqa: F401
+            from concert.ext.ufo import GeneralBackprojectArgs
+        except ImportError as error:
+            raise SkipTest('UFO not available: {}'.format(error))
+        self.args = GeneralBackprojectArgs([8.0], [8.5], 8, overall_angle=np.pi)
+        self.args.region = [0.0, 1.0, 1.0]
+
+    async def _feed(self, experiment):
+        for acq in experiment.acquisitions:
+            for consumer in acq.consumers:
+                await consumer(acq.producer())
+
+    def test_reconstruct(self):
+        async def run():
+            experiment = FakeExperiment([('darks', make_producer(2, (16, 16), 0)),
+                                         ('flats', make_producer(2, (16, 16), 1)),
+                                         ('radios', make_producer(8, (16, 16), 0.5))])
+            # Spawns the worker, which gets the pickled arguments
+            reco = ProcessReconstruction(experiment, self.args, num_slots=4)
+            try:
+                await self._feed(experiment)
+                volume = await reco.get_volume(timeout=60 * q.s)
+                self.assertEqual(reco.num_received_projections, 8)
+            finally:
+                await reco.shutdown()
+
+            return volume
+
+        volume = asyncio.run(run())
+        self.assertEqual(volume.shape[0], 1)
+        self.assertTrue(np.all(np.isfinite(volume)))
+
+    def test_larger_images(self):
+        async def run():
+            experiment = FakeExperiment([('darks', make_producer(2, (16, 16), 0))])
+            reco = ProcessReconstruction(experiment, self.args, num_slots=4)
+            try:
+                await self._feed(experiment)
+                pid = reco._process.pid
+                # Enlarged region of interest
+                experiment.acquisitions[0].producer = make_producer(2, (32, 32), 0)
+                await self._feed(experiment)
+                self.assertEqual(reco._ring.slot_size, 32 * 32 * 4)
+                self.assertNotEqual(reco._process.pid, pid)
+            finally:
+                await reco.shutdown()
+
+        asyncio.run(run())
@@ -0,0 +1,52 @@
+"""Test alignment routines."""
+import numpy as np
+from unittest import TestCase
+from concert.quantities import q
+from esrfconcert.alignment import (get_absorption, get_edges, get_sample_offset,
+                                   get_trajectory_extent, make_roi_plan)
+
+
+class TestRoiPlanning(TestCase):
+
+    def setUp(self):
+        # Sample moving on an ellipse around the center
+        self.angles = np.linspace(0, 360, 8, endpoint=False) * q.deg
+        self.projections = np.ones((8, 200, 300), dtype=np.float32)
+        for i, angle in enumerate(self.angles.to(q.rad).magnitude):
+            x = int(round(150 + 40 * np.cos(angle)))
+            y = int(round(100 + 10 * np.sin(angle)))
+            self.projections[i, y - 20:y + 20, x - 15:x + 15] = 0.5
+
+    def test_edges(self):
+        masks = get_absorption(self.projections, np.ones((200, 300))) > 0.1
+        edges = get_edges(masks, min_pixels=5)
+        np.testing.assert_array_equal(edges[0], [175, 204, 80, 119])
+        self.assertTrue(np.all(np.isnan(get_edges(np.zeros((1, 10, 10), dtype=bool)))))
+
+    def test_extent(self):
+        masks = get_absorption(self.projections, np.ones((200, 300))) > 0.1
+        left, right, top, bottom = get_trajectory_extent(get_edges(masks), self.angles)
+        self.assertAlmostEqual(left, 95, delta=1)
+        self.assertAlmostEqual(right, 204, delta=1)
+        self.assertAlmostEqual(top, 70, delta=1)
+        self.assertAlmostEqual(bottom, 129, delta=1)
+
+    def test_plan(self):
+        plan = make_roi_plan((95, 204, 70, 129), 300, 200, margin=4, x_step=4)
+        self.assertEqual((plan.x0, plan.width), (88, 124))
+        # Vertically centered on the sensor
+        self.assertEqual((plan.y0, plan.height), (66, 68))
+        self.assertAlmostEqual(plan.frame_rate_gain, 100 / 34)
+        self.assertAlmostEqual(plan.pixel_gain, 300 * 200 / (124 * 68))
+
+
+class TestSampleCentering(TestCase):
+
+    def test_sample_offset(self):
+        angles = np.arange(0, 360, 90) * q.deg
+        radians = angles.to(q.rad).magnitude
+        positions = 1000 + 30 * np.cos(radians) - 20 * np.sin(radians)
+        center, x, y = get_sample_offset(positions, angles)
+        self.assertAlmostEqual(center, 1000)
+        self.assertAlmostEqual(x, 30)
+        self.assertAlmostEqual(y, 20)
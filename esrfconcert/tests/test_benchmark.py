@@ -0,0 +1,50 @@
+"""Test the acquisition benchmark."""
+import asyncio
+import numpy as np
+from unittest import SkipTest, TestCase
+from concert.quantities import q
+try:
+    from esrfconcert.experiments.benchmark import (BenchmarkResult, _get_frame_rate, _RssMonitor,
+                                                   run_benchmark)
+    from esrfconcert.experiments.laminography import ContinuousLaminography
+except ImportError as error:
+    # Concert without the experiment API of this package
+    raise SkipTest('Experiments not available: {}'.format(error))
+
+
+class TestBenchmark(TestCase):
+
+    def test_frame_rate(self):
+        self.assertEqual(_get_frame_rate([]), 0)
+        self.assertEqual(_get_frame_rate([1.0]), 0)
+        self.assertEqual(_get_frame_rate([1.0, 1.0]), 0)
+        self.assertAlmostEqual(_get_frame_rate(np.arange(11) * 0.01), 100)
+
+    def test_rss_per_run(self):
+        async def allocate(size):
+            async with _RssMonitor(interval=1 * q.ms) as rss:
+                data = np.ones(size, dtype=np.uint8)
+                await asyncio.sleep(0.01)
+                del data
+
+            return rss
+
+        large = asyncio.run(allocate(64 * 2 ** 20))
+        small = asyncio.run(allocate(1))
+        self.assertGreater(large.increase, 32 * q.MiB)
+        # The previous allocation does not carry over
+        self.assertLess(small.increase, 32 * q.MiB)
+
+    def test_check(self):
+        result = BenchmarkResult('foo', 0, 2, 100 * q.MiB, 10 * q.MiB, {})
+        self.assertEqual(len(result.check(min_fps=10, max_dropped=0, max_rss=50 * q.MiB)), 3)
+        self.assertEqual(result.check(max_dropped=2, max_rss=200 * q.MiB), [])
+
+    def test_run(self):
+        # A small angular range keeps the rewind at the fixed 25 deg/s short
+        result = asyncio.run(run_benchmark(ContinuousLaminography, frame_rate=100 / q.s, width=16,
+                                           height=16, num_projections=20, num_flats=2,
+                                           num_darks=2, angular_range=10 * q.deg))
+        self.assertEqual(result.dropped_frames, 0)
+        self.assertGreater(result.fps, 0)
+        self.assertIn('radios', result.phases)
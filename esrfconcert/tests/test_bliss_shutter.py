@@ -0,0 +1,63 @@
+"""Test the Bliss shutter."""
+import asyncio
+import time
+from unittest import TestCase
+from concert.quantities import q
+from esrfconcert.devices.shutters.bliss import Shutter, ShutterError
+
+
+class State(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class BlissShutter(object):
+
+    """Shutter reaching the commanded state after *latency* seconds."""
+
+    name = 'shutter'
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.target = 'CLOSED'
+        self.time = 0
+
+    def open(self):
+        self.target = 'OPEN'
+        self.time = time.perf_counter()
+
+    def close(self):
+        self.target = 'CLOSED'
+        self.time = time.perf_counter()
+
+    @property
+    def state(self):
+        return State(self.target if time.perf_counter() - self.time > self.latency else 'MOVING')
+
+
+class TestShutter(TestCase):
+
+    def test_open_close(self):
+        async def main():
+            shutter = await Shutter(BlissShutter())
+            self.assertIsNone(await shutter.get_open_latency())
+            for i in range(3):
+                await shutter.open()
+                self.assertEqual(await shutter.get_state(), 'open')
+                await shutter.close()
+                self.assertEqual(await shutter.get_state(), 'closed')
+
+            return await shutter.get_open_latency()
+
+        latency = asyncio.run(main())
+        self.assertGreater(latency, 0.05 * q.s)
+        self.assertLess(latency, 0.2 * q.s)
+
+    def test_timeout(self):
+        async def main():
+            shutter = await Shutter(BlissShutter(latency=1), timeout=0.1 * q.s)
+            with self.assertRaises(ShutterError):
+                await shutter.open()
+
+        asyncio.run(main())
@@ -0,0 +1,216 @@
+"""Test scan checkpoints."""
+import asyncio
+import glob
+import os
+import shutil
+import tempfile
+import numpy as np
+from unittest import SkipTest, TestCase
+from concert.quantities import q
+from esrfconcert.experiments.checkpoint import (CheckpointError, ScanCheckpoint, WrittenFrames,
+                                                _get_ranges)
+
+
+class TestScanCheckpoint(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'checkpoint.json')
+        self.scan = {'num_projections': 10, 'angular_range': 360.0, 'start_angle': 0.0}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_missing_sectors(self):
+        checkpoint = ScanCheckpoint(self.path)
+        checkpoint.reset(**self.scan)
+        self.assertEqual(checkpoint.get_missing_sectors(), [(0, 10)])
+        for index in [0, 1, 2, 5, 9]:
+            checkpoint.add(index)
+        # Not acquired until stored
+        self.assertEqual(checkpoint.get_missing_sectors(), [(0, 10)])
+        checkpoint.confirm()
+        self.assertEqual(checkpoint.get_missing_sectors(), [(3, 2), (6, 3)])
+        self.assertFalse(checkpoint.complete)
+        for index in [3, 4, 6, 7, 8]:
+            checkpoint.add(index)
+        checkpoint.confirm()
+        self.assertEqual(checkpoint.get_missing_sectors(), [])
+        self.assertTrue(checkpoint.complete)
+
+    def test_persistence(self):
+        checkpoint = ScanCheckpoint(self.path, save_interval=2)
+        checkpoint.reset(**self.scan)
+        checkpoint.directory = 'scan_0000'
+        checkpoint.set_valid('flats')
+        for index in range(3):
+            checkpoint.add(index)
+            checkpoint.confirm()
+
+        # Only saved every second projection
+        loaded = ScanCheckpoint(self.path)
+        self.assertEqual(loaded.num_acquired, 2)
+        self.assertTrue(loaded.is_valid('flats'))
+        self.assertFalse(loaded.is_valid('darks'))
+
+        loaded.start_run(**self.scan)
+        loaded.directory = 'scan_0001'
+        loaded.add(5)
+        loaded.confirm()
+        self.assertEqual(loaded.runs.tolist(), [0, 0, -1, -1, -1, 1, -1, -1, -1, -1])
+        self.assertEqual(loaded.locate(1), ('scan_0000', 1))
+        self.assertEqual(loaded.locate(5), ('scan_0001', 0))
+        self.assertIsNone(loaded.locate(2))
+
+    def test_confirm(self):
+        checkpoint = ScanCheckpoint(self.path)
+        checkpoint.reset(**self.scan)
+        for index in [3, 4, 5]:
+            checkpoint.add(index)
+        checkpoint.confirm(2)
+        self.assertEqual(checkpoint.get_missing().tolist(), [0, 1, 2, 5, 6, 7, 8, 9])
+        # More than added
+        checkpoint.confirm(10)
+        self.assertEqual(checkpoint.num_acquired, 3)
+
+    def test_locate(self):
+        checkpoint = ScanCheckpoint(self.path)
+        checkpoint.reset(**self.scan)
+        # Bidirectional sectors
+        for index in [0, 1, 2, 9, 8, 7, 5]:
+            checkpoint.add(index)
+        checkpoint.confirm()
+        self.assertEqual(checkpoint.records[0]['ranges'], [[0, 3, 1], [9, 6, -1], [5, 6, 1]])
+        for position, index in enumerate([0, 1, 2, 9, 8, 7, 5]):
+            self.assertEqual(checkpoint.locate(index), (None, position))
+
+    def test_ranges(self):
+        self.assertEqual(_get_ranges([]), [])
+        self.assertEqual(_get_ranges([4]), [[4, 5, 1]])
+        self.assertEqual(_get_ranges([4, 3, 2, 7]), [[4, 1, -1], [7, 8, 1]])
+        self.assertEqual(_get_ranges([1, 3, 4, 5]), [[1, 2, 1], [3, 6, 1]])
+
+    def test_discard(self):
+        checkpoint = ScanCheckpoint(self.path)
+        checkpoint.reset(**self.scan)
+        for index in [5, 6, 7, 2, 3]:
+            checkpoint.add(index)
+        checkpoint.confirm()
+        checkpoint.discard_since(7)
+        # Ignored until the next run
+        checkpoint.add(4)
+        checkpoint.confirm()
+        self.assertEqual(checkpoint.get_missing().tolist(), [0, 1, 2, 3, 4, 7, 8, 9])
+        self.assertEqual(checkpoint.locate(6), (None, 1))
+
+    def test_incompatible_scan(self):
+        checkpoint = ScanCheckpoint(self.path)
+        checkpoint.reset(**self.scan)
+        with self.assertRaises(CheckpointError):
+            checkpoint.start_run(num_projections=20, angular_range=360.0, start_angle=0.0)
+
+
+class TestWrittenFrames(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_count(self):
+        import tifffile
+
+        written = WrittenFrames(self.directory)
+        self.assertEqual(written.count(), 0)
+        for i in range(3):
+            tifffile.imwrite(os.path.join(self.directory, 'frame_{:>06}.tif'.format(i)),
+                             np.zeros((2, 2, 2), dtype=np.uint16))
+        # The last frame of the last file may still be being written
+        self.assertEqual(written.count(), 5)
+        with open(os.path.join(self.directory, 'frame_000003.tif'), 'w') as f:
+            f.write('incomplete')
+        self.assertEqual(written.count(), 6)
+
+
+class TestCheckpointedLaminography(TestCase):
+
+    def setUp(self):
+        try:
+            from esrfconcert.experiments.benchmark import SimulatedCamera
+        except ImportError as error:
+            raise SkipTest('Experiments not available: {}'.format(error))
+
+        class FailingCamera(SimulatedCamera):
+
+            """Camera failing after *fail_after* grabbed frames unless it is None."""
+
+            fail_after = None
+
+            async def _grab_real(self):
+                if self.fail_after is not None:
+                    if not self.fail_after:
+                        raise RuntimeError('Camera failed')
+                    self.fail_after -= 1
+
+                return await super()._grab_real()
+
+        self.camera_class = FailingCamera
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    async def _make_experiment(self):
+        from concert.devices.shutters.dummy import Shutter
+        from concert.experiments.addons import ImageWriter
+        from concert.storage import DirectoryWalker
+        from esrfconcert.experiments.benchmark import SimulatedRotationMotor
+        from esrfconcert.experiments.laminography import SteppedLaminography
+
+        camera = await self.camera_class(frame_rate=1000 / q.s, width=4, height=4)
+        flat_motor = await SimulatedRotationMotor(velocity=1000 * q.deg / q.s)
+        rot_motor = await SimulatedRotationMotor(velocity=100000 * q.deg / q.s)
+        walker = DirectoryWalker(root=self.directory)
+        experiment = await SteppedLaminography(walker, flat_motor, rot_motor, 30 * q.deg,
+                                               0 * q.deg, camera, await Shutter(), num_flats=2,
+                                               num_darks=2, num_projections=10)
+        ImageWriter(experiment.acquisitions, walker)
+        experiment.checkpoint = ScanCheckpoint(os.path.join(self.directory, 'checkpoint.json'),
+                                               save_interval=2)
+
+        return experiment, camera
+
+    def test_resume(self):
+        async def run():
+            experiment, camera = await self._make_experiment()
+            # Darks, flats and 6 projections succeed
+            camera.fail_after = 10
+            with self.assertRaises(Exception):
+                await experiment.run()
+            checkpoint = experiment.checkpoint
+            self.assertTrue(checkpoint.is_valid('darks'))
+            self.assertTrue(checkpoint.is_valid('flats'))
+            self.assertFalse(checkpoint.complete)
+            self.assertGreater(checkpoint.num_acquired, 0)
+            num_first = checkpoint.num_acquired
+
+            camera.fail_after = None
+            await experiment.resume()
+            self.assertTrue(checkpoint.complete)
+
+            return checkpoint, num_first
+
+        checkpoint, num_first = asyncio.run(run())
+        first, second = [record['directory'] for record in checkpoint.records]
+        # Completed acquisitions are not taken again
+        self.assertTrue(os.path.exists(os.path.join(first, 'darks')))
+        self.assertFalse(os.path.exists(os.path.join(second, 'darks')))
+        self.assertFalse(os.path.exists(os.path.join(second, 'flats')))
+        self.assertEqual(len(glob.glob(os.path.join(second, 'radios', '*.tif'))), 10 - num_first)
+        # Every projection can be found where it was written
+        for index in range(10):
+            directory, position = checkpoint.locate(index)
+            path = os.path.join(directory, 'radios', 'frame_{:>06}.tif'.format(position))
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(checkpoint.runs[index], 0 if directory == first else 1)
@@ -0,0 +1,82 @@
+"""Test image measures."""
+import numpy as np
+from unittest import TestCase
+from esrfconcert.imageprocessing import (center_of_mass, downsample, entropy, get_shift,
+                                         gradient_energy, sharpness, RunningStatistics)
+
+
+class TestSharpness(TestCase):
+
+    def setUp(self):
+        y, x = np.mgrid[-32:32, -32:32]
+        self.sharp = (x ** 2 + y ** 2 < 16 ** 2).astype(np.float32)
+        # Box blur
+        kernel = np.ones(5) / 5
+        blurred = np.apply_along_axis(np.convolve, 0, self.sharp, kernel, mode='same')
+        self.blurred = np.apply_along_axis(np.convolve, 1, blurred, kernel, mode='same')
+
+    def test_gradient_energy(self):
+        sharp, blurred = gradient_energy([self.sharp, self.blurred])
+        self.assertGreater(sharp, blurred)
+        self.assertEqual(gradient_energy(np.ones((8, 8))), 0)
+
+    def test_entropy(self):
+        sharp, blurred = entropy([self.sharp, self.blurred])
+        self.assertLess(sharp, blurred)
+        self.assertAlmostEqual(entropy(np.ones((8, 8))), 0)
+        self.assertAlmostEqual(entropy(np.arange(4).reshape(2, 2), num_bins=4), 2)
+
+    def test_stack_shape(self):
+        stack = np.random.random((2, 3, 16, 16))
+        self.assertEqual(sharpness(stack).shape, (2, 3))
+        self.assertEqual(sharpness(stack, metric='entropy').shape, (2, 3))
+
+    def test_unknown_metric(self):
+        with self.assertRaises(ValueError):
+            sharpness(self.sharp, metric='foo')
+
+
+class TestCenterOfMass(TestCase):
+
+    def test_center_of_mass(self):
+        images = np.zeros((2, 16, 32), dtype=np.float32)
+        images[0, 4:7, 10:13] = 1
+        # Negative values are ignored
+        images[0, 0, 0] = -1
+        np.testing.assert_almost_equal(center_of_mass(images)[0], [11, 5])
+        self.assertTrue(np.all(np.isnan(center_of_mass(images)[1])))
+
+
+class TestRunningStatistics(TestCase):
+
+    def test_statistics(self):
+        images = np.random.randint(0, 2 ** 16, size=(20, 8, 8)).astype(np.uint16)
+        images[:5, 0, 0] = 2 ** 16 - 1
+        images[:, 1, 1] = 2 ** 15
+        statistics = RunningStatistics()
+        for image in images:
+            statistics.update(image)
+        np.testing.assert_allclose(statistics.mean, images.mean(axis=0), rtol=1e-5)
+        np.testing.assert_allclose(statistics.variance, images.var(axis=0, ddof=1), rtol=1e-3,
+                                   atol=1e-3)
+        self.assertEqual(statistics.saturated[0, 0], 0.25)
+
+    def test_hot_pixels(self):
+        statistics = RunningStatistics()
+        image = np.full((16, 16), 100, dtype=np.uint16) + np.arange(16, dtype=np.uint16) % 3
+        image[3, 4] = 1000
+        statistics.update(image)
+        self.assertEqual(list(zip(*np.where(statistics.get_hot_pixels()))), [(3, 4)])
+
+
+class TestRegistration(TestCase):
+
+    def test_downsample(self):
+        image = np.arange(4 * 6, dtype=np.uint16).reshape(4, 6)
+        np.testing.assert_almost_equal(downsample(image, 2), [[3.5, 5.5, 7.5], [15.5, 17.5, 19.5]])
+        self.assertEqual(downsample(np.ones((3, 17, 17)), 4).shape, (3, 4, 4))
+
+    def test_shift(self):
+        reference = np.random.random((64, 80))
+        image = np.roll(reference, (3, -5), axis=(0, 1))
+        self.assertEqual(get_shift(image, reference), (3, -5))
@@ -0,0 +1,82 @@
+"""Test laminography experiments with simulated devices."""
+import asyncio
+import glob
+import os
+import shutil
+import tempfile
+from unittest import SkipTest, TestCase
+from concert.quantities import q
+try:
+    from concert.devices.shutters.dummy import Shutter
+    from concert.experiments.addons import Consumer, ImageWriter
+    from concert.storage import DirectoryWalker
+    from esrfconcert.experiments.benchmark import SimulatedCamera, SimulatedRotationMotor
+    from esrfconcert.experiments.laminography import TimeResolvedLaminography
+except ImportError as error:
+    # Concert without the experiment API of this package
+    raise SkipTest('Experiments not available: {}'.format(error))
+
+
+class TestTimeResolvedLaminography(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_revolutions(self):
+        num_projections = 12
+        num_revolutions = 3
+        names = ['radios', 'radios_1', 'radios_2']
+        revolutions = {}
+
+        def collect(name):
+            async def consume(producer):
+                async for frame in producer:
+                    revolutions[name].append(frame.metadata['revolution'])
+
+            return consume
+
+        async def run():
+            camera = await SimulatedCamera(frame_rate=500 / q.s, width=4, height=4)
+            flat_motor = await SimulatedRotationMotor(velocity=1000 * q.deg / q.s)
+            # A high acceleration keeps the margins and thus the rewind at 25 deg/s short
+            rot_motor = await SimulatedRotationMotor(velocity=1000 * q.deg / q.s,
+                                                     acceleration=1e8 * q.deg / q.s ** 2)
+            walker = DirectoryWalker(root=self.directory)
+            experiment = await TimeResolvedLaminography(
+                walker, flat_motor, rot_motor, await Shutter(), 30 * q.deg, 0 * q.deg, camera,
+                num_flats=2, num_darks=2, num_projections=num_projections,
+                num_revolutions=num_revolutions, flats_at_end=False
+            )
+            ImageWriter(experiment.acquisitions, walker)
+            for acquisition in experiment.acquisitions:
+                if acquisition.name in names:
+                    revolutions[acquisition.name] = []
+                    Consumer([acquisition], collect(acquisition.name))
+
+            positions = []
+            for i in range(2):
+                await experiment.run()
+                positions.append(await rot_motor.get_position())
+
+            return experiment, positions
+
+        experiment, positions = asyncio.run(run())
+        self.assertEqual([acq.name for acq in experiment.acquisitions],
+                         ['darks', 'flats'] + names)
+
+        for index, name in enumerate(names):
+            self.assertEqual(revolutions[name], [index] * num_projections * 2)
+            for scan in ['scan_0000', 'scan_0001']:
+                files = glob.glob(os.path.join(self.directory, scan, name, '*.tif'))
+                self.assertEqual(len(files), num_projections)
+
+        # The motor returns to the start angle modulo 360 degrees and the next scan continues
+        # from there instead of unwinding all revolutions
+        for i, position in enumerate(positions):
+            turns = (i + 1) * num_revolutions
+            self.assertAlmostEqual(position.to(q.deg).magnitude, turns * 360)
+        self.assertAlmostEqual(experiment._turn_offset.to(q.deg).magnitude,
+                               2 * num_revolutions * 360)
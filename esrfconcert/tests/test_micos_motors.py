@@ -1,10 +1,28 @@
 """Test Tango motors."""
+import asyncio
+import time
+import numpy as np
 from unittest import TestCase
+from concert.quantities import q
+from esrfconcert.sequencer import InterlockError
 from esrfconcert.devices.motors.micos import (
+    ALPHA,
+    BETA,
+    GAMMA,
     LinearMotor,
     RotationMotor,
     ContinuousLinearMotor,
+    MagnetsInException,
+    SampleManipulator,
+    SampleMotor,
     ContinuousRotationMotor,
+    LimitTable,
+    SoftLimitError,
+    _Base,
+    _LIMITS,
+    _QUERIES,
+    _RESTRICTIONS,
+    get_pusher_offsets,
 )
 
 
@@ -12,6 +30,55 @@ MICOS_HOST = '160.103.39.110'
 MICOS_PORT = 6542
 
 
+class FakeConnection(object):
+
+    """Records commands and replies like an idle Micos controller with three axes and soft limits
+    [-10, 32] on axis 0 and [0, 150] on the other axes. The reply to the limits query is *limits*
+    (raised if it is an exception) and is sent after *delay* seconds.
+    """
+
+    sleep_between = 1 * q.ms
+
+    def __init__(self, limits='Limit -10 32 0 150 0 150', delay=0):
+        self.commands = []
+        self.positions = ['0', '0', '0']
+        self.limits = limits
+        self.delay = delay
+
+    async def execute(self, data, priority=None):
+        self.commands.append(data)
+        controller, name = data.split()[:2]
+        if name == 'IsReady':
+            return controller + ' ready'
+        if name == 'Limit':
+            await asyncio.sleep(self.delay)
+            if isinstance(self.limits, Exception):
+                raise self.limits
+            return '{} {}'.format(controller, self.limits)
+        if name == 'MoveAbs':
+            self.positions = data.split()[2:]
+        if name == 'Crds':
+            return '{} Crds {}'.format(controller, ' '.join(self.positions))
+
+        return controller
+
+    async def send(self, data):
+        self.commands.append(data)
+
+
+class FakeMotor(object):
+
+    def __init__(self, position, state='in'):
+        self.position = position
+        self.state = state
+
+    async def get_position(self):
+        return self.position
+
+    async def get_state(self):
+        return self.state
+
+
 class TestLinearMotor(TestCase):
 
     """Simple sanity tests."""
@@ -23,3 +90,369 @@ class TestLinearMotor(TestCase):
         position = 1 * q.mm
         self.motor.position = position
         self.assertEqual(position, self.motor.position)
+
+
+class TestPusherOffsets(TestCase):
+
+    def test_single_axis(self):
+        rel_pos = 0.3 * q.mm
+        for offset, (x, y) in [(0 * q.deg, (rel_pos, 0 * q.mm)), (ALPHA, (0 * q.mm, rel_pos))]:
+            sx45, sy45 = get_pusher_offsets(x, y)
+            self.assertAlmostEqual(sx45.magnitude,
+                                   (rel_pos / np.cos(GAMMA - offset)).to(q.mm).magnitude)
+            self.assertAlmostEqual(sy45.magnitude,
+                                   (rel_pos / np.cos(GAMMA + BETA - offset)).to(q.mm).magnitude)
+
+    def test_vectorized(self):
+        x = np.linspace(-1, 1, 5) * q.mm
+        y = np.linspace(0, 200, 5) * q.um
+        sx45, sy45 = get_pusher_offsets(x, y)
+        for i in range(len(x)):
+            sx45_single, sy45_single = get_pusher_offsets(x[i], y[i])
+            self.assertAlmostEqual(sx45[i].magnitude, sx45_single.magnitude)
+            self.assertAlmostEqual(sy45[i].magnitude, sy45_single.magnitude)
+
+
+class TestLimits(TestCase):
+
+    def setUp(self):
+        self.limits = LimitTable([-10, 0, 0], [32, 150, 150])
+        _LIMITS.clear()
+        _QUERIES.clear()
+        _RESTRICTIONS.clear()
+
+    def tearDown(self):
+        _LIMITS.clear()
+        _QUERIES.clear()
+        _RESTRICTIONS.clear()
+
+    async def make_motor(self, **kwargs):
+        motor = _Base()
+        await motor.__ainit__('Cont2', 0, 'fake-limits', MICOS_PORT)
+        motor._connection = FakeConnection(**kwargs)
+
+        return motor
+
+    def test_validate(self):
+        targets = np.array([[0, 10, 10], [5, 149, 20], [5, 20, 151], [40, 20, 20]])
+        self.limits.validate(targets[:2])
+        self.limits.validate([31, 1], axes=[0, 2])
+        self.limits.validate(100, axes=[1])
+        with self.assertRaises(SoftLimitError) as context:
+            self.limits.validate(targets)
+        self.assertTrue(str(context.exception).startswith('Point 2 of 4: axis 2'))
+        with self.assertRaises(SoftLimitError):
+            self.limits.validate([np.nan], axes=[1])
+        with self.assertRaises(ValueError):
+            self.limits.validate(targets, axes=[0, 1])
+
+    def test_restrict(self):
+        self.limits.restrict(0, lower=-20, upper=20)
+        np.testing.assert_equal(self.limits.lower, [-10, 0, 0])
+        np.testing.assert_equal(self.limits.upper, [20, 150, 150])
+        with self.assertRaises(SoftLimitError):
+            self.limits.validate([25], axes=[0])
+
+    def test_query_once(self):
+        async def main():
+            queries = []
+
+            async def serve(reader, writer):
+                writer.write(b'Micos Motion Server\r\n')
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    queries.append(line.decode('ascii').strip())
+                    writer.write(b'Cont2 Limit -10 32 0 150 0 150\r\n')
+                writer.close()
+
+            server = await asyncio.start_server(serve, '127.0.0.1', 0)
+            host, port = server.sockets[0].getsockname()[:2]
+            motors = [_Base() for i in range(3)]
+            try:
+                for i, motor in enumerate(motors):
+                    await motor.__ainit__('Cont2', i, host, port)
+                    motor._connection.sleep_between = 1 * q.ms
+                tables = await asyncio.gather(*[motor.get_limits() for motor in motors])
+                # Only the first motor has connected
+                await motors[0]._connection.close()
+            finally:
+                server.close()
+                await server.wait_closed()
+
+            return queries, tables
+
+        queries, tables = asyncio.run(main())
+        self.assertEqual(queries, ['Cont2 Limit ?'])
+        self.assertTrue(all(table is tables[0] for table in tables))
+        np.testing.assert_equal(tables[0].upper, [32, 150, 150])
+
+    def test_cancelled_query(self):
+        async def main():
+            motor = await self.make_motor(delay=0.01)
+            first = asyncio.ensure_future(motor.get_limits())
+            await asyncio.sleep(0)
+            first.cancel()
+            # The query goes on for the other callers
+            table = await motor.get_limits()
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+
+            return table, motor._connection.commands
+
+        table, commands = asyncio.run(main())
+        self.assertEqual(commands, ['Cont2 Limit ?'])
+        np.testing.assert_equal(table.upper, [32, 150, 150])
+
+    def test_failed_query(self):
+        async def main():
+            motor = await self.make_motor(limits=ConnectionError('Controller unreachable'))
+            with self.assertRaises(ConnectionError):
+                await motor.get_limits()
+            motor._connection.limits = 'Limit -10 32 0 150 0 150'
+
+            return await motor.get_limits()
+
+        np.testing.assert_equal(asyncio.run(main()).upper, [32, 150, 150])
+
+    def test_unsupported_query(self):
+        async def main():
+            motor = await self.make_motor(limits='Unknown command')
+            with self.assertLogs('esrfconcert.devices.motors.micos', 'WARNING'):
+                limits = await motor.get_limits()
+            # Not checked
+            await motor.check_limits([100], axes=[0])
+
+            return limits
+
+        self.assertIsNone(asyncio.run(main()))
+
+    def test_query_timeout(self):
+        async def main():
+            motor = await self.make_motor(delay=1)
+            motor.limits_timeout = 10 * q.ms
+            with self.assertLogs('esrfconcert.devices.motors.micos', 'WARNING'):
+                limits = await motor.get_limits()
+            # Not checked this time but asked again next time
+            await motor.check_limits([100], axes=[0])
+            motor._connection.delay = 0
+
+            return limits, await motor.get_limits()
+
+        limits, table = asyncio.run(main())
+        self.assertIsNone(limits)
+        np.testing.assert_equal(table.upper, [32, 150, 150])
+
+    def test_other_loop(self):
+        async def main(motor=None):
+            motor = motor or await self.make_motor()
+
+            return motor, await motor.get_limits()
+
+        motor, first = asyncio.run(main())
+        # The table is not bound to the event loop which queried it
+        motor, second = asyncio.run(main(motor))
+        self.assertIs(first, second)
+        self.assertEqual(motor._connection.commands, ['Cont2 Limit ?'])
+
+    def test_restrictions(self):
+        async def main():
+            motor = await self.make_motor()
+            motor.restrict_limits(0, upper=20)
+            uppers = [(await motor.get_limits()).upper[0]]
+            motor.restrict_limits(0, lower=-5, upper=25)
+            uppers.append((await motor.get_limits()).upper[0])
+            motor.restrict_limits(0, upper=10)
+            uppers.append((await motor.get_limits()).upper[0])
+            # Kept when the controller is queried again
+            table = await motor.get_limits(refresh=True)
+
+            return uppers, table
+
+        uppers, table = asyncio.run(main())
+        self.assertEqual(uppers, [20, 20, 10])
+        np.testing.assert_equal(table.lower, [-5, 0, 0])
+        np.testing.assert_equal(table.upper, [10, 150, 150])
+
+
+class TestSampleMotor(TestCase):
+
+    def setUp(self):
+        _LIMITS.clear()
+        _QUERIES.clear()
+
+    def tearDown(self):
+        _LIMITS.clear()
+        _QUERIES.clear()
+
+    async def make_motor(self, **kwargs):
+        motor = await SampleMotor('Cont2', 'fake-sample-motor', MICOS_PORT, FakeMotor(10 * q.mm),
+                                  FakeMotor(20 * q.mm), FakeMotor(0.9 * q.mm),
+                                  FakeMotor(0.9 * q.mm), FakeMotor(5 * q.deg))
+        motor._connection = FakeConnection(**kwargs)
+
+        return motor
+
+    def test_move_relative(self):
+        offsets = np.array([[0, 0], [1, 0], [0, 0.5]]) * q.mm
+
+        async def main():
+            motor = await self.make_motor()
+
+            async def callback(x, y):
+                return await motor.get_position()
+
+            results = await motor.move_relative(offsets, callback=callback)
+
+            return motor._connection.commands, results
+
+        commands, results = asyncio.run(main())
+        moves = [command for command in commands if 'MoveAbs' in command]
+        self.assertEqual(len(moves), len(offsets))
+        sx45, sy45 = get_pusher_offsets(offsets[:, 0], offsets[:, 1])
+        for i, move in enumerate(moves):
+            np.testing.assert_almost_equal([float(value) for value in move.split()[2:]],
+                                           [5, 10 + sx45[i].magnitude, 20 + sy45[i].magnitude])
+        np.testing.assert_almost_equal(results[-1], [5, 10 + sx45[-1].magnitude,
+                                                     20 + sy45[-1].magnitude])
+
+    def test_move_relative_more_axes(self):
+        async def main():
+            # Controller with a fourth axis not moved by the sample motor
+            motor = await self.make_motor(limits='Limit -10 32 0 150 0 150 0 360')
+            await motor.move_relative(np.array([[0, 0], [1, 0]]) * q.mm)
+
+            return motor._connection.commands
+
+        self.assertEqual(len([command for command in asyncio.run(main()) if 'MoveAbs' in command]),
+                         2)
+
+    def test_move_relative_beyond_limits(self):
+        async def main():
+            motor = await self.make_motor()
+            with self.assertRaises(SoftLimitError):
+                await motor.move_grid(np.arange(3) * q.mm, np.linspace(0, 100, 3) * q.mm)
+
+            return motor._connection.commands
+
+        self.assertFalse([command for command in asyncio.run(main()) if 'MoveAbs' in command])
+
+
+class FakeManipulationMotor(object):
+
+    """Pusher or magnet of controller *controller* logging its motions into *log*, *active* counts
+    motions per controller to detect concurrent commands. If *stuck*, the motor does not move.
+    """
+
+    def __init__(self, name, log, active, state, controller='Sam', stuck=False, index=0):
+        self.name = name
+        self.log = log
+        self.active = active
+        self.state = state
+        self._controller = controller
+        self._index = index
+        self.stuck = stuck
+        self.max_active = 0
+
+    def __getitem__(self, name):
+        # Position parameter
+        return self
+
+    async def _move(self, state):
+        self.active[self._controller] = self.active.get(self._controller, 0) + 1
+        self.max_active = max(self.max_active, self.active[self._controller])
+        self.log.append((self.name, state))
+        await asyncio.sleep(0.01)
+        if not self.stuck:
+            self.state = state
+        self.active[self._controller] -= 1
+
+    async def move_in(self):
+        await self._move('in')
+
+    async def move_out(self):
+        await self._move('out')
+
+    async def stash(self):
+        pass
+
+    async def restore(self):
+        await self._move('in')
+
+    async def get_state(self):
+        return self.state
+
+
+class FakeAirConnection(object):
+
+    def __init__(self, log):
+        self.log = log
+
+    async def send(self, data):
+        self.log.append(('air', data))
+
+
+class TestSampleManipulator(TestCase):
+
+    def setUp(self):
+        self.log = []
+        self.active = {}
+
+    def make_manipulator(self, angle=-90 * q.deg, stuck=False, concurrent_axes=False):
+        pushers = [FakeManipulationMotor(name, self.log, self.active, 'in', index=i)
+                   for i, name in enumerate(['sx45', 'sy45'])]
+        magnets = [FakeManipulationMotor(name, self.log, self.active, 'in', stuck=stuck,
+                                         index=i + 2)
+                   for i, name in enumerate(['px45', 'py45'])]
+
+        return SampleManipulator(*pushers, *magnets, FakeMotor(angle),
+                                 FakeAirConnection(self.log), concurrent_axes=concurrent_axes)
+
+    def test_pushers_out(self):
+        manipulator = self.make_manipulator()
+        asyncio.run(manipulator.move_pushers_out())
+        names = [entry[0] for entry in self.log]
+        # Magnets go out and the air is switched off before any pusher moves
+        self.assertEqual(set(names[:2]), {'px45', 'py45'})
+        self.assertEqual(names[2], 'air')
+        self.assertEqual(set(names[3:]), {'sx45', 'sy45'})
+        # All axes are on one controller, which gets one command at a time
+        for motor in [manipulator.sx45, manipulator.sy45, manipulator.px45, manipulator.py45]:
+            self.assertEqual(motor.max_active, 1)
+
+    def test_concurrent_axes(self):
+        async def exchange(manipulator):
+            start = time.perf_counter()
+            await manipulator.move_pushers_out()
+
+            return time.perf_counter() - start
+
+        serial = asyncio.run(exchange(self.make_manipulator()))
+        manipulator = self.make_manipulator(concurrent_axes=True)
+        concurrent = asyncio.run(exchange(manipulator))
+        names = [entry[0] for entry in self.log[len(self.log) // 2:]]
+        # The interlocks still hold
+        self.assertEqual(set(names[:2]), {'px45', 'py45'})
+        self.assertEqual(names[2], 'air')
+        self.assertEqual(max(manipulator.px45.max_active, manipulator.py45.max_active), 2)
+        # Two motions at a time instead of four after each other
+        self.assertLess(concurrent, 0.75 * serial)
+
+    def test_magnets_stuck(self):
+        manipulator = self.make_manipulator(stuck=True)
+        with self.assertRaises(MagnetsInException):
+            asyncio.run(manipulator.move_pushers_out())
+        self.assertNotIn('sx45', [entry[0] for entry in self.log])
+        self.assertNotIn('sy45', [entry[0] for entry in self.log])
+
+    def test_exchange_angle(self):
+        manipulator = self.make_manipulator(angle=0 * q.deg)
+        for motor in [manipulator.px45, manipulator.py45]:
+            motor.state = 'out'
+        with self.assertRaises(InterlockError):
+            asyncio.run(manipulator.move_pushers_in())
+        self.assertEqual(self.log, [])
+        manipulator.lamino_rot.position = -90.05 * q.deg
+        asyncio.run(manipulator.move_pushers_in())
+        self.assertEqual(self.log[-1], ('air', 'Dmc2143 sendcommand SB 1'))
@@ -0,0 +1,161 @@
+"""Test Micos connection priorities against a simulated controller."""
+import asyncio
+import time
+from unittest import TestCase
+from concert.quantities import q
+from esrfconcert.devices.motors.micos import _Base
+from esrfconcert.networking.micos import NORMAL, POLL, URGENT, PriorityLock
+
+
+class SimulatedController(object):
+
+    """Micos server replying to IsReady and Crds queries after *reply_time* seconds, Stop has no
+    reply. The axes are moving if *moving* is True until Stop arrives. If *chunk_time* is not None,
+    replies are written in two chunks *chunk_time* seconds apart. Received commands are stored with
+    their arrival times in :attr:`received`.
+    """
+
+    def __init__(self, reply_time=0.001, moving=False, chunk_time=None):
+        self.reply_time = reply_time
+        self.moving = moving
+        self.chunk_time = chunk_time
+        self.received = []
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, '127.0.0.1', 0)
+
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def serve(self, reader, writer):
+        writer.write(b'Micos Motion Server\r\n')
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode('ascii').strip()
+            self.received.append((time.perf_counter(), command))
+            controller, name = command.split()[:2]
+            if name == 'Stop':
+                self.moving = False
+                continue
+            await asyncio.sleep(self.reply_time)
+            if name == 'IsReady':
+                reply = 'not ready' if self.moving else 'ready'
+            else:
+                reply = 'Crds 0 0 0'
+            reply = '{} {}\r\n'.format(controller, reply).encode('ascii')
+            if self.chunk_time is not None:
+                writer.write(reply[:len(reply) // 2])
+                await writer.drain()
+                await asyncio.sleep(self.chunk_time)
+                reply = reply[len(reply) // 2:]
+            writer.write(reply)
+        writer.close()
+
+
+class TestPriorityLock(TestCase):
+
+    def test_order(self):
+        async def main():
+            lock = PriorityLock()
+            order = []
+
+            async def request(name, priority):
+                await lock.acquire(priority)
+                order.append(name)
+                lock.release()
+
+            await lock.acquire()
+            tasks = [asyncio.ensure_future(request(name, priority)) for name, priority in
+                     [('poll-1', POLL), ('normal', NORMAL), ('poll-2', POLL), ('urgent', URGENT)]]
+            await asyncio.sleep(0)
+            self.assertTrue(lock.urgent.is_set())
+            lock.release()
+            await asyncio.gather(*tasks)
+            self.assertFalse(lock.urgent.is_set())
+
+            return order
+
+        self.assertEqual(asyncio.run(main()), ['urgent', 'normal', 'poll-1', 'poll-2'])
+
+
+class TestSocketConnection(TestCase):
+
+    def test_stop_latency(self):
+        sleep_between = 0.05
+        num_polls = 10
+
+        async def main():
+            controller = SimulatedController(moving=True)
+            host, port = await controller.start()
+            motor = _Base()
+            await motor.__ainit__('Sam', 0, host, port)
+            motor._connection.sleep_between = sleep_between * q.s
+            try:
+                # Queue state polling of other coroutines
+                polls = [asyncio.ensure_future(motor.get_state(priority=POLL))
+                         for i in range(num_polls)]
+                await asyncio.sleep(sleep_between / 2)
+                await motor._stop()
+                num_done = sum(poll.done() for poll in polls)
+                states = await asyncio.gather(*polls)
+            finally:
+                await motor._connection.close()
+                await controller.stop()
+
+            return [command for t, command in controller.received], num_done, states
+
+        commands, num_done, states = asyncio.run(main())
+        # Stop overtakes all queued polls, only the one in flight may be ahead of it
+        self.assertLessEqual(commands.index('Sam Stop'), 1)
+        # The stop is confirmed before the queued polls are served
+        self.assertLessEqual(num_done, 1)
+        self.assertEqual(commands.count('Sam IsReady'), num_polls + 1)
+        self.assertEqual(states[num_done:], ['standby'] * (num_polls - num_done))
+
+    def test_split_reply(self):
+        async def main():
+            controller = SimulatedController(moving=True, chunk_time=0.02)
+            host, port = await controller.start()
+            motor = _Base()
+            await motor.__ainit__('Sam', 0, host, port)
+            motor._connection.sleep_between = 0.001 * q.s
+            try:
+                # Urgent requests do not wait before reading and the normal one waits shorter than
+                # the reply takes, neither may leave the rest of the reply for the next request
+                states = [await motor.get_state(priority=URGENT)]
+                coordinates = await motor._connection.execute('Sam Crds', priority=NORMAL)
+                await motor._stop()
+                states.append(await motor.get_state(priority=URGENT))
+            finally:
+                await motor._connection.close()
+                await controller.stop()
+
+            return states, coordinates
+
+        states, coordinates = asyncio.run(main())
+        self.assertEqual(states, ['moving', 'standby'])
+        self.assertEqual(coordinates, 'Sam Crds 0 0 0')
+
+    def test_cancelled_request(self):
+        async def main():
+            controller = SimulatedController(reply_time=0.05)
+            host, port = await controller.start()
+            motor = _Base()
+            await motor.__ainit__('Sam', 0, host, port)
+            motor._connection.sleep_between = 0.001 * q.s
+            try:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(motor._connection.execute('Sam Crds'), 0.01)
+                # The late reply to the cancelled request is not taken for this one
+                return await motor.get_state()
+            finally:
+                await motor._connection.close()
+                await controller.stop()
+
+        self.assertEqual(asyncio.run(main()), 'standby')
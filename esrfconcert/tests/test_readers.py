@@ -0,0 +1,44 @@
+"""Test image replay."""
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import tifffile
+from unittest import TestCase
+from esrfconcert.readers import ReplaySource, TiffStack
+
+
+class TestReplay(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.images = np.arange(10 * 16 * 32, dtype=np.uint16).reshape(10, 16, 32)
+        # Two multi-page files, the second one compressed so it cannot be memory mapped
+        for i, compression in enumerate([None, 'zlib']):
+            with tifffile.TiffWriter(os.path.join(self.directory, 'frame_{}.tif'.format(i))) as tif:
+                for j in range(5):
+                    tif.write(self.images[5 * i + j], compression=compression,
+                              description=json.dumps({'index': 5 * i + j}))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read(self):
+        stack = TiffStack(self.directory)
+        self.assertEqual(len(stack), 10)
+        for index in [2, 7]:
+            image = stack.read(index, roi=(slice(2, 6), None))
+            np.testing.assert_array_equal(image, self.images[index, 2:6])
+            self.assertEqual(image.metadata, {'index': index})
+
+    def test_replay(self):
+        source = ReplaySource(self.directory, num_workers=3, prefetch=4, first=1, stride=2)
+
+        async def consume():
+            return [image async for image in source()]
+
+        images = asyncio.run(consume())
+        self.assertEqual(len(images), len(source))
+        np.testing.assert_array_equal(images, self.images[1::2])
@@ -0,0 +1,49 @@
+"""Test reconstruction helpers."""
+import asyncio
+import numpy as np
+from types import SimpleNamespace
+from unittest import TestCase
+from concert.quantities import q
+from esrfconcert.reconstruction import optimize_lamino_parameters
+
+
+class FakeManager(object):
+
+    """Backprojection manager whose slices get blurrier with the distance of the reco parameters
+    from *angle* and *center*.
+    """
+
+    def __init__(self, angle, center):
+        self.angle = angle
+        self.center = center
+        self.args = SimpleNamespace(z_parameter='z', region=[0.0, 1.0, 1.0], z=0,
+                                    axis_angle_x=[np.deg2rad(30)], center_position_x=[100.0])
+        self.projections = [np.zeros((4, 4))]
+        self.volume = None
+        self.pattern = np.random.RandomState(0).random_sample((16, 16))
+
+    async def backproject(self, producer):
+        async for projection in producer:
+            pass
+        values = np.arange(*self.args.region)
+        angles = values if self.args.z_parameter == 'axis-angle-x' else self.args.axis_angle_x[0]
+        centers = (values if self.args.z_parameter == 'center-position-x'
+                   else self.args.center_position_x[0])
+        contrast = np.exp(-((angles - self.angle) / 0.05) ** 2 - ((centers - self.center) / 5) ** 2)
+        contrast = np.broadcast_to(contrast, values.shape)
+        self.volume = contrast[:, np.newaxis, np.newaxis] * self.pattern
+
+
+class TestLaminoOptimization(TestCase):
+
+    def test_converges(self):
+        angle = np.deg2rad(31.7)
+        manager = FakeManager(angle, 107.3)
+        result = asyncio.run(optimize_lamino_parameters(manager, angle_range=5 * q.deg,
+                                                        center_range=20, zs=[0, 10]))
+        self.assertAlmostEqual(result.axis_angle_x.to(q.rad).magnitude, angle, delta=1e-3)
+        self.assertAlmostEqual(result.center_position_x, 107.3, delta=0.2)
+        self.assertEqual(len(result.scores['axis-angle-x']), 3)
+        # Original arguments are restored
+        self.assertEqual(manager.args.z_parameter, 'z')
+        self.assertEqual(manager.args.center_position_x, [100.0])
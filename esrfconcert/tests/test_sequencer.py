@@ -0,0 +1,99 @@
+"""Test sequences of dependent steps."""
+import asyncio
+from unittest import TestCase
+from esrfconcert.sequencer import InterlockError, Sequence, SequenceError, Step
+
+
+class TestSequence(TestCase):
+
+    def setUp(self):
+        self.log = []
+
+    def make_step(self, name, duration=0.05, after=(), interlocks=(), resource=None):
+        async def func():
+            self.log.append(('start', name))
+            await asyncio.sleep(duration)
+            self.log.append(('end', name))
+
+        return Step(name, func, after=after, interlocks=interlocks, resource=resource)
+
+    def test_concurrent(self):
+        sequence = Sequence([
+            self.make_step('a'),
+            self.make_step('b'),
+            self.make_step('c', after=['a', 'b']),
+        ])
+        asyncio.run(sequence.run())
+        # a and b run concurrently, c waits for both
+        self.assertEqual(set(self.log[:2]), {('start', 'a'), ('start', 'b')})
+        self.assertEqual(self.log[-2:], [('start', 'c'), ('end', 'c')])
+        self.assertLess(sequence.timings['total'], 0.14)
+
+    def test_invalid_graph(self):
+        with self.assertRaises(SequenceError):
+            Sequence([self.make_step('a', after=['foo'])])
+        with self.assertRaises(SequenceError):
+            Sequence([self.make_step('a', after=['b']), self.make_step('b', after=['a'])])
+        with self.assertRaises(SequenceError):
+            Sequence([self.make_step('a'), self.make_step('a')])
+
+    def test_interlock(self):
+        async def violated():
+            raise InterlockError('Not safe')
+
+        sequence = Sequence([self.make_step('a')], interlocks=[violated])
+        with self.assertRaises(InterlockError):
+            asyncio.run(sequence.run())
+        self.assertEqual(self.log, [])
+
+    def test_step_interlock_cancels(self):
+        async def violated():
+            raise InterlockError('Not safe')
+
+        sequence = Sequence([
+            self.make_step('slow', duration=1),
+            self.make_step('a', duration=0),
+            self.make_step('b', after=['a'], interlocks=[violated]),
+        ])
+        with self.assertRaises(InterlockError):
+            asyncio.run(sequence.run())
+        self.assertNotIn(('end', 'slow'), self.log)
+        self.assertNotIn(('start', 'b'), self.log)
+
+    def test_resource(self):
+        sequence = Sequence([
+            self.make_step('a', resource='ctrl'),
+            self.make_step('b', resource='ctrl'),
+            self.make_step('c'),
+        ])
+        asyncio.run(sequence.run())
+        a_start = self.log.index(('start', 'a'))
+        b_start = self.log.index(('start', 'b'))
+        first, second = ('a', 'b') if a_start < b_start else ('b', 'a')
+        self.assertLess(self.log.index(('end', first)), self.log.index(('start', second)))
+        # c does not wait for any of them
+        self.assertLess(self.log.index(('start', 'c')), self.log.index(('end', first)))
+
+    def test_interlock_cancels_interlocks(self):
+        cancelled = []
+
+        async def violated():
+            raise InterlockError('Not safe')
+
+        async def slow():
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append('slow')
+                raise
+
+        sequence = Sequence([self.make_step('a')], interlocks=[slow, violated])
+
+        async def main():
+            with self.assertRaises(InterlockError):
+                await sequence.run()
+            # The other check is cancelled by the time run returns
+            self.assertEqual(cancelled, ['slow'])
+
+        asyncio.run(main())
+        self.assertEqual(self.log, [])
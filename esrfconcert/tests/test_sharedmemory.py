@@ -0,0 +1,63 @@
+"""Test shared memory image transfer."""
+import multiprocessing
+import numpy as np
+from unittest import TestCase
+from esrfconcert.sharedmemory import SharedMemoryError, SharedRingBuffer
+
+
+def sum_images(ring, connection):
+    total = 0
+    while True:
+        kind, index, image = ring.read()
+        if kind == 1:
+            break
+        total += int(image.sum())
+        ring.release()
+    connection.send(total)
+    ring.close()
+
+
+class TestSharedRingBuffer(TestCase):
+
+    def setUp(self):
+        self.context = multiprocessing.get_context('spawn')
+        self.ring = SharedRingBuffer(4, 64 * 64 * 2, context=self.context)
+
+    def tearDown(self):
+        self.ring.close()
+        self.ring.unlink()
+
+    def test_round_trip(self):
+        image = np.arange(64 * 32, dtype=np.uint16).reshape(32, 64)
+        self.assertTrue(self.ring.reserve())
+        self.ring.write(5, index=3, image=image)
+        kind, index, result = self.ring.read()
+        self.assertEqual((kind, index), (5, 3))
+        np.testing.assert_array_equal(result, image)
+        self.ring.release()
+
+    def test_full(self):
+        for i in range(4):
+            self.assertTrue(self.ring.reserve(block=False))
+            self.ring.write(0, index=i)
+        self.assertFalse(self.ring.reserve(block=False))
+        self.assertIsNone(self.ring.read()[2])
+        self.ring.release()
+        self.assertTrue(self.ring.reserve(block=False))
+
+    def test_too_large(self):
+        self.ring.reserve()
+        with self.assertRaises(SharedMemoryError):
+            self.ring.write(0, image=np.zeros((65, 64), dtype=np.uint16))
+
+    def test_other_process(self):
+        connection, child_connection = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=sum_images, args=(self.ring, child_connection))
+        process.start()
+        for i in range(20):
+            self.ring.reserve()
+            self.ring.write(0, image=np.full((64, 64), i, dtype=np.uint16))
+        self.ring.reserve()
+        self.ring.write(1)
+        process.join(10)
+        self.assertEqual(connection.recv(), 64 * 64 * sum(range(20)))
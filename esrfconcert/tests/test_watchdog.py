@@ -0,0 +1,46 @@
+"""Test event loop stall detection."""
+import asyncio
+import os
+import time
+from unittest import TestCase
+from concert.quantities import q
+from esrfconcert.watchdog import StallWatchdog
+
+
+class BlockingDevice(object):
+
+    async def block(self, duration):
+        time.sleep(duration)
+
+
+class TestStallWatchdog(TestCase):
+
+    def run_with_watchdog(self, corofunc, **kwargs):
+        watchdog = StallWatchdog(threshold=50 * q.ms, directories=[os.path.dirname(__file__)],
+                                 **kwargs)
+
+        async def main():
+            watchdog.start()
+            try:
+                await corofunc()
+                # Let the watchdog see the heartbeat again
+                await asyncio.sleep(0.1)
+            finally:
+                watchdog.stop()
+
+        asyncio.run(main())
+
+        return watchdog
+
+    def test_stall(self):
+        device = BlockingDevice()
+        watchdog = self.run_with_watchdog(lambda: device.block(0.3), devices={'foo': device})
+        self.assertEqual(list(watchdog.stats.keys()), ['foo'])
+        stats = watchdog.stats['foo']
+        self.assertEqual(stats.count, 1)
+        self.assertGreater(stats.total, 0.2 * q.s)
+        self.assertIn('BlockingDevice.block', list(stats.call_sites.keys())[0])
+
+    def test_no_stall(self):
+        watchdog = self.run_with_watchdog(lambda: asyncio.sleep(0.3))
+        self.assertEqual(watchdog.stats, {})
@@ -0,0 +1,145 @@
+"""Event loop stall detection.
+
+Usage::
+
+    watchdog = StallWatchdog(threshold=50 * q.ms, devices={'lamino_rot': lamino_rot})
+    watchdog.start()
+    ...
+    print(watchdog)
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import esrfconcert.devices
+from concert.quantities import q
+
+
+LOG = logging.getLogger(__name__)
+
+
+class StallStatistics(object):
+
+    """Cumulative stalls caused by one device."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0 * q.s
+        self.maximum = 0 * q.s
+        # Call site -> number of stalls
+        self.call_sites = {}
+
+    def add(self, duration, call_site):
+        self.count += 1
+        self.total += duration
+        self.maximum = max(self.maximum, duration)
+        self.call_sites[call_site] = self.call_sites.get(call_site, 0) + 1
+
+    def __str__(self):
+        lines = ['{}: {} stalls, total {:.3f}, max {:.3f}'.format(
+            self.name, self.count, self.total.to(q.s), self.maximum.to(q.s))]
+        for call_site, count in sorted(self.call_sites.items(), key=lambda item: -item[1]):
+            lines.append('  {} ({}x)'.format(call_site, count))
+
+        return '\n'.join(lines)
+
+
+class StallWatchdog(object):
+
+    """Detect blocking of the event loop longer than *threshold*. A coroutine on the loop updates a
+    heartbeat every *interval* and a separate thread checks it. When the heartbeat is late, the
+    thread inspects the stack of the loop thread and attributes the stall to the innermost method of
+    an object defined in a file under one of *directories* (esrfconcert devices by default). Such
+    objects are named by the *devices* dictionary mapping names to devices, or by their class name.
+    Stalls without such a method are attributed to 'unknown'. Statistics are in :attr:`stats`.
+    """
+
+    def __init__(self, threshold=100 * q.ms, interval=10 * q.ms, devices=None, directories=None):
+        self.threshold = threshold.to(q.s).magnitude
+        self.interval = interval.to(q.s).magnitude
+        self.names = {id(device): name for name, device in (devices or {}).items()}
+        if directories is None:
+            directories = [os.path.dirname(esrfconcert.devices.__file__)]
+        self.directories = [os.path.abspath(directory) + os.sep for directory in directories]
+        self.stats = {}
+        self._heartbeat = None
+        self._loop_thread_id = None
+        self._beat_task = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """Start watching the current event loop, must be called from the loop thread."""
+        if self._thread:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop_event.clear()
+        self._beat_task = asyncio.ensure_future(self._beat())
+        self._thread = threading.Thread(target=self._watch, name='StallWatchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching."""
+        if not self._thread:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._beat_task.cancel()
+        self._thread = None
+
+    def reset(self):
+        """Clear statistics."""
+        self.stats = {}
+
+    async def _beat(self):
+        while True:
+            self._heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        stall = None
+        while not self._stop_event.wait(self.interval):
+            last = self._heartbeat
+            if stall is None:
+                if time.monotonic() - last - self.interval > self.threshold:
+                    frame = sys._current_frames().get(self._loop_thread_id)
+                    stall = (last, ) + self._locate(frame)
+            elif last != stall[0]:
+                # Heartbeat is back
+                duration = (last - stall[0] - self.interval) * q.s
+                name, call_site = stall[1:]
+                if name not in self.stats:
+                    self.stats[name] = StallStatistics(name)
+                self.stats[name].add(duration, call_site)
+                LOG.warning('Event loop blocked for %.3f s by %s at %s',
+                            duration.to(q.s).magnitude, name, call_site)
+                stall = None
+
+    def _locate(self, frame):
+        """Return (device name, call site) of the innermost device method in *frame*."""
+        innermost = frame
+        while frame is not None:
+            filename = os.path.abspath(frame.f_code.co_filename)
+            obj = frame.f_locals.get('self')
+            if obj is not None and any(filename.startswith(directory)
+                                       for directory in self.directories):
+                name = self.names.get(id(obj), type(obj).__name__)
+                call_site = '{}.{} ({}:{})'.format(type(obj).__name__, frame.f_code.co_name,
+                                                   filename, frame.f_lineno)
+                return (name, call_site)
+            frame = frame.f_back
+
+        if innermost is None:
+            return ('unknown', 'unknown')
+
+        return ('unknown', '{} ({}:{})'.format(innermost.f_code.co_name,
+                                               innermost.f_code.co_filename, innermost.f_lineno))
+
+    def __str__(self):
+        stats = sorted(self.stats.values(), key=lambda item: -item.total)
+
+        return '\n'.join(str(item) for item in stats) or 'No stalls'
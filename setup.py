@@ -5,7 +5,7 @@ import esrfconcert
 
 setup(
     name='esrfconcert',
-    python_requires='>=3.7',
+    python_requires='>=3.8',
     version=esrfconcert.__version__,
     author='Tomas Farago',
     author_email='tomas.farago@kit.edu',